@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+    Commentease benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the hot paths of Commentease on a synthetic SQLite database: posting
+    through ``comment_action``, voting and cancelling votes, recounts, deleting
+    comments and rendering the first page of threads. Each benchmark reports wall
+    time, the number of SQL statements and peak Python memory.
+
+    Peak memory is measured with ``tracemalloc`` in a second pass, since tracing
+    slows everything down. ``tracemalloc`` needs Python 3.4 or later, so on
+    Python 2 peak memory is reported as ``-`` and not compared.
+
+    Usage::
+
+        python -m benchmarks.run                      # Print results
+        python -m benchmarks.run --save baseline.json # Store results as a baseline
+        python -m benchmarks.run --baseline baseline.json  # Compare, fail on regressions
+
+    Data is generated from a fixed random seed, so runs are comparable across
+    versions. ``--comments`` sets the size of the large threads (default 10000).
+"""
+
+from __future__ import print_function
+
+import sys
+import gc
+import json
+import random
+import argparse
+from contextlib import contextmanager
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from flask import Flask, g
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from baseframe import baseframe
+from flask_commentease import Commentease, CommentingMixin
+
+try:
+    unicode_type = unicode
+except NameError:  # Python 3
+    unicode_type = str
+
+WORDS = (u"lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    u"incididunt ut labore et dolore magna aliqua").split()
+
+
+# --- Application ----------------------------------------------------------
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+app.config['SECRET_KEY'] = 'benchmark'
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['CSRF_ENABLED'] = False
+db = SQLAlchemy(app)
+
+
+class User(db.Model):
+    __tablename__ = 'user'
+    id = db.Column(db.Integer, primary_key=True)
+    fullname = db.Column(db.Unicode(80), nullable=False)
+
+
+class Document(CommentingMixin, db.Model):
+    __tablename__ = 'document'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(None, db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship(User)
+
+
+commentease = Commentease(app, db)
+baseframe.init_app(app, requires=[])
+
+
+# --- Synthetic data -------------------------------------------------------
+
+def make_message(rng):
+    return u' '.join(rng.choice(WORDS) for i in range(rng.randint(5, 60)))
+
+
+def make_users(count):
+    users = [User(fullname=u'User %d' % i) for i in range(count)]
+    db.session.add_all(users)
+    db.session.commit()
+    return users
+
+
+def make_document(owner):
+    document = Document(user=owner)
+    commentease.enable_commenting(document)
+    db.session.add(document)
+    db.session.commit()
+    return document
+
+
+def make_thread(document, users, count, rng, shape='wide', chain=50):
+    """
+    Add ``count`` comments to a document. ``wide`` threads are mostly top-level
+    comments with shallow replies. ``deep`` threads are chains of ``chain`` nested
+    replies each.
+    """
+    commentset = document.comments
+    comments = []
+    for i in range(count):
+        user = rng.choice(users)
+        comment = commentease.Comment(user=user, commentset=commentset, message=make_message(rng))
+        if shape == 'deep':
+            if i % chain:
+                comment.reply_to = comments[-1]
+        elif comments and rng.random() < 0.6:
+            comment.reply_to = rng.choice(comments[-50:])
+        comment.votes.vote(user, +1)
+        db.session.add(comment)
+        comments.append(comment)
+        if i % 500 == 499:
+            db.session.commit()
+    commentset.count += count
+    db.session.commit()
+    commentset.recount()
+    db.session.commit()
+    return comments
+
+
+def make_votes(comments, users, votes, rng):
+    """
+    Cast ``votes`` random votes on the given comments.
+    """
+    for i in range(votes):
+        comment = rng.choice(comments)
+        comment.votes.vote(rng.choice(users), rng.choice([+1, -1]))
+        if i % 500 == 499:
+            db.session.commit()
+    db.session.commit()
+
+
+# --- Measurement ----------------------------------------------------------
+
+class Statements(object):
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+@contextmanager
+def measure(results, name, statements, trace=False):
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    start_count = statements.count
+    start = default_timer()
+    yield
+    elapsed = default_timer() - start
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    results[name] = {'time': elapsed, 'statements': statements.count - start_count, 'peak_memory': peak}
+
+
+def post_comments(document, users, count, rng, reply_to_ids):
+    for i in range(count):
+        reply_to = u''
+        if rng.random() < 0.5:
+            reply_to = unicode_type(rng.choice(reply_to_ids))
+        with app.test_request_context('/comments', method='POST', data={
+                'form.id': 'newcomment', 'message': make_message(rng),
+                'comment_reply_to_id': reply_to, 'comment_edit_id': u''}):
+            g.user = rng.choice(users)
+            commentease.comment_action(document.comments, g.user)
+
+
+def run(statements, comments=10000, seed=1, trace=False):
+    rng = random.Random(seed)
+    results = {}
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    def timed(name):
+        return measure(results, name, statements, trace)
+
+    users = make_users(500)
+    wide = make_document(users[0])
+    deep = make_document(users[0])
+    wide_comments = make_thread(wide, users, comments, rng, shape='wide')
+    deep_comments = make_thread(deep, users, comments // 5, rng, shape='deep')
+    make_votes(wide_comments, users, comments * 2, rng)
+
+    reply_to_ids = [comment.id for comment in wide_comments[-50:]]
+    with timed('comment_action.post'):
+        post_comments(wide, users, 200, rng, reply_to_ids)
+
+    pairs = [(rng.choice(users), rng.choice(wide_comments)) for i in range(1000)]
+    with timed('VoteSet.vote'):
+        for user, comment in pairs:
+            comment.votes.vote(user, +1)
+            db.session.commit()
+    with timed('VoteSet.cancelvote'):
+        for user, comment in pairs:
+            comment.votes.cancelvote(user)
+            db.session.commit()
+
+    with timed('CommentSet.recount'):
+        wide.comments.recount()
+        deep.comments.recount()
+        db.session.commit()
+    with timed('VoteSet.recount'):
+        for comment in wide_comments[:1000]:
+            comment.votes.recount()
+        db.session.commit()
+
+    with app.test_request_context('/comments'):
+        g.user = users[1]
+        for name, document in (('wide', wide), ('deep', deep)):
+            db.session.expire_all()
+            with timed('comments.render.%s' % name):
+                commentease.thread_html(document, g.user, '/comments')
+
+    # Delete five deep chains from the head down, leaving deleted placeholders, then
+    # five from the tail up, so that placeholders are removed in a cascade
+    with timed('Comment.delete'):
+        for comment in deep_comments[:250]:
+            comment.delete()
+        db.session.commit()
+        for comment in reversed(deep_comments[250:500]):
+            comment = commentease.Comment.query.get(comment.id)
+            if comment is not None:
+                comment.delete()
+                db.session.commit()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for key in ('time', 'statements', 'peak_memory'):
+            old, new = baseline[name].get(key), result.get(key)
+            if old and new and new > old * tolerance:
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+def report(results):
+    print(u'%-28s %10s %12s %14s' % (u'benchmark', u'time (s)', u'statements', u'peak memory'))
+    for name, result in sorted(results.items()):
+        print(u'%-28s %10.3f %12d %14s' % (name, result['time'], result['statements'],
+            result['peak_memory'] if result['peak_memory'] is not None else u'-'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Commentease hot paths.")
+    parser.add_argument('--comments', type=int, default=10000, help="Comments in the large thread")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for generated data")
+    parser.add_argument('--save', metavar='PATH', help="Save results as a baseline")
+    parser.add_argument('--baseline', metavar='PATH', help="Compare results with a baseline")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+        help="Ratio over the baseline that counts as a regression (default 1.25)")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        statements = Statements(db.engine)
+        results = run(statements, comments=args.comments, seed=args.seed)
+        if tracemalloc is not None:
+            traced = run(statements, comments=args.comments, seed=args.seed, trace=True)
+            for name, result in traced.items():
+                results[name]['peak_memory'] = result['peak_memory']
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, key, old, new in regressions:
+            print(u'REGRESSION %s %s: %s -> %s' % (name, key, old, new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,26 +9,60 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import re
+import json
+import logging
+import math
+import numbers
+import hashlib
+from contextlib import contextmanager
 import bleach
+from time import time
 from datetime import datetime
-from flask import g, Blueprint, Markup, request, flash, redirect
-from sqlalchemy import Column, ForeignKey, Boolean
-from sqlalchemy.sql import select
-from sqlalchemy.orm import relationship, backref
+from weakref import WeakKeyDictionary
+from flask import (g, current_app, Blueprint, Markup, request, flash, redirect, abort, jsonify,
+    get_template_attribute, has_app_context, has_request_context, session as flask_session, _app_ctx_stack)
+from werkzeug.datastructures import MultiDict
+from sqlalchemy import Column, ForeignKey, Boolean, DateTime, Float, event, func, or_, and_, case, cast
+from sqlalchemy.sql import select, literal, literal_column, bindparam, table, column
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import (relationship, backref, joinedload, column_property, lazyload, undefer_group,
+    scoped_session, Session, object_session)
+from sqlalchemy.orm.attributes import set_committed_value, instance_state, get_history
 from sqlalchemy.ext.declarative import declared_attr, synonym_for
 import wtforms
 from coaster.gfm import markdown
 from coaster.sqlalchemy import TimestampMixin, BaseMixin, BaseScopedIdMixin
 from baseframe import assets, Version
 from baseframe.forms import Form
+try:
+    from bleach.sanitizer import Cleaner
+except ImportError:  # bleach < 2.0
+    Cleaner = None
 from ._version import __version__
+from .votebuffer import VoteBuffer
+from .cache import LRUCache, DBMCache
+from . import ranking
+from .cli import register_commands
+from .instrument import Instrumentation, timed
+from .pubsub import PubSub
+from .pipeline import Pipeline
+from .signals import (comment_posted, comment_edited, comment_deleted, comment_processed, vote_cast,
+    vote_cancelled, votes_cast, thread_rendered)
 
-__all__ = ['Commentease', 'CommentingMixin', 'VotingMixin', 'CommenteaseActionError']
+__all__ = ['Commentease', 'CommentingMixin', 'VotingMixin', 'CommenteaseActionError', 'ThreadNode']
+
+logger = logging.getLogger(__name__)
 
 version = Version(__version__)
 # assets['commentease.js'][version] = 'commentease/js/commentease.js'
 assets['commentease.css'][version] = 'commentease/css/commentease.css'
 
+MACROS = 'commentease/macros.html.jinja2'
+
+# Placeholders for per-user content in cached threads. See Commentease.personalize
+_placeholder_re = re.compile(r'<!--commentease:(vote|owner):(\d+)-->')
+
 
 class VOTE_PATTERN:
     UP_ONLY = 1   # Allow only +1 votes
@@ -45,6 +79,9 @@ class COMMENT_STATUS:
     SPAM = 5      # Marked as spam
     DELETED = 6   # Deleted, but has children and hierarchy needs to be preserved
 
+    #: Comments with these statuses are left out of threads, along with their replies
+    UNLISTED = (DRAFT, SCREENED, HIDDEN, SPAM)
+
 
 class CommentForm(Form):
     """
@@ -63,14 +100,207 @@ class CommenteaseActionError(Exception):
     pass
 
 
+def _populate_replies(comments, complete):
+    """
+    Assign reply lists to comments that were loaded in bulk, so that walking
+    :attr:`Comment.replies` does not emit a query per comment. Only comments in
+    ``complete`` are known to have all their replies present in ``comments``;
+    the others are left to load lazily.
+    """
+    replies = dict((comment.id, []) for comment in complete)
+    for comment in comments:
+        if comment.reply_to_id in replies:
+            replies[comment.reply_to_id].append(comment)
+    for comment in complete:
+        set_committed_value(comment, 'replies', replies[comment.id])
+
+
+_cursor_datetime_format = '%Y%m%dT%H%M%S%f'
+
+
+def _encode_cursor(order, comment):
+    if order == 'created_at':
+        value = comment.created_at.strftime(_cursor_datetime_format)
+    else:
+        value = repr(comment.rank)
+    return u'%s_%d' % (value, comment.id)
+
+
+def _decode_cursor(order, cursor):
+    try:
+        value, comment_id = cursor.split(u'_')
+        if order == 'created_at':
+            value = datetime.strptime(value, _cursor_datetime_format)
+        else:
+            value = float(value)
+        return value, int(comment_id)
+    except ValueError:
+        raise ValueError("Invalid cursor: %s." % cursor)
+
+
+def _flatten(roots, limit=None, max_depth=None):
+    """
+    Walk a thread in display order without recursion, yielding ``(comment, depth)``.
+    Each comment's replies are its first ``limit`` shown replies, and replies more
+    than ``max_depth`` levels down are skipped.
+    """
+    stack = [(comment, 0) for comment in reversed(roots)]
+    while stack:
+        comment, depth = stack.pop()
+        yield comment, depth
+        if max_depth is None or depth < max_depth:
+            stack.extend((reply, depth + 1) for reply in reversed(comment.shown_replies(limit)))
+
+
+class NodeUser(object):
+    """
+    Author of a :class:`ThreadNode`. Compares equal to any user with the same id.
+    """
+    __slots__ = ('id', 'fullname')
+
+    def __init__(self, id, fullname):
+        self.id = id
+        self.fullname = fullname
+
+    def __eq__(self, other):
+        return other is not None and getattr(other, 'id', None) == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+
+class NodeVotes(object):
+    """
+    Vote count and score of a :class:`ThreadNode`.
+    """
+    __slots__ = ('count', 'score')
+
+    def __init__(self, count, score):
+        self.count = count
+        self.score = score
+
+
+class ThreadNode(object):
+    """
+    Read-only comment for display, built from a row by :meth:`CommentSet.nodes`.
+    It has the attributes and methods of :class:`Comment` that the macros and
+    JSON views use, with all listed replies present.
+    """
+    __slots__ = ('id', 'reply_to_id', 'user', 'status', 'created_at', 'edited_at', 'rank',
+        'reply_count', 'depth', 'votes_id', 'votes', 'replies', '_message_html')
+
+    def __init__(self, id, reply_to_id, user, status, created_at, edited_at, rank, reply_count,
+            depth, votes_id, votes, message_html):
+        self.id = id
+        self.reply_to_id = reply_to_id
+        self.user = user
+        self.status = status
+        self.created_at = created_at
+        self.edited_at = edited_at
+        self.rank = rank
+        self.reply_count = reply_count
+        self.depth = depth
+        self.votes_id = votes_id
+        self.votes = votes
+        self.replies = []
+        self._message_html = message_html
+
+    @property
+    def message_html(self):
+        return Markup(self._message_html)
+
+    @property
+    def is_deleted(self):
+        return self.status == COMMENT_STATUS.DELETED
+
+    def sorted_replies(self):
+        # Rows are loaded in display order
+        return self.replies
+
+    def shown_replies(self, limit=None):
+        return self.replies[:limit]
+
+    def more_replies(self, limit=None):
+        if limit is None:
+            return 0
+        return max(len(self.replies) - limit, 0)
+
+    def cursor(self, order='rank'):
+        return _encode_cursor(order, self)
+
+
+def _path_segment(comment_id):
+    # Fixed width, so that paths sort in tree order. Sixteen digits fit any 64-bit id
+    return u'%016x' % comment_id
+
+
+def _dump_row(keys, row):
+    return dict((key, value.isoformat() if isinstance(value, datetime) else value)
+        for key, value in zip(keys, row))
+
+
+def _load_row(table, data):
+    row = {}
+    for column in table.columns:
+        if column.name in data:
+            value = data[column.name]
+            if value is not None and isinstance(column.type, DateTime):
+                value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+            row[column.name] = value
+    return row
+
+
+# Just the columns that summaries need. The models are defined later, in init_db
+_voteset_summary = table('voteset', column('id'), column('count'), column('score'))
+_commentset_summary = table('commentset', column('id'), column('count'))
+# Full-text index of comment messages on SQLite, with the comment id as rowid
+_comment_fts = table('comment_fts', column('rowid'), column('message'))
+
+#: Deferred column group with the vote and comment summaries of a model
+SUMMARY_GROUP = 'commentease_summary'
+
+
+def _uses_voting(cls):
+    # Models get the mixins by subclassing them or from Commentease.addmixin
+    return hasattr(cls, 'votes_id')
+
+
+def _uses_commenting(cls):
+    return hasattr(cls, 'comments_id')
+
+
+def _add_summary(cls):
+    """
+    Add deferred ``vote_count``, ``vote_score`` and ``comment_count`` column
+    properties to a model using the mixins, once its table is available.
+    """
+    mapper = cls.__mapper__
+    if _uses_voting(cls) and not mapper.has_property('vote_count'):
+        cls.vote_count = column_property(select([func.coalesce(_voteset_summary.c.count, 0)]).where(
+            _voteset_summary.c.id == cls.__table__.c.votes_id).as_scalar(),
+            deferred=True, group=SUMMARY_GROUP)
+        cls.vote_score = column_property(select([func.coalesce(_voteset_summary.c.score, 0)]).where(
+            _voteset_summary.c.id == cls.__table__.c.votes_id).as_scalar(),
+            deferred=True, group=SUMMARY_GROUP)
+    if _uses_commenting(cls) and not mapper.has_property('comment_count'):
+        cls.comment_count = column_property(select([func.coalesce(_commentset_summary.c.count, 0)]).where(
+            _commentset_summary.c.id == cls.__table__.c.comments_id).as_scalar(),
+            deferred=True, group=SUMMARY_GROUP)
+
+
 class VotingMixin(object):
+    #: Loading strategy for :attr:`votes`. Override in the model to change it
+    votes_lazy = 'joined'
+
     @declared_attr
     def votes_id(cls):
         return Column(None, ForeignKey('voteset.id'), nullable=True)
 
     @declared_attr
     def votes(cls):
-        return relationship('VoteSet', lazy='joined', single_parent=True,
+        return relationship('VoteSet', lazy=cls.votes_lazy, single_parent=True,
             backref=backref(cls.__tablename__ + '_parent'), cascade='all, delete-orphan')
 
     #: Allow voting? This flag allows voting to be turned off if required
@@ -78,15 +308,22 @@ class VotingMixin(object):
     def allow_voting(cls):
         return Column(Boolean, nullable=False, default=False)
 
+    @classmethod
+    def __declare_last__(cls):
+        _add_summary(cls)
+
 
 class CommentingMixin(object):
+    #: Loading strategy for :attr:`comments`. Override in the model to change it
+    comments_lazy = 'select'
+
     @declared_attr
     def comments_id(cls):
         return Column(None, ForeignKey('commentset.id'), nullable=True)
 
     @declared_attr
     def comments(cls):
-        return relationship('CommentSet', lazy='subquery', single_parent=True,
+        return relationship('CommentSet', lazy=cls.comments_lazy, single_parent=True,
             backref=backref(cls.__tablename__ + '_parent'), cascade='all, delete-orphan')
 
     #: Allow comments? This flag allows commenting to be turned off if required
@@ -94,6 +331,10 @@ class CommentingMixin(object):
     def allow_commenting(cls):
         return Column(Boolean, nullable=False, default=False)
 
+    @classmethod
+    def __declare_last__(cls):
+        _add_summary(cls)
+
 
 commentease_blueprint = Blueprint('commentease', __name__,
     static_folder='static',
@@ -122,35 +363,231 @@ class Commentease(object):
             'markdown': markdown
             }
 
+        #: Ranking functions for ordering comments, selected by ``CommentSet.ranking``
+        self.rankers = {
+            'score': ranking.score,
+            'wilson': ranking.wilson,
+            'hot': ranking.hot
+            }
+
+        #: Cache of cooked HTML, keyed on parser and a hash of the text
+        self.cooked = LRUCache(4 * 1024 * 1024)
+        self._cleaner = None
+        self._configure_sanitizer()
+
+        #: Write-behind buffer for vote counts, enabled with ``COMMENT_VOTE_BUFFER``
+        self.votebuffer = None
+        #: Cache for rendered threads, configured with ``COMMENT_CACHE``
+        self.cache = None
+        #: Seconds before a cached thread is rendered again to refresh its ages
+        self.cache_timeout = 300
+        #: Number of top-level comments in a page
+        self.page_size = 20
+        #: Levels of replies loaded along with a page of comments
+        self.reply_depth = 3
+        #: Number of replies shown under a comment before a "more replies" link
+        self.reply_limit = None
+        #: Levels of replies rendered before a "more replies" link
+        self.max_depth = None
+        #: Level below which replies are listed without further nesting
+        self.flatten_depth = None
+        self._thread_access = None
+        #: SQL statement counts and timings per operation, enabled with ``COMMENT_INSTRUMENT``
+        self.instrumentation = None
+        #: Publish/subscribe backend for pushing thread changes, enabled with ``COMMENT_PUSH``
+        self.pubsub = None
+        #: Seconds an event stream stays open before the client has to reconnect
+        self.push_timeout = 300
+        self._staged_events = WeakKeyDictionary()
+        self._staged_reranks = WeakKeyDictionary()
+        #: Name of a bind in ``SQLALCHEMY_BINDS`` for read paths, set with ``COMMENT_READ_BIND``
+        self.read_bind = None
+        #: Seconds a client's reads stay on the primary after it writes something
+        self.read_sticky = 10
+        self._read_session = None
+        #: Background processing of new comments, enabled with ``COMMENT_PIPELINE``
+        self.pipeline = None
+        #: Checks run on new comments by the pipeline. See :meth:`comment_check`
+        self.checks = []
+        #: PostgreSQL text search configuration for the search index, set with
+        #: ``COMMENT_SEARCH_CONFIG``. Changing it requires recreating the index
+        self.search_config = 'english'
+        self._search_backends = WeakKeyDictionary()
+
         if app is not None:
             self.init_app(app)
 
         if db is not None:
             self.init_db(db)
 
+    def _configure_sanitizer(self):
+        # Rebuild the reusable cleaner and drop HTML cooked with the old settings
+        if Cleaner is not None:
+            self._cleaner = Cleaner(tags=self.sanitize_tags, attributes=self.sanitize_attributes)
+        self.cooked.clear()
+
     def sanitize(self, text):
         """
         Sanitize HTML to remove harmful tags and attributes.
         """
+        if self._cleaner is not None:
+            return self._cleaner.clean(text)
         return bleach.clean(text, tags=self.sanitize_tags, attributes=self.sanitize_attributes)
 
     def cook(self, parser, text):
         """
-        Cook text with the specified parser.
+        Cook text with the specified parser. Output is cached on a hash of the text,
+        so identical text is only cooked once.
+        """
+        key = u'%s:%s' % (parser, hashlib.sha1(text.encode('utf-8')).hexdigest())
+        html = self.cooked.get(key)
+        if html is None:
+            html = self.parsers[parser](text)
+            self.cooked.set(key, html)
+        return html
+
+    def recook(self, commentset=None, batch_size=500):
         """
-        return self.parsers[parser](text)
+        Cook stored comments again, in the given comment set or all of them, such as
+        after changing ``COMMENT_TAGS``. Comments are read as plain columns in batches
+        of ``batch_size`` and changed HTML is written with one UPDATE per batch,
+        committing after each. Returns the number of comments updated.
+        """
+        self.cooked.clear()
+        comment_table = self.Comment.__table__
+        commentset_table = self.CommentSet.__table__
+        update_comment = comment_table.update().where(
+            comment_table.c.id == bindparam('_id')).values(message_html=bindparam('_html'))
+        updated = 0
+        last_id = 0
+        while True:
+            query = select([comment_table.c.id, comment_table.c.commentset_id, comment_table.c.parser,
+                comment_table.c.message, comment_table.c.message_html]).where(
+                comment_table.c.id > last_id).order_by(comment_table.c.id).limit(batch_size)
+            if commentset is not None:
+                query = query.where(comment_table.c.commentset_id == commentset.id)
+            rows = self.db.session.execute(query).fetchall()
+            if not rows:
+                break
+            changes = []
+            commentsets = set()
+            for comment_id, commentset_id, parser, message, message_html in rows:
+                html = self.cook(parser, message)
+                if html != message_html:
+                    changes.append({'_id': comment_id, '_html': html})
+                    commentsets.add(commentset_id)
+            if changes:
+                self.db.session.execute(update_comment, changes)
+                self.db.session.execute(commentset_table.update().where(
+                    commentset_table.c.id.in_(commentsets)).values(
+                    version=commentset_table.c.version + 1))
+            self.db.session.commit()
+            updated += len(changes)
+            last_id = rows[-1][0]
+        return updated
 
     def init_app(self, app):
         self.app = app
+        app.extensions['commentease'] = self
         app.register_blueprint(commentease_blueprint)
+        app.add_template_global(self.thread_html, 'commentease_thread')
+        register_commands(app, self)
 
         if 'COMMENT_TAGS' in app.config:
             self.sanitize_tags = app.config['COMMENT_TAGS']
         if 'COMMENT_ATTRIBUTES' in app.config:
             self.sanitize_attributes = app.config['COMMENT_ATTRIBUTES']
+        if 'COMMENT_COOK_CACHE_SIZE' in app.config:
+            self.cooked = LRUCache(app.config['COMMENT_COOK_CACHE_SIZE'])
+        self._configure_sanitizer()
+        if app.config.get('COMMENT_VOTE_BUFFER'):
+            def flush():
+                with app.app_context():
+                    self.flush_votes()
+            self.votebuffer = VoteBuffer(
+                size=app.config.get('COMMENT_VOTE_BUFFER_SIZE', 100),
+                interval=app.config.get('COMMENT_VOTE_BUFFER_INTERVAL', 5),
+                flush=flush)
+        if app.config.get('COMMENT_CACHE') == 'lru':
+            self.cache = LRUCache(app.config.get('COMMENT_CACHE_SIZE', 16 * 1024 * 1024))
+        elif app.config.get('COMMENT_CACHE') == 'dbm':
+            self.cache = DBMCache(app.config['COMMENT_CACHE_PATH'])
+        self.cache_timeout = app.config.get('COMMENT_CACHE_TIMEOUT', self.cache_timeout)
+        self.page_size = app.config.get('COMMENT_PAGE_SIZE', self.page_size)
+        self.reply_depth = app.config.get('COMMENT_REPLY_DEPTH', self.reply_depth)
+        self.reply_limit = app.config.get('COMMENT_REPLY_LIMIT', self.reply_limit)
+        self.max_depth = app.config.get('COMMENT_MAX_DEPTH', self.max_depth)
+        self.flatten_depth = app.config.get('COMMENT_FLATTEN_DEPTH', self.flatten_depth)
+        if app.config.get('COMMENT_INSTRUMENT') and self.instrumentation is None:
+            self.instrumentation = Instrumentation()
+        if app.config.get('COMMENT_PUSH') and self.pubsub is None:
+            self.pubsub = PubSub(app.config.get('COMMENT_PUSH_QUEUE_SIZE', 100))
+        self.push_timeout = app.config.get('COMMENT_PUSH_TIMEOUT', self.push_timeout)
+        self.read_sticky = app.config.get('COMMENT_READ_STICKY', self.read_sticky)
+        self.search_config = app.config.get('COMMENT_SEARCH_CONFIG', self.search_config)
+        if app.config.get('COMMENT_READ_BIND'):
+            self.read_bind = app.config['COMMENT_READ_BIND']
+            # Scoped like Flask-SQLAlchemy's own session, and removed along with it
+            self._read_session = scoped_session(
+                lambda: Session(bind=self._read_engine(), autoflush=False),
+                scopefunc=_app_ctx_stack.__ident_func__)
+            app.teardown_appcontext(self._remove_read_session)
+        if app.config.get('COMMENT_PIPELINE') and self.pipeline is None:
+            def process(ids):
+                with app.app_context():
+                    self.process_comments(ids)
+            self.pipeline = Pipeline(process,
+                workers=app.config.get('COMMENT_PIPELINE_WORKERS', 2),
+                queue_size=app.config.get('COMMENT_PIPELINE_QUEUE_SIZE', 1000),
+                batch_size=app.config.get('COMMENT_PIPELINE_BATCH_SIZE', 50))
+        if self.instrumentation is not None:
+            self._listen_engines()
+            if app.debug:
+                app.after_request(self._log_metrics)
+
+    def _listen_engines(self):
+        # Count statements on this app's engines only, not every engine in the process
+        self.instrumentation.listen(self.db.get_engine(self.app))
+        if self.read_bind is not None:
+            self.instrumentation.listen(self.db.get_engine(self.app, self.read_bind))
+
+    def _read_engine(self):
+        if self.read_bind is None:
+            return self.db.engine
+        return self.db.get_engine(current_app, self.read_bind)
+
+    def _remove_read_session(self, exc=None):
+        self._read_session.remove()
+
+    def reader(self):
+        """
+        Session for read paths that can tolerate slightly stale data, like thread
+        rendering. This is the read bind's session if ``COMMENT_READ_BIND`` is set,
+        except for a client that wrote something in the last ``COMMENT_READ_STICKY``
+        seconds, whose reads stay on the primary so that it sees its own changes.
+        Objects loaded from the read session must not be modified.
+        """
+        if self._read_session is None or self._reads_from_primary():
+            return self.db.session
+        return self._read_session
+
+    def _reads_from_primary(self):
+        if getattr(g, 'commentease_primary', False):
+            return True
+        return has_request_context() and flask_session.get('commentease_primary_until', 0) > time()
+
+    def mark_write(self):
+        """
+        Send this client's reads to the primary for the next ``COMMENT_READ_STICKY``
+        seconds. The view handlers call this after writing.
+        """
+        g.commentease_primary = True
+        if self._read_session is not None and has_request_context():
+            flask_session['commentease_primary_until'] = time() + self.read_sticky
 
     def init_db(self, db, userid='user.id', usermodel='User'):
         self.db = db
+        commentease = self
 
         # Create models that are linked to this database object
         class Vote(TimestampMixin, db.Model):
@@ -168,6 +605,53 @@ class Commentease(object):
             #: Voting data. Contents vary based on voting pattern (boolean, range, flags)
             data = db.Column(db.Integer, nullable=True)
 
+            @property
+            def votedown(self):
+                return self.data is not None and self.data < 0
+
+        class VoteBucket(db.Model):
+            """
+            Number of votes with one value in a range voteset. Range votesets have a
+            bucket for every value from ``min`` to ``max``, kept current as votes are
+            cast, changed and withdrawn, so that their distribution can be read without
+            scanning votes.
+            """
+            __tablename__ = 'vote_bucket'
+            #: Id of voteset
+            voteset_id = db.Column(None, db.ForeignKey('voteset.id'), nullable=False, primary_key=True)
+            #: VoteSet this bucket is a part of
+            voteset = db.relationship('VoteSet',
+                backref=db.backref('buckets', cascade="all, delete-orphan", order_by='VoteBucket.value'))
+            #: Vote value
+            value = db.Column(db.Integer, nullable=False, primary_key=True)
+            #: Number of votes with this value
+            count = db.Column(db.Integer, default=0, nullable=False)
+
+            @classmethod
+            def rebuild(cls, ids):
+                """
+                Recreate the buckets of the range votesets among the given voteset ids
+                (a list or a select of ids) from their votes.
+                """
+                bucket_table = cls.__table__
+                voteset_table = VoteSet.__table__
+                vote_table = Vote.__table__
+                ranges = db.session.execute(select([voteset_table.c.id, voteset_table.c.min,
+                    voteset_table.c.max]).where(and_(voteset_table.c.id.in_(ids),
+                    voteset_table.c.pattern == VOTE_PATTERN.RANGE, voteset_table.c.min != None,
+                    voteset_table.c.max != None))).fetchall()
+                if not ranges:
+                    return
+                range_ids = [voteset_id for voteset_id, low, high in ranges]
+                counts = dict(((voteset_id, value), count) for voteset_id, value, count in db.session.execute(
+                    select([vote_table.c.voteset_id, vote_table.c.data, func.count()]).where(
+                        vote_table.c.voteset_id.in_(range_ids)).group_by(
+                        vote_table.c.voteset_id, vote_table.c.data)))
+                db.session.execute(bucket_table.delete().where(bucket_table.c.voteset_id.in_(range_ids)))
+                db.session.execute(bucket_table.insert(), [{'voteset_id': voteset_id, 'value': value,
+                    'count': counts.get((voteset_id, value), 0)}
+                    for voteset_id, low, high in ranges for value in range(low, high + 1)])
+
         class VoteSet(BaseMixin, db.Model):
             __tablename__ = 'voteset'
             #: Type of entity getting voted on
@@ -176,8 +660,8 @@ class Commentease(object):
             count = db.Column(db.Integer, default=0, nullable=False)
             #: Voting score (sum of votes)
             score = db.Column(db.Integer, default=0, nullable=False)
-            #: Voting average
-            # average = db.column_property(score / count)  # Causes division by zero errors
+            #: Voting average, or None without votes
+            average = db.column_property(case([(count > 0, cast(score, Float) / count)], else_=None))
             #: Voting pattern
             pattern = db.Column(db.SmallInteger, nullable=False, default=VOTE_PATTERN.UP_DOWN)
             #: Range vote minimum (optional)
@@ -190,109 +674,240 @@ class Commentease(object):
                 self.count = 0
                 self.score = 0
 
-            def vote(self, user, data=None):
-                vote = self.getvote(user)
-                # The following count and score incrementing operations work with SQL expressions
-                # rather than actual values to handle concurrency. Offloading calculations to the
-                # database prevents concurrent updates from messing up the values.
+            def _adjust(self, count=0, score=0):
+                """
+                Add to this voteset's count and score.
+                """
+                if not count and not score:
+                    return
+                if self.id is None:
+                    # New voteset. There's no row yet and no concurrency to worry about
+                    self.count += count
+                    self.score += score
+                elif commentease.votebuffer is not None:
+                    commentease.votebuffer.add(db.session(), self.id, count, score)
+                else:
+                    # Work with SQL expressions rather than actual values to handle
+                    # concurrency. Offloading calculations to the database prevents
+                    # concurrent updates from messing up the values.
+                    if count:
+                        self.count = select([self.__table__.c.count]).where(
+                            self.__table__.c.id == self.id).as_scalar() + count
+                    if score:
+                        self.score = select([self.__table__.c.score]).where(
+                            self.__table__.c.id == self.id).as_scalar() + score
+
+            def validate(self, data):
+                """
+                Check that ``data`` is a valid vote for this voteset's pattern.
+                Raises ValueError if not.
+                """
                 if self.pattern == VOTE_PATTERN.UP_ONLY:
                     if data is not None:
-                        raise ValueError("Invalid vote data: %s." % data)
-                    if not vote:
-                        vote = Vote(user=user, voteset=self)
-                        db.session.add(vote)
-                        if self.id is not None:
-                            self.count = select([self.__table__.c.count]).where(
-                                self.__table__.c.id == self.id).as_scalar() + 1
-                            self.score = select([self.__table__.c.score]).where(
-                                self.__table__.c.id == self.id).as_scalar() + 1
-                        else:
-                            self.count = 1
-                            self.score = data
+                        raise ValueError("Invalid vote data: %r." % (data,))
                 elif self.pattern == VOTE_PATTERN.UP_DOWN:
                     if data not in [+1, -1]:
-                        raise ValueError("Invalid vote data: %s." % data)
-                    if not vote:
-                        vote = Vote(user=user, voteset=self, data=data)
-                        db.session.add(vote)
-                        if self.id is not None:
-                            self.count = select([self.__table__.c.count]).where(
-                                self.__table__.c.id == self.id).as_scalar() + 1
-                            self.score = select([self.__table__.c.score]).where(
-                                self.__table__.c.id == self.id).as_scalar() + data
-                        else:
-                            self.count = 1
-                            self.score = data
-                    else:
-                        if data != vote.data:
-                            # Recalculate score
-                            vote.data = data
-                            if self.id is not None:
-                                self.score = select([self.__table__.c.score]).where(
-                                    self.__table__.c.id == self.id).as_scalar() + (data * 2)
-                            else:
-                                # We should never get here. Can't have vote but no voteset
-                                self.score = data
+                        raise ValueError("Invalid vote data: %r." % (data,))
                 elif self.pattern == VOTE_PATTERN.RANGE:
-                    if self.min <= data <= self.max:
-                        raise ValueError("Vote data out of range %d <= %d <= %d." % (
+                    if not isinstance(data, numbers.Integral) or not self.min <= data <= self.max:
+                        raise ValueError("Vote data out of range %d <= %s <= %d." % (
                             self.min, data, self.max))
-                    if not vote:
-                        vote = Vote(user=user, voteset=self, data=data)
-                        db.session.add(vote)
-                        if self.id is not None:
-                            self.count = select([self.__table__.c.count]).where(
-                                self.__table__.c.id == self.id).as_scalar() + 1
-                            self.score = select([self.__table__.c.score]).where(
-                                self.__table__.c.id == self.id).as_scalar() + data
-                        else:
-                            self.count = 1
-                            self.score = data
-                    else:
-                        if data != vote.data:
-                            self.score = select([self.__table__.c.score]).where(
-                                self.__table__.c.id == self.id).as_scalar() - vote.data + data
-                            vote.data = data
                 elif self.pattern == VOTE_PATTERN.CUSTOM:
-                    if not vote:
-                        vote = Vote(user=user, voteset=self, data=data)
-                        self.db.session.add(vote)
-                        if self.id is not None:
-                            self.count = select([self.__table__.c.count]).where(
-                                self.__table__.c.id == self.id).as_scalar() + 1
-                        else:
-                            self.count = 1
-                    else:
-                        vote.data = data
-                    # We don't know how to calculate score for custom votes. Return vote
-                    # and let the caller manage the score.
+                    # Apps define the meaning, but the value is stored in an integer column
+                    if data is not None and not isinstance(data, numbers.Integral):
+                        raise ValueError("Invalid vote data: %r." % (data,))
                 else:
                     # This shouldn't happen. This VoteSet has an invalid pattern type.
                     raise ValueError("Unknown voting pattern.")
+
+            def vote(self, user, data=None):
+                with commentease.measure('vote') as operation:
+                    self.validate(data)
+                    # A new voteset has no votes to look up
+                    vote = self.getvote(user) if self.id is not None else None
+                    if self.pattern == VOTE_PATTERN.UP_ONLY:
+                        if not vote:
+                            vote = Vote(user=user, voteset=self)
+                            db.session.add(vote)
+                            self._adjust(1, 1)
+                    elif self.pattern == VOTE_PATTERN.UP_DOWN:
+                        if not vote:
+                            vote = Vote(user=user, voteset=self, data=data)
+                            db.session.add(vote)
+                            self._adjust(1, data)
+                        elif data != vote.data:
+                            # Flipped vote. Undo the old vote and apply the new one
+                            vote.data = data
+                            self._adjust(0, data * 2)
+                    elif self.pattern == VOTE_PATTERN.RANGE:
+                        if not vote:
+                            vote = Vote(user=user, voteset=self, data=data)
+                            db.session.add(vote)
+                            self._adjust(1, data)
+                        elif data != vote.data:
+                            self._adjust(0, data - vote.data)
+                            vote.data = data
+                    elif self.pattern == VOTE_PATTERN.CUSTOM:
+                        if not vote:
+                            vote = Vote(user=user, voteset=self, data=data)
+                            db.session.add(vote)
+                            self._adjust(1)
+                        else:
+                            vote.data = data
+                        # We don't know how to calculate score for custom votes. Return vote
+                        # and let the caller manage the score.
+                commentease._send(vote_cast, voteset=self, vote=vote, operation=operation)
                 return vote
 
             def cancelvote(self, user):
-                vote = self.getvote(user)
+                with commentease.measure('cancelvote') as operation:
+                    vote = self.getvote(user)
+                    if vote:
+                        if self.pattern == VOTE_PATTERN.UP_ONLY:
+                            self._adjust(-1, -1)
+                        elif self.pattern in (VOTE_PATTERN.UP_DOWN, VOTE_PATTERN.RANGE):
+                            self._adjust(-1, -vote.data)
+                        elif self.pattern == VOTE_PATTERN.CUSTOM:
+                            self._adjust(-1)  # App maintains score.
+                        else:
+                            # This shouldn't happen. This VoteSet has an invalid pattern type.
+                            raise ValueError("Unknown voting pattern.")
+                        db.session.delete(vote)
                 if vote:
-                    self.count = self.__table__.c.count - 1
-                    if self.pattern == VOTE_PATTERN.UP_ONLY:
-                        self.score = self.__table__.c.score - 1
-                    elif self.pattern in (VOTE_PATTERN.UP_DOWN, VOTE_PATTERN.RANGE):
-                        self.score = self.__table__.c.score - vote.data
-                    elif self.pattern == VOTE_PATTERN.CUSTOM:
-                        pass  # Do nothing. App maintains score.
-                    else:
-                        # This shouldn't happen. This VoteSet has an invalid pattern type.
-                        raise ValueError("Unknown voting pattern.")
-                    db.session.delete(vote)
+                    commentease._send(vote_cancelled, voteset=self, user=user, operation=operation)
 
             def recount(self):
-                self.count = len(self.votes)
-                if self.pattern != VOTE_PATTERN.CUSTOM:
-                    self.score = sum([v.data for v in self.votes])
+                with commentease.measure('recount'), commentease._counting_votes():
+                    count, score = db.session.query(func.count(Vote.user_id),
+                        func.coalesce(func.sum(Vote.data), 0)).filter(Vote.voteset_id == self.id).one()
+                    if commentease.votebuffer is not None:
+                        # Buffered deltas are already reflected in the vote rows
+                        commentease.votebuffer.discard(db.session(), self.id)
+                    self.count = count
+                    if self.pattern == VOTE_PATTERN.UP_ONLY:
+                        self.score = count
+                    elif self.pattern != VOTE_PATTERN.CUSTOM:
+                        self.score = score
+                    if self.pattern == VOTE_PATTERN.RANGE and self.id is not None:
+                        VoteBucket.rebuild([self.id])
+
+            @classmethod
+            def repair(cls, ids=None, fix=True):
+                """
+                Find votesets whose stored count or score differs from their votes, and
+                correct them unless ``fix`` is False. Checks all votesets, or those with
+                the given ids (a list or a select of ids). Counting and comparison are done
+                in SQL, so this takes a few statements however many votesets there are.
+                Returns a list of ``(id, (count, score), (actual_count, actual_score))``.
+                The caller is responsible for committing.
+                """
+                vote_table = Vote.__table__
+                voteset_table = cls.__table__
+                actual = select([vote_table.c.voteset_id, func.count().label('count'),
+                    func.sum(vote_table.c.data).label('score')]).group_by(vote_table.c.voteset_id)
+                if ids is not None:
+                    actual = actual.where(vote_table.c.voteset_id.in_(ids))
+                actual = actual.alias('actual')
+                actual_count = func.coalesce(actual.c.count, 0)
+                actual_score = case([(voteset_table.c.pattern == VOTE_PATTERN.UP_ONLY, actual_count),
+                    (voteset_table.c.pattern == VOTE_PATTERN.CUSTOM, voteset_table.c.score)],
+                    else_=func.coalesce(actual.c.score, 0))
+                query = select([voteset_table.c.id, voteset_table.c.count, voteset_table.c.score,
+                    actual_count, actual_score]).select_from(voteset_table.outerjoin(
+                    actual, actual.c.voteset_id == voteset_table.c.id)).where(or_(
+                    voteset_table.c.count != actual_count, voteset_table.c.score != actual_score))
+                if ids is not None:
+                    query = query.where(voteset_table.c.id.in_(ids))
+                db.session.flush()
+                with commentease._counting_votes():
+                    drift = [(row[0], (row[1], row[2]), (row[3], row[4]))
+                        for row in db.session.execute(query)]
+                    if fix and commentease.votebuffer is not None:
+                        for voteset_id, stored, actual in drift:
+                            commentease.votebuffer.discard(db.session(), voteset_id)
+                if fix and drift:
+                    db.session.execute(voteset_table.update().where(
+                        voteset_table.c.id == bindparam('_id')).values(
+                        count=bindparam('_count'), score=bindparam('_score')),
+                        [{'_id': voteset_id, '_count': count, '_score': score}
+                            for voteset_id, stored, (count, score) in drift])
+                    voteset_ids = [voteset_id for voteset_id, stored, actual in drift]
+                    VoteBucket.rebuild(voteset_ids)
+                    commentease._stage_rerank(db.session(), voteset_ids)
+                return drift
 
             def getvote(self, user):
-                return Vote.query.get((user.id, self.id))
+                vote = Vote.query.get((user.id, self.id))
+                if vote is not None:
+                    # Spares a query when the vote's histogram bucket is updated
+                    set_committed_value(vote, 'voteset', self)
+                return vote
+
+            def histogram(self):
+                """
+                Return ``(value, count)`` for each value of a range voteset, lowest first.
+                """
+                return VoteSet.histograms([self.id]).get(self.id, [])
+
+            @classmethod
+            def histograms(cls, votesets):
+                """
+                Return a dictionary of voteset id to histogram (as in :meth:`histogram`)
+                for many votesets, using a single query. ``votesets`` may be a list of
+                votesets or voteset ids, or a select of voteset ids.
+                """
+                if isinstance(votesets, (list, tuple, set)):
+                    votesets = [v.id if isinstance(v, VoteSet) else v for v in votesets]
+                    if not votesets:
+                        return {}
+                bucket_table = VoteBucket.__table__
+                histograms = {}
+                for voteset_id, value, count in db.session.execute(select([bucket_table.c.voteset_id,
+                        bucket_table.c.value, bucket_table.c.count]).where(
+                        bucket_table.c.voteset_id.in_(votesets)).order_by(
+                        bucket_table.c.voteset_id, bucket_table.c.value)):
+                    histograms.setdefault(voteset_id, []).append((value, count))
+                return histograms
+
+            def percentile(self, fraction, histogram=None):
+                """
+                Return the vote value at ``fraction`` (0 to 1) of the way through the
+                votes, by nearest rank, or None without votes. Pass a histogram from
+                :meth:`histograms` to avoid a query.
+                """
+                if histogram is None:
+                    histogram = self.histogram()
+                total = sum(count for value, count in histogram)
+                if not total:
+                    return None
+                rank = max(int(math.ceil(fraction * total)), 1)
+                seen = 0
+                for value, count in histogram:
+                    seen += count
+                    if seen >= rank:
+                        return value
+
+            def median(self, histogram=None):
+                return self.percentile(0.5, histogram)
+
+            @classmethod
+            def getvotes(cls, user, votesets, session=None):
+                """
+                Return a dictionary of voteset id to this user's vote, for every voteset in
+                ``votesets`` that the user has voted in, using a single query. ``votesets``
+                may be a list of votesets or voteset ids, or a select of voteset ids.
+                Queries ``session`` if given (see :meth:`Commentease.reader`).
+                """
+                if user is None:
+                    return {}
+                if isinstance(votesets, (list, tuple, set)):
+                    votesets = [v.id if isinstance(v, VoteSet) else v for v in votesets]
+                    if not votesets:
+                        return {}
+                if session is None:
+                    session = db.session
+                return dict((vote.voteset_id, vote) for vote in session.query(Vote).filter(
+                    Vote.user_id == user.id, Vote.voteset_id.in_(votesets)))
 
         class Comment(BaseScopedIdMixin, db.Model):
             __tablename__ = 'comment'
@@ -304,7 +919,7 @@ class Commentease(object):
                 backref=db.backref('comments', cascade="all, delete-orphan"))
             parent = db.synonym('commentset')
 
-            # TODO: Remove this and use CommentTree.
+            #: Comment this is a reply to. CommentTree has the full ancestry
             reply_to_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
             replies = db.relationship('Comment', backref=db.backref("reply_to", remote_side='Comment.id'))
 
@@ -312,16 +927,38 @@ class Commentease(object):
             _message = db.Column('message', db.UnicodeText, nullable=False)
             _message_html = db.Column('message_html', db.UnicodeText, nullable=False)
 
-            status = db.Column(db.SmallInteger, default=0, nullable=False)
+            status = db.Column(db.SmallInteger, default=COMMENT_STATUS.PUBLIC, nullable=False)
 
             votes_id = db.Column(db.Integer, db.ForeignKey('voteset.id'), nullable=False)
             votes = db.relationship(VoteSet, uselist=False)
 
             edited_at = db.Column(db.DateTime, nullable=True)
 
+            #: Rank for ordering, maintained from votes by the commentset's ranking function
+            rank = db.Column(db.Float, default=0.0, nullable=False)
+
+            #: Number of direct replies, including those hidden by moderation
+            reply_count = db.Column(db.Integer, default=0, nullable=False)
+            #: Number of comments above this one; zero for top-level comments
+            depth = db.Column(db.SmallInteger, default=0, nullable=False)
+            #: Id of the top-level comment of this branch (this comment's own id if top-level)
+            root_id = db.Column(db.Integer, nullable=True, index=True)
+            #: Materialized path: the ids of this comment's ancestors and itself, as
+            #: 16-digit hex. A subtree is the range of paths starting with its root's.
+            #: Unbounded, but PostgreSQL can't index paths of more than about 2700 bytes,
+            #: so threads there are limited to about 160 levels
+            path = db.Column(db.UnicodeText, default=u'', nullable=False)
+
+            __table_args__ = (db.Index('ix_comment_commentset_id_reply_to_id_rank',
+                'commentset_id', 'reply_to_id', 'rank'), db.Index('ix_comment_path', 'path'))
+
             def __init__(self, votepattern=VOTE_PATTERN.UP_DOWN, **kwargs):
+                # Cook the message after the parser has been set
+                message = kwargs.pop('message', None)
                 super(Comment, self).__init__(**kwargs)
                 self.votes = VoteSet(type=u'CMNT', pattern=votepattern)
+                if message is not None:
+                    self.message = message
 
             @property
             def message(self):
@@ -330,7 +967,17 @@ class Commentease(object):
             @message.setter
             def message(self, value):
                 self._message = value
-                self._message_html = markdown(value)
+                if self.status == COMMENT_STATUS.SCREENED and commentease.pipeline is not None:
+                    # Cooked by the pipeline
+                    self._message_html = u''
+                else:
+                    self.cook()
+
+            def cook(self):
+                """
+                Render :attr:`message_html` from the message with the comment's parser.
+                """
+                self._message_html = commentease.cook(self.parser or u'markdown', self._message)
 
             @synonym_for("_message_html")
             @property
@@ -341,26 +988,155 @@ class Commentease(object):
                 """
                 Delete this comment.
                 """
-                if len(self.replies) > 0:
-                    self.status = COMMENT_STATUS.DELETED
-                    self.user = None
-                    self.message = ''
-                else:
-                    if self.reply_to and self.reply_to.is_deleted:
-                        # If the parent (reply_to) is deleted, ask it to reconsider removing itself
-                        reply_to = self.reply_to
-                        reply_to.replies.remove(self)
-                        db.session.delete(self)
-                        reply_to.delete()
+                with commentease.measure('delete'):
+                    self.commentset.touch()
+                    if self.reply_count:
+                        self.status = COMMENT_STATUS.DELETED
+                        self.user = None
+                        self.message = ''
                     else:
-                        db.session.delete(self)
+                        # Remove this comment, then any deleted ancestors it was the last reply to
+                        comment = self
+                        while comment is not None:
+                            reply_to = comment.reply_to
+                            db.session.delete(comment)
+                            if reply_to is not None and reply_to.is_deleted and reply_to.reply_count <= 1:
+                                comment = reply_to
+                            else:
+                                comment = None
 
             @property
             def is_deleted(self):
                 return self.status == COMMENT_STATUS.DELETED
 
             def sorted_replies(self):
-                return sorted(self.replies, key=lambda reply: reply.votes.count)
+                # Same order as CommentSet.page, so that cursors from shown replies work
+                return sorted(self.replies, key=lambda reply: (reply.rank, reply.id), reverse=True)
+
+            def shown_replies(self, limit=None):
+                """
+                Replies to render under this comment: the first ``limit`` of them, or none
+                if they were not loaded (see :meth:`load_branches`). Never loads replies.
+                """
+                if 'replies' in instance_state(self).unloaded:
+                    return []
+                return self.sorted_replies()[:limit]
+
+            def more_replies(self, limit=None):
+                """
+                Number of listed replies to this comment not included in
+                :meth:`shown_replies`. Replies that are screened, hidden or spam are
+                not counted.
+                """
+                if 'replies' in instance_state(self).unloaded:
+                    if not self.reply_count:
+                        return 0
+                    listed = getattr(self, '_listed_replies', None)
+                    if listed is None:
+                        listed = Comment.count_listed_replies([self],
+                            object_session(self))[0]._listed_replies
+                    return listed
+                if limit is None:
+                    return 0
+                return max(len(self.replies) - limit, 0)
+
+            @classmethod
+            def count_listed_replies(cls, comments, session=None):
+                """
+                Count the listed replies of those comments whose replies were not
+                loaded, in a single query, for :meth:`more_replies`. Returns the comments.
+                """
+                pending = [comment for comment in comments
+                    if comment.reply_count and 'replies' in instance_state(comment).unloaded]
+                if not pending:
+                    return comments
+                if session is None:
+                    session = db.session
+                counts = dict(session.query(Comment.reply_to_id, func.count(Comment.id)).filter(
+                    Comment.reply_to_id.in_([comment.id for comment in pending]),
+                    ~Comment.status.in_(COMMENT_STATUS.UNLISTED)).group_by(Comment.reply_to_id))
+                for comment in pending:
+                    comment._listed_replies = counts.get(comment.id, 0)
+                return comments
+
+            def cursor(self, order='rank'):
+                """
+                Cursor for the page after this comment. See :meth:`CommentSet.page`.
+                """
+                return _encode_cursor(order, self)
+
+            @classmethod
+            def load_branches(cls, comments, depth, session=None):
+                """
+                Load replies to the given comments, up to ``depth`` levels below them, in
+                a single query on the comment tree. Comments at the last level are left
+                with their replies unloaded, and their listed replies are counted with
+                :meth:`count_listed_replies` for "more replies" links.
+                """
+                if not comments:
+                    return comments
+                if session is None:
+                    session = db.session
+                rows = session.query(Comment, CommentTree.depth).join(
+                    CommentTree, CommentTree.child_id == Comment.id).filter(
+                    CommentTree.parent_id.in_([comment.id for comment in comments]),
+                    CommentTree.depth <= depth, ~Comment.status.in_(COMMENT_STATUS.UNLISTED)).options(
+                    joinedload(Comment.votes), joinedload(Comment.user)).all()
+                _populate_replies([comment for comment, level in rows],
+                    [comment for comment, level in rows if level < depth])
+                Comment.count_listed_replies([comment for comment, level in rows if level >= depth],
+                    session)
+                return comments
+
+            def subtree(self, max_depth=None):
+                """
+                Load all replies to this comment, up to ``max_depth`` levels below it,
+                with one range scan on :attr:`path`. Returns this comment, with
+                :attr:`replies` populated on every loaded comment.
+                """
+                # Hex digits sort before 'g', so this range covers every path below this one
+                query = Comment.query.filter(Comment.path >= self.path, Comment.path < self.path + u'g',
+                    or_(Comment.id == self.id, ~Comment.status.in_(COMMENT_STATUS.UNLISTED))).options(
+                    joinedload(Comment.votes), joinedload(Comment.user))
+                if max_depth is not None:
+                    query = query.filter(Comment.depth <= self.depth + max_depth)
+                comments = query.order_by(Comment.path).all()
+                _populate_replies(comments, [comment for comment in comments
+                    if max_depth is None or comment.depth < self.depth + max_depth])
+                if max_depth is not None:
+                    Comment.count_listed_replies([comment for comment in comments
+                        if comment.depth >= self.depth + max_depth])
+                return self
+
+            @classmethod
+            def rebuild(cls, commentset_ids):
+                """
+                Recalculate :attr:`reply_count`, :attr:`depth`, :attr:`root_id` and
+                :attr:`path` for all comments in the given comment sets (a list or a
+                select of ids), such as after an import or when upgrading.
+                """
+                comment_table = cls.__table__
+                rows = db.session.execute(select([comment_table.c.id, comment_table.c.reply_to_id]).where(
+                    comment_table.c.commentset_id.in_(commentset_ids))).fetchall()
+                replies = dict((comment_id, []) for comment_id, reply_to_id in rows)
+                for comment_id, reply_to_id in rows:
+                    if reply_to_id is not None:
+                        replies[reply_to_id].append(comment_id)
+                values = []
+                stack = [(comment_id, comment_id, 0, _path_segment(comment_id))
+                    for comment_id, reply_to_id in rows if reply_to_id is None]
+                while stack:
+                    comment_id, root_id, depth, path = stack.pop()
+                    values.append({'_id': comment_id, '_reply_count': len(replies[comment_id]),
+                        '_depth': depth, '_root_id': root_id, '_path': path})
+                    stack.extend((reply_id, root_id, depth + 1, path + _path_segment(reply_id))
+                        for reply_id in replies[comment_id])
+                if values:
+                    db.session.execute(comment_table.update().where(
+                        comment_table.c.id == bindparam('_id')).values(
+                        reply_count=bindparam('_reply_count'), depth=bindparam('_depth'),
+                        root_id=bindparam('_root_id'), path=bindparam('_path'),
+                        updated_at=comment_table.c.updated_at), values)
 
         class CommentSet(BaseMixin, db.Model):
             __tablename__ = 'commentset'
@@ -374,29 +1150,187 @@ class Commentease(object):
             count_replies = db.Column(db.Integer, default=0, nullable=False)
             #: Is downvoting a comment allowed? (selects voting pattern)
             downvoting = db.Column(db.Boolean, nullable=False, default=True)
+            #: Version number, bumped whenever rendered copies of the thread go stale
+            version = db.Column(db.Integer, default=0, nullable=False)
+            #: Ranking function for comments, from Commentease.rankers
+            ranking = db.Column(db.Unicode(10), default=u'score', nullable=False)
 
             def __init__(self, **kwargs):
                 super(CommentSet, self).__init__(**kwargs)
                 self.count = self.count_toplevel = self.count_replies = 0
+                self.version = 0
+
+            def touch(self):
+                """
+                Bump the version number, invalidating cached renderings of this thread.
+                """
+                if self.id is not None:
+                    self.version = self.__table__.c.version + 1
 
             def recount(self):
-                toplevel = replies = 0
-                for comment in self.comments:
-                    if comment.status == COMMENT_STATUS.PUBLIC:
-                        if comment.reply_to is None:
-                            toplevel += 1
-                        else:
-                            replies += 1
+                with commentease.measure('recount'):
+                    toplevel, replies = db.session.query(
+                        func.coalesce(func.sum(case([(Comment.reply_to_id == None, 1)], else_=0)), 0),
+                        func.coalesce(func.sum(case([(Comment.reply_to_id != None, 1)], else_=0)), 0)
+                        ).filter(Comment.commentset_id == self.id,
+                            Comment.status == COMMENT_STATUS.PUBLIC).one()
+
+                    self.count_toplevel = toplevel
+                    self.count_replies = replies
+                    self.count = toplevel + replies
+
+            @classmethod
+            def repair(cls, ids=None, fix=True):
+                """
+                Find comment sets whose stored counts differ from their public comments,
+                and correct them unless ``fix`` is False. Checks all comment sets, or those
+                with the given ids (a list or a select of ids). Counting and comparison are
+                done in SQL. Returns a list of ``(id, (count, count_toplevel, count_replies),
+                (actual_count, actual_toplevel, actual_replies))``. The caller is
+                responsible for committing.
+                """
+                comment_table = Comment.__table__
+                commentset_table = cls.__table__
+                actual = select([comment_table.c.commentset_id,
+                    func.sum(case([(comment_table.c.reply_to_id == None, 1)], else_=0)).label('toplevel'),
+                    func.sum(case([(comment_table.c.reply_to_id != None, 1)], else_=0)).label('replies')
+                    ]).where(comment_table.c.status == COMMENT_STATUS.PUBLIC).group_by(
+                    comment_table.c.commentset_id)
+                if ids is not None:
+                    actual = actual.where(comment_table.c.commentset_id.in_(ids))
+                actual = actual.alias('actual')
+                actual_toplevel = func.coalesce(actual.c.toplevel, 0)
+                actual_replies = func.coalesce(actual.c.replies, 0)
+                query = select([commentset_table.c.id, commentset_table.c.count,
+                    commentset_table.c.count_toplevel, commentset_table.c.count_replies,
+                    actual_toplevel, actual_replies]).select_from(commentset_table.outerjoin(
+                    actual, actual.c.commentset_id == commentset_table.c.id)).where(or_(
+                    commentset_table.c.count != actual_toplevel + actual_replies,
+                    commentset_table.c.count_toplevel != actual_toplevel,
+                    commentset_table.c.count_replies != actual_replies))
+                if ids is not None:
+                    query = query.where(commentset_table.c.id.in_(ids))
+                db.session.flush()
+                drift = [(row[0], (row[1], row[2], row[3]), (row[4] + row[5], row[4], row[5]))
+                    for row in db.session.execute(query)]
+                if fix and drift:
+                    db.session.execute(commentset_table.update().where(
+                        commentset_table.c.id == bindparam('_id')).values(
+                        count=bindparam('_count'), count_toplevel=bindparam('_toplevel'),
+                        count_replies=bindparam('_replies')),
+                        [{'_id': commentset_id, '_count': count, '_toplevel': toplevel, '_replies': replies}
+                            for commentset_id, stored, (count, toplevel, replies) in drift])
+                return drift
+
+            def getvotes(self, user, session=None):
+                """
+                Return a dictionary of voteset id to this user's vote for every comment in
+                this set, using a single query.
+                """
+                return VoteSet.getvotes(user, select([Comment.__table__.c.votes_id]).where(
+                    Comment.__table__.c.commentset_id == self.id), session)
 
-                self.count_toplevel = toplevel
-                self.count_replies = replies
-                self.count = toplevel + replies
+            def page(self, after=None, limit=20, order='rank', reply_to=None, depth=0, session=None):
+                """
+                Return a page of top-level comments (or replies to ``reply_to``) and a
+                cursor for the next page, which is None on the last page. ``order`` is
+                ``'rank'`` (highest first) or ``'created_at'`` (oldest first). Pages are
+                selected with a keyset on the order and comment id, so they stay stable
+                as comments are added. Replies are loaded ``depth`` levels deep. Pages
+                have at least one comment.
+                """
+                if session is None:
+                    session = db.session
+                limit = max(limit, 1)
+                query = session.query(Comment).filter(Comment.commentset_id == self.id,
+                    Comment.reply_to_id == (reply_to.id if reply_to is not None else None),
+                    ~Comment.status.in_(COMMENT_STATUS.UNLISTED))
+                if order == 'rank':
+                    key, descending = Comment.rank, True
+                elif order == 'created_at':
+                    key, descending = Comment.created_at, False
+                else:
+                    raise ValueError("Unknown comment order: %s." % order)
+                if after is not None:
+                    value, comment_id = _decode_cursor(order, after)
+                    if descending:
+                        query = query.filter(or_(key < value, and_(key == value, Comment.id < comment_id)))
+                    else:
+                        query = query.filter(or_(key > value, and_(key == value, Comment.id > comment_id)))
+                if descending:
+                    query = query.order_by(key.desc(), Comment.id.desc())
+                else:
+                    query = query.order_by(key, Comment.id)
+                comments = query.options(joinedload(Comment.votes), joinedload(Comment.user)).limit(
+                    limit + 1).all()
+                cursor = None
+                if len(comments) > limit:
+                    comments = comments[:limit]
+                    cursor = comments[-1].cursor(order)
+                Comment.load_branches(comments, depth, session)
+                return comments, cursor
+
+            def thread(self, session=None):
+                """
+                Return top-level comments in this set, with all replies loaded in
+                a single query.
+                """
+                if session is None:
+                    session = db.session
+                comments = session.query(Comment).filter(Comment.commentset_id == self.id,
+                    ~Comment.status.in_(COMMENT_STATUS.UNLISTED)).options(
+                    joinedload(Comment.votes), joinedload(Comment.user)).order_by(
+                    Comment.rank.desc(), Comment.id.desc()).all()
+                _populate_replies(comments, comments)
+                return [comment for comment in comments if comment.reply_to_id is None]
+
+            def nodes(self, session=None):
+                """
+                Return top-level comments in this set as :class:`ThreadNode` trees, read
+                as plain rows in a single query. Much lighter than :meth:`thread` for
+                display, but the nodes are not ORM objects and can't be changed.
+                """
+                if session is None:
+                    session = db.session
+                comment_table = Comment.__table__
+                voteset_table = VoteSet.__table__
+                user_table = Comment.user.property.mapper.local_table
+                rows = session.execute(select([comment_table.c.id, comment_table.c.reply_to_id,
+                    comment_table.c.user_id, user_table.c.fullname, comment_table.c.status,
+                    comment_table.c.created_at, comment_table.c.edited_at, comment_table.c.rank,
+                    comment_table.c.reply_count, comment_table.c.depth, comment_table.c.votes_id,
+                    voteset_table.c.count, voteset_table.c.score, comment_table.c.message_html]
+                    ).select_from(comment_table.join(voteset_table,
+                        comment_table.c.votes_id == voteset_table.c.id).outerjoin(user_table,
+                        comment_table.c.user_id == user_table.c.id)).where(and_(
+                    comment_table.c.commentset_id == self.id,
+                    ~comment_table.c.status.in_(COMMENT_STATUS.UNLISTED))).order_by(
+                    comment_table.c.rank.desc(), comment_table.c.id.desc()))
+                roots = []
+                nodes = {}
+                orphans = {}
+                # Rows are in display order, so appending keeps every reply list sorted
+                for (comment_id, reply_to_id, user_id, fullname, status, created_at, edited_at, rank,
+                        reply_count, depth, votes_id, count, score, message_html) in rows:
+                    node = ThreadNode(comment_id, reply_to_id,
+                        NodeUser(user_id, fullname) if user_id is not None else None, status,
+                        created_at, edited_at, rank, reply_count, depth, votes_id,
+                        NodeVotes(count, score), message_html)
+                    nodes[comment_id] = node
+                    node.replies = orphans.pop(comment_id, [])
+                    if reply_to_id is None:
+                        roots.append(node)
+                    elif reply_to_id in nodes:
+                        nodes[reply_to_id].replies.append(node)
+                    else:
+                        orphans.setdefault(reply_to_id, []).append(node)
+                return roots
 
-        # TODO: Use this
         class CommentTree(TimestampMixin, db.Model):
             """
             The comment tree implements a closure set structure to help navigate up and down
-            a hierarchical comment thread.
+            a hierarchical comment thread. Rows are inserted along with each comment and
+            removed with it via the ``parenttree`` and ``childtree`` cascades.
             """
             __tablename__ = 'comment_tree'
             #: Parent comment id
@@ -412,28 +1346,1148 @@ class Commentease(object):
             #: Distance from parent to child in the hierarchy
             depth = db.Column(db.SmallInteger, nullable=False)
 
+            @classmethod
+            def rebuild(cls, commentset_ids):
+                """
+                Rebuild the tree for all comments in the given comment sets (a list or a
+                select of ids), with one INSERT per level of depth.
+                """
+                tree_table = cls.__table__
+                comment_table = Comment.__table__
+                columns = ['created_at', 'updated_at', 'parent_id', 'child_id', 'depth']
+                in_sets = comment_table.c.commentset_id.in_(commentset_ids)
+                now = datetime.utcnow()
+                db.session.execute(tree_table.delete().where(
+                    tree_table.c.child_id.in_(select([comment_table.c.id]).where(in_sets))))
+                # Labelled, or the select would collapse the repeated id column into one
+                db.session.execute(tree_table.insert().from_select(columns, select([
+                    literal(now), literal(now), comment_table.c.id.label('parent_id'),
+                    comment_table.c.id.label('child_id'), literal(0)]).where(in_sets)))
+                depth = 0
+                while True:
+                    depth += 1
+                    result = db.session.execute(tree_table.insert().from_select(columns, select([
+                        literal(now), literal(now), tree_table.c.parent_id, comment_table.c.id,
+                        literal(depth)]).select_from(comment_table.join(tree_table,
+                        tree_table.c.child_id == comment_table.c.reply_to_id)).where(
+                        and_(in_sets, tree_table.c.depth == depth - 1))))
+                    if not result.rowcount:
+                        break
+
+        @event.listens_for(Comment, 'after_insert')
+        def _comment_tree_insert(mapper, connection, target):
+            # Link the new comment to itself and to every ancestor of the comment
+            # it replies to. The unit of work inserts parents before their replies,
+            # so the parent's rows are already present when a reply is inserted.
+            tree = CommentTree.__table__
+            now = datetime.utcnow()
+            connection.execute(tree.insert().values(created_at=now, updated_at=now,
+                parent_id=target.id, child_id=target.id, depth=0))
+            if target.reply_to_id is not None:
+                connection.execute(tree.insert().from_select(
+                    ['created_at', 'updated_at', 'parent_id', 'child_id', 'depth'],
+                    select([literal(now), literal(now), tree.c.parent_id, literal(target.id),
+                        tree.c.depth + 1]).where(tree.c.child_id == target.reply_to_id)))
+
+        def _adjust_reply_count(connection, target, change):
+            # Count in SQL to be safe from concurrent replies, and keep a loaded parent
+            # in step. Replies coming and going are not edits, so updated_at is preserved
+            comment_table = Comment.__table__
+            connection.execute(comment_table.update().where(comment_table.c.id == target.reply_to_id).values(
+                reply_count=comment_table.c.reply_count + change, updated_at=comment_table.c.updated_at))
+            parent = target.__dict__.get('reply_to')
+            if parent is not None and 'reply_count' in parent.__dict__:
+                set_committed_value(parent, 'reply_count', parent.reply_count + change)
+
+        @event.listens_for(Comment, 'after_insert')
+        def _comment_path_insert(mapper, connection, target):
+            # Place the new comment under its parent. The path includes the new id,
+            # so it's written after the insert
+            comment_table = Comment.__table__
+            path = _path_segment(target.id)
+            depth = 0
+            root_id = target.id
+            if target.reply_to_id is not None:
+                parent_path, parent_depth, root_id = connection.execute(select([comment_table.c.path,
+                    comment_table.c.depth, comment_table.c.root_id]).where(
+                    comment_table.c.id == target.reply_to_id)).first()
+                path = parent_path + path
+                depth = parent_depth + 1
+                _adjust_reply_count(connection, target, +1)
+            connection.execute(comment_table.update().where(comment_table.c.id == target.id).values(
+                path=path, depth=depth, root_id=root_id))
+            set_committed_value(target, 'path', path)
+            set_committed_value(target, 'depth', depth)
+            set_committed_value(target, 'root_id', root_id)
+
+        @event.listens_for(Comment, 'after_delete')
+        def _comment_path_delete(mapper, connection, target):
+            if target.reply_to_id is not None:
+                _adjust_reply_count(connection, target, -1)
+
+        @event.listens_for(Comment, 'before_update')
+        def _comment_reply_to_update(mapper, connection, target):
+            # The tree columns and closure rows are written once, on insert
+            if get_history(target, 'reply_to_id').has_changes():
+                raise ValueError("A comment can't be moved to another parent once saved.")
+
+        @event.listens_for(Comment, 'expire')
+        def _comment_listed_replies_expire(target, attrs):
+            # Counted with the replies, so it goes stale with them. The target is None
+            # if the instance was garbage collected with changes pending
+            if target is not None and (attrs is None or 'replies' in attrs):
+                target.__dict__.pop('_listed_replies', None)
+
+        @event.listens_for(Comment.__table__, 'after_create')
+        def _search_index_create(target, connection, **kw):
+            self._create_search_index(connection)
+
+        @event.listens_for(Comment.__table__, 'before_drop')
+        def _search_index_drop(target, connection, **kw):
+            if connection.dialect.name == 'sqlite':
+                connection.execute("DROP TABLE IF EXISTS comment_fts")
+            self._search_backends.pop(connection.engine, None)
+
+        @event.listens_for(Comment, 'after_insert')
+        def _search_insert(mapper, connection, target):
+            if target._message and self._search_backend(connection) == 'fts5':
+                connection.execute(_comment_fts.insert().values(rowid=target.id, message=target._message))
+
+        @event.listens_for(Comment, 'after_update')
+        def _search_update(mapper, connection, target):
+            if get_history(target, '_message').has_changes() and self._search_backend(connection) == 'fts5':
+                self._unindex_comments(connection, [target.id])
+                if target._message:
+                    connection.execute(_comment_fts.insert().values(rowid=target.id, message=target._message))
+
+        @event.listens_for(Comment, 'after_delete')
+        def _search_delete(mapper, connection, target):
+            self._unindex_comments(connection, [target.id])
+
+        @event.listens_for(Comment, 'before_insert')
+        def _comment_rank_insert(mapper, connection, target):
+            # A new comment has a new voteset, so its count and score are plain values
+            target.rank = self.rankers[target.commentset.ranking or u'score'](
+                target.votes.count, target.votes.score, target.created_at or datetime.utcnow())
+
+        @event.listens_for(VoteSet, 'after_insert')
+        def _voteset_buckets_insert(mapper, connection, target):
+            if target.pattern == VOTE_PATTERN.RANGE and target.min is not None and target.max is not None:
+                connection.execute(VoteBucket.__table__.insert(), [{'voteset_id': target.id,
+                    'value': value, 'count': 0} for value in range(target.min, target.max + 1)])
+
+        def _adjust_bucket(connection, vote, value, change):
+            # Only range votesets have buckets. Skip the statement if the voteset is
+            # loaded and isn't one; otherwise it's harmless and changes no rows
+            voteset = vote.__dict__.get('voteset')
+            if value is None or (voteset is not None and voteset.pattern != VOTE_PATTERN.RANGE):
+                return
+            bucket_table = VoteBucket.__table__
+            connection.execute(bucket_table.update().where(and_(
+                bucket_table.c.voteset_id == vote.voteset_id, bucket_table.c.value == value)).values(
+                count=bucket_table.c.count + change))
+
+        @event.listens_for(Vote, 'after_insert')
+        def _vote_bucket_insert(mapper, connection, target):
+            _adjust_bucket(connection, target, target.data, +1)
+
+        @event.listens_for(Vote, 'after_update')
+        def _vote_bucket_update(mapper, connection, target):
+            history = get_history(target, 'data')
+            if history.deleted and history.added:
+                _adjust_bucket(connection, target, history.deleted[0], -1)
+                _adjust_bucket(connection, target, history.added[0], +1)
+
+        @event.listens_for(Vote, 'after_delete')
+        def _vote_bucket_delete(mapper, connection, target):
+            _adjust_bucket(connection, target, target.data, -1)
+
+        @event.listens_for(VoteSet, 'after_update')
+        def _comment_rank_update(mapper, connection, target):
+            if target.type == u'CMNT':
+                self._stage_rerank(object_session(target), [target.id])
+
+        @event.listens_for(Session, 'before_commit')
+        def _votebuffer_prepare(session):
+            if self.votebuffer is not None:
+                self.votebuffer.prepare(session)
+
+        @event.listens_for(Session, 'after_commit')
+        def _votebuffer_commit(session):
+            if self.votebuffer is not None:
+                self.votebuffer.commit(session)
+                self.votebuffer.start()
+                if self.votebuffer.due():
+                    self.flush_votes()
+
+        @event.listens_for(Session, 'after_rollback')
+        def _votebuffer_rollback(session):
+            if self.votebuffer is not None:
+                self.votebuffer.rollback(session)
+
+        @event.listens_for(Session, 'after_transaction_end')
+        def _votebuffer_release(session, transaction):
+            # A commit that failed in the database is neither committed nor rolled back
+            # until the session is. Closing it must not leave the buffer held
+            if self.votebuffer is not None and session.transaction is None:
+                self.votebuffer.release(session)
+
+        @event.listens_for(Session, 'after_commit')
+        def _rerank_commit(session):
+            voteset_ids = self._staged_reranks.pop(session, None)
+            if voteset_ids:
+                # The votes are committed by now, so a failure here must not reach the
+                # caller. Ranks stay stale until the comments are voted on again
+                try:
+                    self._publish_votes(self._rerank_committed(session, list(voteset_ids)))
+                except Exception:
+                    logger.exception("Failed to rerank comments for %d votesets", len(voteset_ids))
+
+        @event.listens_for(Session, 'after_rollback')
+        def _rerank_rollback(session):
+            self._staged_reranks.pop(session, None)
+
+        @event.listens_for(Session, 'after_commit')
+        def _events_commit(session):
+            for channel, message in self._staged_events.pop(session, ()):
+                self.pubsub.publish(channel, message)
+
+        @event.listens_for(Session, 'after_rollback')
+        def _events_rollback(session):
+            self._staged_events.pop(session, None)
+
         self.Vote = Vote
+        self.VoteBucket = VoteBucket
         self.VoteSet = VoteSet
         self.Comment = Comment
         self.CommentSet = CommentSet
         self.CommentTree = CommentTree
 
+    def flush_votes(self):
+        """
+        Write buffered vote counts to the database. Returns the number of votesets
+        updated. This happens after commits once the buffer is due, every
+        ``COMMENT_VOTE_BUFFER_INTERVAL`` seconds in a background thread and when
+        the process exits.
+        """
+        if self.votebuffer is None:
+            return 0
+        reranked = []
+
+        def rerank(connection, voteset_ids):
+            reranked.extend(self._rerank(connection, voteset_ids))
+        updated = self.votebuffer.flush(self.db.engine, self.VoteSet.__table__, rerank)
+        self._publish_votes(reranked)
+        return updated
+
+    @contextmanager
+    def _counting_votes(self):
+        # Hold the vote buffer, if any, while votes are counted. See VoteBuffer.held
+        if self.votebuffer is None:
+            yield
+        else:
+            with self.votebuffer.held():
+                yield
+
+    def _stage_rerank(self, session, voteset_ids):
+        # Comments are reranked after the session commits, keeping the statements out
+        # of the voting transaction. See _rerank_committed
+        self._staged_reranks.setdefault(session, set()).update(voteset_ids)
+
+    def _rerank_committed(self, session, voteset_ids, batch_size=500):
+        # Rerank in a transaction of its own, and expire the old rank of comments
+        # loaded in the session that voted. Returns the rows from _rerank
+        rows = []
+        with self.db.engine.begin() as connection:
+            for start in range(0, len(voteset_ids), batch_size):
+                rows.extend(self._rerank(connection, voteset_ids[start:start + batch_size]))
+        mapper = self.Comment.__mapper__
+        for row in rows:
+            comment = session.identity_map.get(mapper.identity_key_from_primary_key([row[0]]))
+            if comment is not None:
+                session.expire(comment, ['rank'])
+        return rows
+
+    def _rerank(self, connection, voteset_ids):
+        # Update the rank of comments whose votesets are given, using current counts
+        comment_table = self.Comment.__table__
+        voteset_table = self.VoteSet.__table__
+        commentset_table = self.CommentSet.__table__
+        rows = connection.execute(select([comment_table.c.id, comment_table.c.commentset_id,
+            commentset_table.c.ranking, voteset_table.c.count, voteset_table.c.score,
+            comment_table.c.created_at]).select_from(
+            comment_table.join(voteset_table, comment_table.c.votes_id == voteset_table.c.id).join(
+                commentset_table, comment_table.c.commentset_id == commentset_table.c.id)).where(
+            comment_table.c.votes_id.in_(voteset_ids))).fetchall()
+        if rows:
+            # Preserve updated_at. A vote is not an edit
+            connection.execute(comment_table.update().where(
+                comment_table.c.id == bindparam('_id')).values(
+                rank=bindparam('_rank'), updated_at=comment_table.c.updated_at),
+                [{'_id': comment_id, '_rank': self.rankers[ranker or u'score'](count, score, created_at)}
+                    for comment_id, commentset_id, ranker, count, score, created_at in rows])
+            # Votes change what clients polling the thread see, but not the version
+            # that rendered threads are cached under
+            connection.execute(commentset_table.update().where(commentset_table.c.id.in_(
+                set(row[1] for row in rows))).values(updated_at=datetime.utcnow()))
+        return rows
+
+    def publish(self, commentset_id, type, data, session=None):
+        """
+        Push an event to clients following a comment set. With a session, the event
+        is held until the session commits and dropped if it rolls back. Does nothing
+        unless push is enabled.
+        """
+        if self.pubsub is None:
+            return
+        channel = u'commentease/%d' % commentset_id
+        message = json.dumps({'type': type, 'data': data})
+        if session is None:
+            self.pubsub.publish(channel, message)
+        else:
+            self._staged_events.setdefault(session, []).append((channel, message))
+
+    def _publish_votes(self, rows, session=None):
+        # Push the counts in rows from _rerank, in one event per comment set
+        if self.pubsub is None or not rows:
+            return
+        votes = {}
+        for comment_id, commentset_id, ranker, count, score, created_at in rows:
+            votes.setdefault(commentset_id, {})[comment_id] = {'count': count, 'score': score}
+        for commentset_id, data in votes.items():
+            self.publish(commentset_id, 'votes', data, session)
+
+    def rerank(self, commentset=None, batch_size=500):
+        """
+        Recalculate the rank of comments in the given comment set (default: all), such
+        as after changing its ranking function.
+        """
+        comment_table = self.Comment.__table__
+        query = select([comment_table.c.votes_id])
+        if commentset is not None:
+            query = query.where(comment_table.c.commentset_id == commentset.id)
+        connection = self.db.session.connection()
+        voteset_ids = [row[0] for row in connection.execute(query)]
+        for start in range(0, len(voteset_ids), batch_size):
+            self._rerank(connection, voteset_ids[start:start + batch_size])
+        self.db.session.commit()
+
+    def reconcile_votes(self, votesets=None):
+        """
+        Flush the vote buffer and recalculate counts and scores from the votes for
+        the given votesets (default: all). Use this after a crash, when buffered
+        changes may have been lost. Returns the drift found, as in
+        :meth:`VoteSet.repair`.
+        """
+        self.flush_votes()
+        if votesets is None:
+            drift = self.VoteSet.repair()
+        else:
+            drift = self.VoteSet.repair([voteset.id for voteset in votesets])
+        self.db.session.commit()
+        return drift
+
+    def vote_batch(self, items):
+        """
+        Cast many votes at once, such as votes queued by an offline client.
+        ``items`` is an iterable of ``(user, voteset, data)``, with data as for
+        :meth:`VoteSet.vote`. If a user votes more than once in a voteset, the
+        last vote wins. All votes are validated before anything is written.
+
+        Existing votes are fetched in one query, new and changed votes are
+        written with one executemany each, and each voteset's count and score
+        get a single combined update (through the vote buffer if enabled).
+        Returns the number of votes inserted or changed. The caller is
+        responsible for committing.
+        """
+        with self.measure('vote_batch') as operation:
+            session = self.db.session
+            session.flush()  # Assign ids to new votesets and write pending votes
+            wanted = {}
+            for user, voteset, data in items:
+                voteset.validate(data)
+                wanted[(user.id, voteset.id)] = (user, voteset, data)
+            if not wanted:
+                return 0
+
+            vote_table = self.Vote.__table__
+            connection = session.connection()
+            existing = {}
+            wanted_keys = list(wanted)
+            for start in range(0, len(wanted_keys), 500):
+                keys = wanted_keys[start:start + 500]
+                existing.update(((user_id, voteset_id), data) for user_id, voteset_id, data
+                    in connection.execute(select([vote_table.c.user_id, vote_table.c.voteset_id,
+                        vote_table.c.data]).where(and_(
+                        vote_table.c.user_id.in_(set(key[0] for key in keys)),
+                        vote_table.c.voteset_id.in_(set(key[1] for key in keys))))))
+
+            now = datetime.utcnow()
+            inserts = []
+            updates = []
+            deltas = {}
+            buckets = {}
+            votesets = {}
+            cast = []
+            for (user_id, voteset_id), (user, voteset, data) in wanted.items():
+                if voteset.pattern == VOTE_PATTERN.RANGE:
+                    if (user_id, voteset_id) in existing:
+                        old = (voteset_id, existing[(user_id, voteset_id)])
+                        buckets[old] = buckets.get(old, 0) - 1
+                    buckets[(voteset_id, data)] = buckets.get((voteset_id, data), 0) + 1
+                if (user_id, voteset_id) not in existing:
+                    inserts.append({'user_id': user_id, 'voteset_id': voteset_id, 'data': data,
+                        'created_at': now, 'updated_at': now})
+                    count = 1
+                    if voteset.pattern == VOTE_PATTERN.UP_ONLY:
+                        score = 1
+                    elif voteset.pattern == VOTE_PATTERN.CUSTOM:
+                        score = 0  # App maintains score
+                    else:
+                        score = data
+                elif existing[(user_id, voteset_id)] != data:
+                    updates.append({'_user_id': user_id, '_voteset_id': voteset_id, '_data': data})
+                    count = 0
+                    if voteset.pattern in (VOTE_PATTERN.UP_DOWN, VOTE_PATTERN.RANGE):
+                        score = data - existing[(user_id, voteset_id)]
+                    else:
+                        score = 0
+                else:
+                    continue
+                oldcount, oldscore = deltas.get(voteset_id, (0, 0))
+                deltas[voteset_id] = (oldcount + count, oldscore + score)
+                votesets[voteset_id] = voteset
+                cast.append((user, voteset, data))
+
+            if inserts:
+                connection.execute(vote_table.insert(), inserts)
+            if updates:
+                connection.execute(vote_table.update().where(and_(
+                    vote_table.c.user_id == bindparam('_user_id'),
+                    vote_table.c.voteset_id == bindparam('_voteset_id'))).values(
+                    data=bindparam('_data'), updated_at=now), updates)
+            bucket_changes = [{'_voteset_id': voteset_id, '_value': value, '_change': change}
+                for (voteset_id, value), change in buckets.items() if change]
+            if bucket_changes:
+                bucket_table = self.VoteBucket.__table__
+                connection.execute(bucket_table.update().where(and_(
+                    bucket_table.c.voteset_id == bindparam('_voteset_id'),
+                    bucket_table.c.value == bindparam('_value'))).values(
+                    count=bucket_table.c.count + bindparam('_change')), bucket_changes)
+            changed = [(voteset_id, count, score) for voteset_id, (count, score) in deltas.items()
+                if count or score]
+            if self.votebuffer is not None:
+                for voteset_id, count, score in changed:
+                    self.votebuffer.add(session(), voteset_id, count, score)
+            elif changed:
+                voteset_table = self.VoteSet.__table__
+                connection.execute(voteset_table.update().where(
+                    voteset_table.c.id == bindparam('_id')).values(
+                    count=voteset_table.c.count + bindparam('_count'),
+                    score=voteset_table.c.score + bindparam('_score')),
+                    [{'_id': voteset_id, '_count': count, '_score': score}
+                        for voteset_id, count, score in changed])
+                self._stage_rerank(session(), [voteset_id for voteset_id, count, score in changed])
+            # Loaded votesets, votes, buckets and vote collections no longer match the rows
+            for voteset in votesets.values():
+                session.expire(voteset, ['count', 'score', 'votes'])
+            for user, voteset, data in cast:
+                if user in session:
+                    session.expire(user, ['votes'])
+            vote_mapper = self.Vote.__mapper__
+            for update in updates:
+                vote = session.identity_map.get(vote_mapper.identity_key_from_primary_key(
+                    [update['_user_id'], update['_voteset_id']]))
+                if vote is not None:
+                    session.expire(vote, ['data', 'updated_at'])
+            bucket_mapper = self.VoteBucket.__mapper__
+            for change in bucket_changes:
+                bucket = session.identity_map.get(bucket_mapper.identity_key_from_primary_key(
+                    [change['_voteset_id'], change['_value']]))
+                if bucket is not None:
+                    session.expire(bucket, ['count'])
+        if cast:
+            self._send(votes_cast, votes=cast, operation=operation)
+        return len(cast)
+
+    def comment_check(self, f):
+        """
+        Decorator that registers a check for the pipeline to run on new comments,
+        such as a spam filter. It is called with the comment and may return a status
+        for it, like ``COMMENT_STATUS.SPAM``, or None to let it through.
+        """
+        self.checks.append(f)
+        return f
+
+    def process_comments(self, ids=None, batch_size=100):
+        """
+        Cook, check and publish screened comments: those with the given ids, or all
+        that are waiting. The first check that returns a status decides it;
+        comments that pass every check become public. Counters and cached threads
+        of the affected comment sets are updated once per batch. Run this without
+        ids after a restart, to pick up comments whose processing was lost.
+        Returns the number of comments processed.
+        """
+        Comment = self.Comment
+        if ids is None:
+            total = 0
+            last_id = 0
+            while True:
+                batch = [row[0] for row in self.db.session.query(Comment.id).filter(
+                    Comment.status == COMMENT_STATUS.SCREENED, Comment.id > last_id).order_by(
+                    Comment.id).limit(batch_size)]
+                if not batch:
+                    return total
+                total += self.process_comments(batch)
+                last_id = batch[-1]
+        if not ids:
+            return 0
+
+        with self.measure('process') as operation:
+            comments = Comment.query.filter(Comment.id.in_(ids),
+                Comment.status == COMMENT_STATUS.SCREENED).options(
+                joinedload(Comment.votes), joinedload(Comment.user)).all()
+            if not comments:
+                return 0
+            for comment in comments:
+                comment.cook()
+                status = None
+                for check in self.checks:
+                    status = check(comment)
+                    if status is not None:
+                        break
+                comment.status = status if status is not None else COMMENT_STATUS.PUBLIC
+            self.db.session.flush()
+            commentset_ids = list(set(comment.commentset_id for comment in comments))
+            self.CommentSet.repair(commentset_ids)
+            commentset_table = self.CommentSet.__table__
+            self.db.session.execute(commentset_table.update().where(
+                commentset_table.c.id.in_(commentset_ids)).values(version=commentset_table.c.version + 1))
+            if self.pubsub is not None:
+                for comment in comments:
+                    if comment.status == COMMENT_STATUS.PUBLIC:
+                        self.publish(comment.commentset_id, 'comment', self.comment_json(comment),
+                            self.db.session())
+            self.db.session.commit()
+        for comment in comments:
+            self._send(comment_processed, comment=comment, operation=operation)
+        return len(comments)
+
+    def _send(self, signal, **kwargs):
+        """
+        Send a signal from the current app. Outside an app context, such as in
+        a pipeline worker or a script, the app Commentease was initialised with
+        is the sender, and the signal is skipped if there is none.
+        """
+        app = current_app._get_current_object() if has_app_context() else self.app
+        if app is not None:
+            signal.send(app, **kwargs)
+
+    def measure(self, name):
+        """
+        Context manager that times an operation and yields an
+        :class:`~flask_commentease.instrument.Operation`. With instrumentation
+        enabled, the operation also counts the SQL statements run within it and
+        is passed to the metrics sinks.
+        """
+        if self.instrumentation is not None:
+            return self.instrumentation.operation(name)
+        return timed(name)
+
+    def metrics_sink(self, f):
+        """
+        Decorator that registers a callable to receive each measured operation,
+        for forwarding to statsd or similar. Enables instrumentation if
+        ``COMMENT_INSTRUMENT`` did not.
+        """
+        if self.instrumentation is None:
+            self.instrumentation = Instrumentation()
+            if self.app is not None:
+                self._listen_engines()
+        self.instrumentation.sinks.append(f)
+        return f
+
+    def metrics(self):
+        """
+        Totals per operation for the current request. Empty unless instrumentation
+        is enabled.
+        """
+        if self.instrumentation is None:
+            return {}
+        return self.instrumentation.summary()
+
+    def _log_metrics(self, response):
+        # Per-request summary in debug mode
+        for name, total in sorted(self.metrics().items()):
+            current_app.logger.debug(u"commentease %s: %d calls, %.2fms, %d statements (%.2fms SQL)",
+                name, total['count'], total['duration'] * 1000, total['statements'],
+                total['sql_time'] * 1000)
+        return response
+
+    def thread_html(self, document, currentuser, commenturl):
+        """
+        Render the first page of the comment thread on a document: ``page_size``
+        top-level comments with ``reply_depth`` levels of replies, followed by a
+        "more" link for :meth:`page_action`. With a cache configured, the page is
+        rendered once per version of the comment set and only the per-user parts
+        are filled in for each viewer. Available in templates as
+        ``commentease_thread``.
+        """
+        with self.measure('render') as operation:
+            commentset = document.comments
+            reader = self.reader()
+            if self.cache is None:
+                comments, cursor = self._first_page(commentset, reader)
+                html = Markup(u''.join(self.iter_thread(comments, document, currentuser,
+                    commenturl, commentset.getvotes(currentuser, reader)))) + self._more_link(
+                    None, cursor, commenturl)
+            else:
+                key = u'commentease/thread/%d' % commentset.id
+                cached = self.cache.get(key)
+                html = None
+                if cached is not None:
+                    header, html = cached.split(u'\n', 1)
+                    version, rendered_at = header.split(u' ')
+                    if int(version) != commentset.version or time() - float(rendered_at) > self.cache_timeout:
+                        html = None
+                if html is None:
+                    # Render from the primary, or a lagging replica's thread could be cached
+                    # as the current version
+                    comments, cursor = self._first_page(commentset, self.db.session)
+                    html = Markup(u''.join(self.iter_thread(comments, document, None, commenturl,
+                        cached=True))) + self._more_link(None, cursor, commenturl)
+                    self.cache.set(key, u'%d %f\n%s' % (commentset.version, time(), html))
+                html = self.personalize(html, commentset, currentuser, commenturl)
+        self._send(thread_rendered, commentset=commentset, operation=operation)
+        return html
+
+    def iter_thread(self, comments, document, currentuser, commenturl, uservotes=None, cached=False,
+            chunk_size=8192):
+        """
+        Render comments and their loaded replies as HTML chunks of about
+        ``chunk_size`` characters, without recursion. Each comment is an
+        ``<li class="comment">`` holding the ``commentbody`` macro, then its replies
+        in a ``<ul class="com-children">``, then a ``morereplies`` link if some
+        replies were not shown. The caller supplies the list around the top-level
+        comments. Replies more than ``max_depth`` levels down are left behind a
+        "more replies" link, and replies more than ``flatten_depth`` levels down are
+        listed at that level instead of nesting further. Wrap the generator in
+        :func:`~flask.stream_with_context` to stream it in a response.
+        """
+        commentbody = get_template_attribute(MACROS, 'commentbody')
+        morereplies = get_template_attribute(MACROS, 'morereplies')
+        limit = self.reply_limit
+        if uservotes is None and not cached:
+            uservotes = {}
+        chunk = []
+        size = 0
+        # Comments whose <li> is open, as [comment, depth, level, has <ul>]
+        opened = []
+
+        def close(comment, depth, level, nested):
+            parts = [u'</ul>'] if nested else []
+            replies = comment.shown_replies(limit)
+            if self.max_depth is not None and depth >= self.max_depth:
+                more, after = len(replies) + comment.more_replies(limit), None
+            else:
+                more, after = comment.more_replies(limit), replies[-1].cursor() if replies else None
+            if more:
+                parts.append(morereplies(comment.id, more, after, commenturl))
+            parts.append(u'</li>')
+            return u''.join(parts)
+
+        for comment, depth in _flatten(comments, limit, self.max_depth):
+            level = depth if self.flatten_depth is None else min(depth, self.flatten_depth)
+            while opened and opened[-1][2] >= level:
+                chunk.append(close(*opened.pop()))
+            if opened and not opened[-1][3]:
+                chunk.append(u'<ul class="com-children">')
+                opened[-1][3] = True
+            html = u'<li class="comment">' + commentbody(comment, document, currentuser, commenturl,
+                uservotes, cached)
+            chunk.append(html)
+            size += len(html)
+            opened.append([comment, depth, level, False])
+            if size >= chunk_size:
+                yield u''.join(chunk)
+                chunk = []
+                size = 0
+        while opened:
+            chunk.append(close(*opened.pop()))
+        if chunk:
+            yield u''.join(chunk)
+
+    def stream_thread(self, document, currentuser, commenturl):
+        """
+        Like :meth:`thread_html`, but as a generator of HTML chunks that bypasses the
+        cache, so that a response can start before the whole page is rendered::
+
+            return Response(stream_with_context(commentease.stream_thread(doc, g.user, url)))
+        """
+        commentset = document.comments
+        reader = self.reader()
+        comments, cursor = self._first_page(commentset, reader)
+        uservotes = commentset.getvotes(currentuser, reader)
+        for chunk in self.iter_thread(comments, document, currentuser, commenturl, uservotes):
+            yield chunk
+        more = self._more_link(None, cursor, commenturl)
+        if more:
+            yield more
+
+    def _first_page(self, commentset, session):
+        # The first page of a thread, as page_action would serve it without a cursor
+        return commentset.page(limit=self.page_size, depth=self.reply_depth, session=session)
+
+    def _more_link(self, reply_to_id, cursor, commenturl):
+        # Link to the page after a cursor, or nothing on the last page
+        if cursor is None:
+            return Markup(u'')
+        return get_template_attribute(MACROS, 'morereplies')(reply_to_id, None, cursor, commenturl)
+
+    def personalize(self, html, commentset, currentuser, commenturl):
+        """
+        Fill in the per-user placeholders in a cached thread: vote widgets with the
+        current counts and the user's votes, and edit/delete links on the user's own
+        comments. Only the comments with placeholders in ``html`` are looked up, in
+        two queries.
+        """
+        ids = set(int(match.group(2)) for match in _placeholder_re.finditer(html))
+        if not ids:
+            return Markup(html)
+        comment_table = self.Comment.__table__
+        voteset_table = self.VoteSet.__table__
+        reader = self.reader()
+        comments = dict((row[0], row) for row in reader.execute(
+            select([comment_table.c.id, comment_table.c.user_id, comment_table.c.votes_id,
+                voteset_table.c.count]).select_from(comment_table.join(
+                voteset_table, comment_table.c.votes_id == voteset_table.c.id)).where(and_(
+                comment_table.c.commentset_id == commentset.id, comment_table.c.id.in_(ids)))))
+        uservotes = self.VoteSet.getvotes(currentuser, [row[2] for row in comments.values()], reader)
+        votewidget = get_template_attribute(MACROS, 'votewidget')
+        ownerlinks = get_template_attribute(MACROS, 'ownerlinks')
+
+        def replace(match):
+            comment_id = int(match.group(2))
+            if comment_id not in comments:
+                return u''
+            comment_id, user_id, votes_id, count = comments[comment_id]
+            # Macros from this template aren't autoescaped and return plain strings,
+            # which substituting into Markup would escape
+            if match.group(1) == 'vote':
+                return Markup(votewidget(comment_id, count, uservotes.get(votes_id), commenturl))
+            elif currentuser is not None and user_id == currentuser.id:
+                return Markup(ownerlinks(comment_id))
+            return u''
+
+        return Markup(_placeholder_re.sub(replace, html))
+
+    def moderate(self, status, ids=None, user=None, commentset=None, current=None):
+        """
+        Set the status of many comments at once, selected by any combination of
+        comment ids, author and comment set. ``status`` is one of
+        ``COMMENT_STATUS.PUBLIC``, ``HIDDEN``, ``SPAM`` or ``DELETED``. ``current``
+        limits the change to comments that have one of the given statuses. It
+        defaults to ``HIDDEN`` and ``SPAM`` when making comments public, so that
+        drafts and comments still being screened are not published by accident.
+        Deleted comments that have replies are kept as placeholders, as with
+        :meth:`Comment.delete`. Screened comments that the pipeline hasn't cooked
+        yet are cooked as they leave screening.
+        Changes are made with set-based statements and comment set counters are
+        repaired in the same transaction. The caller is responsible for committing.
+        Returns the number of comments changed.
+        """
+        comment_table = self.Comment.__table__
+        commentset_table = self.CommentSet.__table__
+        criteria = []
+        if ids is not None:
+            criteria.append(comment_table.c.id.in_(ids))
+        if user is not None:
+            criteria.append(comment_table.c.user_id == user.id)
+        if commentset is not None:
+            criteria.append(comment_table.c.commentset_id == commentset.id)
+        if not criteria:
+            raise ValueError("No comments selected for moderation.")
+        if current is None and status == COMMENT_STATUS.PUBLIC:
+            current = (COMMENT_STATUS.HIDDEN, COMMENT_STATUS.SPAM)
+        if current is not None:
+            criteria.append(comment_table.c.status.in_(current))
+        selected = and_(*criteria)
+
+        session = self.db.session
+        session.flush()
+        commentset_ids = [row[0] for row in session.execute(
+            select([comment_table.c.commentset_id]).where(selected).distinct())]
+        if status == COMMENT_STATUS.DELETED:
+            changed = session.execute(select([func.count()]).where(and_(selected,
+                comment_table.c.status != COMMENT_STATUS.DELETED))).scalar()
+            self._delete_comments(selected)
+        elif status in (COMMENT_STATUS.PUBLIC, COMMENT_STATUS.HIDDEN, COMMENT_STATUS.SPAM):
+            # Comments waiting for the pipeline are stored uncooked. Cook them before
+            # they leave screening, or they would be shown without a body
+            for comment in self.Comment.query.filter(selected,
+                    self.Comment.status == COMMENT_STATUS.SCREENED, self.Comment._message_html == u''):
+                comment.cook()
+            session.flush()
+            changed = session.execute(comment_table.update().where(and_(selected,
+                comment_table.c.status != COMMENT_STATUS.DELETED)).values(status=status)).rowcount
+        else:
+            raise ValueError("Unsupported moderation status: %s." % status)
+        if commentset_ids:
+            self.CommentSet.repair(commentset_ids)
+            session.execute(commentset_table.update().where(
+                commentset_table.c.id.in_(commentset_ids)).values(
+                version=commentset_table.c.version + 1))
+        session.expire_all()
+        return changed
+
+    def _delete_comments(self, selected):
+        comment_table = self.Comment.__table__
+        tree_table = self.CommentTree.__table__
+        vote_table = self.Vote.__table__
+        bucket_table = self.VoteBucket.__table__
+        voteset_table = self.VoteSet.__table__
+        session = self.db.session
+        has_replies = comment_table.c.reply_count > 0
+
+        # Comments with replies become placeholders
+        self._unindex_comments(session.connection(),
+            select([comment_table.c.id]).where(and_(selected, has_replies)))
+        session.execute(comment_table.update().where(and_(selected, has_replies)).values(
+            status=COMMENT_STATUS.DELETED, user_id=None, message=u'', message_html=u''))
+        # Remove the rest, then any placeholders left without replies, a level at a time
+        removable = and_(selected, ~has_replies)
+        while True:
+            rows = session.execute(select([comment_table.c.id, comment_table.c.votes_id,
+                comment_table.c.reply_to_id]).where(removable)).fetchall()
+            if not rows:
+                break
+            comment_ids = [row[0] for row in rows]
+            voteset_ids = [row[1] for row in rows]
+            session.execute(tree_table.delete().where(or_(tree_table.c.child_id.in_(comment_ids),
+                tree_table.c.parent_id.in_(comment_ids))))
+            session.execute(comment_table.delete().where(comment_table.c.id.in_(comment_ids)))
+            self._unindex_comments(session.connection(), comment_ids)
+            session.execute(vote_table.delete().where(vote_table.c.voteset_id.in_(voteset_ids)))
+            session.execute(bucket_table.delete().where(bucket_table.c.voteset_id.in_(voteset_ids)))
+            session.execute(voteset_table.delete().where(voteset_table.c.id.in_(voteset_ids)))
+            removed = {}
+            for row in rows:
+                if row[2] is not None:
+                    removed[row[2]] = removed.get(row[2], 0) + 1
+            if not removed:
+                break
+            session.execute(comment_table.update().where(comment_table.c.id == bindparam('_id')).values(
+                reply_count=comment_table.c.reply_count - bindparam('_removed'),
+                updated_at=comment_table.c.updated_at),
+                [{'_id': parent_id, '_removed': count} for parent_id, count in removed.items()])
+            parent_ids = set(removed)
+            removable = and_(comment_table.c.id.in_(parent_ids),
+                comment_table.c.status == COMMENT_STATUS.DELETED, ~has_replies)
+
+    def search(self, terms, commentset=None, status=None, user=None, page=1, per_page=None):
+        """
+        Find comments containing all the words in ``terms``, best matches first.
+        Search all comment sets or one ``commentset``, and optionally only comments
+        with the given ``status`` (one status or a list) or by the given ``user``.
+        Uses an FTS5 table on SQLite and a text search index on PostgreSQL, and falls
+        back to ``LIKE`` elsewhere. Returns a page of comments (``per_page``
+        defaults to ``COMMENT_PAGE_SIZE``) and the next page number, which is None
+        on the last page.
+        """
+        words = terms.split()
+        if not words:
+            return [], None
+        if per_page is None:
+            per_page = self.page_size
+        Comment = self.Comment
+        with self.measure('search'):
+            session = self.reader()
+            backend = self._search_backend(session.connection())
+            query = session.query(Comment)
+            if backend == 'fts5':
+                # Quote each word so that FTS5 query syntax in the terms is taken literally
+                query = query.join(_comment_fts, _comment_fts.c.rowid == Comment.id).filter(
+                    literal_column('comment_fts').match(
+                        u' '.join(u'"%s"' % word.replace(u'"', u'""') for word in words)))
+                order = [func.bm25(literal_column('comment_fts'))]
+            elif backend == 'tsvector':
+                # Must match the indexed expression for the index to be used
+                document = func.to_tsvector(self.search_config, Comment._message)
+                tsquery = func.plainto_tsquery(self.search_config, terms)
+                query = query.filter(document.op('@@')(tsquery))
+                order = [func.ts_rank(document, tsquery).desc()]
+            else:
+                for word in words:
+                    pattern = word.replace(u'/', u'//').replace(u'%', u'/%').replace(u'_', u'/_')
+                    query = query.filter(Comment._message.like(u'%' + pattern + u'%', escape=u'/'))
+                order = [Comment.created_at.desc()]
+            if commentset is not None:
+                query = query.filter(Comment.commentset_id == commentset.id)
+            if status is not None:
+                query = query.filter(Comment.status.in_(status if isinstance(status, (list, tuple, set))
+                    else [status]))
+            if user is not None:
+                query = query.filter(Comment.user_id == user.id)
+            comments = query.options(joinedload(Comment.votes), joinedload(Comment.user)).order_by(
+                *(order + [Comment.id.desc()])).offset((page - 1) * per_page).limit(per_page + 1).all()
+        if len(comments) > per_page:
+            return comments[:per_page], page + 1
+        return comments, None
+
+    def reindex_search(self, commentset_ids=None):
+        """
+        Create the search index if it is missing and, on SQLite, index the comments
+        in the given comment sets (a list or a select of ids; default: all). Needed
+        once for databases created before search was available. PostgreSQL keeps its
+        index current by itself. The caller is responsible for committing.
+        """
+        connection = self.db.session.connection()
+        self._create_search_index(connection)
+        if self._search_backend(connection) != 'fts5':
+            return
+        comment_table = self.Comment.__table__
+        criteria = [comment_table.c.message != u'']
+        if commentset_ids is None:
+            connection.execute(_comment_fts.delete())
+        else:
+            criteria.append(comment_table.c.commentset_id.in_(commentset_ids))
+            self._unindex_comments(connection, select([comment_table.c.id]).where(
+                comment_table.c.commentset_id.in_(commentset_ids)))
+        connection.execute(_comment_fts.insert().from_select(['rowid', 'message'],
+            select([comment_table.c.id, comment_table.c.message]).where(and_(*criteria))))
+
+    def _create_search_index(self, connection):
+        self._search_backends.pop(connection.engine, None)
+        if connection.dialect.name == 'sqlite':
+            try:
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS comment_fts "
+                    "USING fts5(message, tokenize='porter unicode61')")
+            except OperationalError:
+                # SQLite was built without FTS5. Search falls back to LIKE
+                pass
+        elif connection.dialect.name == 'postgresql':
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_comment_message_search ON comment "
+                "USING gin (to_tsvector('%s', message))" % self.search_config)
+
+    def _search_backend(self, connection):
+        # 'fts5', 'tsvector' or 'like', decided once per engine
+        engine = connection.engine
+        backend = self._search_backends.get(engine)
+        if backend is None:
+            if engine.dialect.name == 'postgresql':
+                backend = 'tsvector'
+            elif engine.dialect.name == 'sqlite' and engine.dialect.has_table(connection, 'comment_fts'):
+                backend = 'fts5'
+            else:
+                backend = 'like'
+            self._search_backends[engine] = backend
+        return backend
+
+    def _unindex_comments(self, connection, ids):
+        if self._search_backend(connection) == 'fts5':
+            connection.execute(_comment_fts.delete().where(_comment_fts.c.rowid.in_(ids)))
+
+    def _transfer_tables(self):
+        # Tables in the order their rows must be inserted
+        return [
+            ('commentset', self.CommentSet.__table__),
+            ('voteset', self.VoteSet.__table__),
+            ('comment', self.Comment.__table__),
+            ('vote', self.Vote.__table__),
+            ]
+
+    def export_comments(self, commentset_ids=None, batch_size=1000):
+        """
+        Generate JSON Lines for the given comment sets (default: all), with their
+        comments, the comments' votesets and the votes. Each line is an object with
+        ``type`` and ``data``. Rows are read with server-side cursors where the
+        database supports them, so memory use stays flat. Also available as
+        ``flask commentease export``.
+        """
+        commentset_table = self.CommentSet.__table__
+        voteset_table = self.VoteSet.__table__
+        comment_table = self.Comment.__table__
+        vote_table = self.Vote.__table__
+        comment_votesets = select([comment_table.c.votes_id])
+        if commentset_ids is not None:
+            commentset_ids = list(commentset_ids)
+            comment_votesets = comment_votesets.where(comment_table.c.commentset_id.in_(commentset_ids))
+        queries = [
+            ('commentset', select([commentset_table]).order_by(commentset_table.c.id)),
+            ('voteset', select([voteset_table]).where(
+                voteset_table.c.id.in_(comment_votesets)).order_by(voteset_table.c.id)),
+            ('comment', select([comment_table]).order_by(comment_table.c.id)),
+            ('vote', select([vote_table]).where(vote_table.c.voteset_id.in_(comment_votesets))),
+            ]
+        if commentset_ids is not None:
+            queries[0] = (queries[0][0], queries[0][1].where(commentset_table.c.id.in_(commentset_ids)))
+            queries[2] = (queries[2][0], queries[2][1].where(comment_table.c.commentset_id.in_(commentset_ids)))
+
+        connection = self._read_engine().connect().execution_options(stream_results=True)
+        try:
+            for kind, query in queries:
+                result = connection.execute(query)
+                keys = result.keys()
+                while True:
+                    rows = result.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield json.dumps({'type': kind, 'data': _dump_row(keys, row)}) + '\n'
+        finally:
+            connection.close()
+
+    def import_comments(self, lines, batch_size=1000):
+        """
+        Import JSON Lines produced by :meth:`export_comments`, inserting rows in
+        batches of ``batch_size`` with their original ids. Users must already exist.
+        Comment trees and counters are rebuilt once all rows are in. Also available
+        as ``flask commentease import``. Returns the number of rows of each type.
+        """
+        tables = self._transfer_tables()
+        batches = dict((kind, []) for kind, table in tables)
+        counts = dict((kind, 0) for kind, table in tables)
+        commentset_ids = []
+        connection = self.db.session.connection()
+
+        def flush():
+            for kind, table in tables:
+                if batches[kind]:
+                    connection.execute(table.insert(), batches[kind])
+                    counts[kind] += len(batches[kind])
+                    batches[kind] = []
+
+        tablemap = dict(tables)
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('type') not in tablemap:
+                raise ValueError("Unknown record type: %s." % record.get('type'))
+            row = _load_row(tablemap[record['type']], record['data'])
+            batches[record['type']].append(row)
+            if record['type'] == 'commentset':
+                commentset_ids.append(row['id'])
+            if len(batches[record['type']]) >= batch_size:
+                flush()
+        flush()
+
+        comment_table = self.Comment.__table__
+        for start in range(0, len(commentset_ids), batch_size):
+            chunk = commentset_ids[start:start + batch_size]
+            self.CommentTree.rebuild(chunk)
+            self.Comment.rebuild(chunk)
+            self.CommentSet.repair(chunk)
+            self.VoteSet.repair(select([comment_table.c.votes_id]).where(
+                comment_table.c.commentset_id.in_(chunk)))
+            self.VoteBucket.rebuild(select([comment_table.c.votes_id]).where(
+                comment_table.c.commentset_id.in_(chunk)))
+            self.reindex_search(chunk)
+        if self.db.engine.dialect.name == 'postgresql':
+            # Explicit ids don't advance sequences
+            for kind, table in tables:
+                if 'id' in table.c:
+                    connection.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                        "COALESCE((SELECT MAX(id) FROM %s), 1))" % (table.name, table.name))
+        self.db.session.commit()
+        return counts
+
+    def thread_access(self, f):
+        """
+        Register a function that decides whether a user may read a comment set
+        through the JSON endpoints. It is called with the comment set and the user
+        (or None), and returns True or False. The endpoints refuse all requests until
+        a function is registered.
+        """
+        self._thread_access = f
+        return f
+
+    def comment_json(self, comment):
+        """
+        Return a comment as a dictionary for JSON responses.
+        """
+        return {
+            'id': comment.id,
+            'reply_to_id': comment.reply_to_id,
+            'depth': comment.depth,
+            'user': comment.user.fullname if comment.user is not None else None,
+            'html': comment.message_html if not comment.is_deleted else u'',
+            'status': comment.status,
+            'created_at': comment.created_at.isoformat(),
+            'edited_at': comment.edited_at.isoformat() if comment.edited_at else None,
+            'votes': {'count': comment.votes.count, 'score': comment.votes.score},
+            'rank': comment.rank,
+            'more_replies': comment.more_replies(),
+            }
+
+    def thread_state(self, commentset, variant=u''):
+        """
+        Return an ETag and a Last-Modified time for a comment set. Both change when
+        comments in the set are posted, edited, moderated or voted on, since votes
+        touch the comment set's ``updated_at`` when comments are reranked. ``variant``
+        distinguishes representations of the same state, such as different pages,
+        and is part of the ETag. Reads one row, on the read session. A comment set
+        that hasn't reached the read bind yet is looked up on the primary.
+        """
+        commentset_table = self.CommentSet.__table__
+        query = select([commentset_table.c.version, commentset_table.c.count,
+            commentset_table.c.updated_at]).where(commentset_table.c.id == commentset.id)
+        reader = self.reader()
+        row = reader.execute(query).first()
+        if row is None and reader is not self.db.session:
+            row = self.db.session.execute(query).first()
+        version, count, updated_at = row
+        etag = hashlib.sha1((u'%d:%d:%d:%s:%s' % (commentset.id, version, count,
+            updated_at.isoformat(), variant)).encode('utf-8')).hexdigest()
+        return etag, updated_at
+
     # This method is meant for use with Nodular
     def addmixin(self, model, votes=True, comments=True):
         """
-        Add the voting and commenting mixins to an existing SQLAlchemy declarative model.
+        Add the voting and commenting mixins to an existing SQLAlchemy declarative model,
+        with the summary columns used by :meth:`summary_options`. The model may be
+        mapped already, or be a class that is mapped later.
         """
+        mixins = []
         if votes:
-            for key, value in VotingMixin.__dict__.items():
-                if not key.startswith('__'):
-                    setattr(model, key, value)
+            mixins.append(VotingMixin)
         if comments:
-            for key, value in CommentingMixin.__dict__.items():
-                if not key.startswith('__'):
+            mixins.append(CommentingMixin)
+        mapped = hasattr(model, '__mapper__')
+        for mixin in mixins:
+            attributes = [(key, value) for key, value in mixin.__dict__.items() if not key.startswith('__')]
+            # Plain attributes first, as declared attributes read them (like votes_lazy)
+            for key, value in attributes:
+                if not isinstance(value, declared_attr):
                     setattr(model, key, value)
+            for key, value in attributes:
+                if isinstance(value, declared_attr):
+                    # Declarative only evaluates declared attributes while mapping a class
+                    setattr(model, key, value.fget(model) if mapped else value)
+            if not mapped:
+                model.__declare_last__ = mixin.__dict__['__declare_last__']
+        if mapped:
+            _add_summary(model)
+
+    def summary_options(self, model):
+        """
+        Loader options for listing pages that show only vote and comment counts.
+        The counts are loaded as columns of the main query (``vote_count``,
+        ``vote_score`` and ``comment_count``), and the voteset and comment set
+        are not loaded at all, so a page of any size costs one query::
+
+            Proposal.query.options(*commentease.summary_options(Proposal))
+        """
+        options = [undefer_group(SUMMARY_GROUP)]
+        if _uses_voting(model):
+            options.append(lazyload(model.votes))
+        if _uses_commenting(model):
+            options.append(lazyload(model.comments))
+        return options
 
     def enable_voting(self, obj):
-        if isinstance(obj, VotingMixin):
+        if _uses_voting(type(obj)):
             obj.allow_voting = True
             if obj.votes is None:
                 obj.votes = self.VoteSet()
@@ -442,7 +2496,7 @@ class Commentease(object):
         """
         Enable commenting on the given object.
         """
-        if isinstance(obj, CommentingMixin):
+        if _uses_commenting(type(obj)):
             obj.allow_commenting = True
             if obj.comments is None:
                 obj.comments = self.CommentSet()
@@ -470,17 +2524,101 @@ class Commentease(object):
             form = self.CsrfForm()
             if form.validate():
                 action = request.form.get('action')
-                if action == 'vote':
-                    # TODO: Vote up
-                    pass
-                elif action == 'votedown':
-                    # TODO: Vote down
-                    pass
-                else:
-                    raise CommenteaseActionError(u"Unknown voting action")
+                try:
+                    if action in ('vote', 'voteup'):
+                        if voteset.pattern == VOTE_PATTERN.UP_ONLY:
+                            voteset.vote(user)
+                        elif voteset.pattern == VOTE_PATTERN.UP_DOWN:
+                            voteset.vote(user, +1)
+                        else:
+                            voteset.vote(user, request.form.get('data', type=int))
+                    elif action == 'votedown':
+                        voteset.vote(user, -1)
+                    elif action == 'cancelvote':
+                        voteset.cancelvote(user)
+                    else:
+                        raise CommenteaseActionError(u"Unknown voting action")
+                except ValueError:
+                    abort(400)
+                self.db.session.commit()
+                self.mark_write()
+                return redirect(request.base_url)
             else:
                 return form
 
+    # Batch vote view handler
+    def vote_batch_action(self, user, votesets=None):
+        """
+        Cast votes posted as a JSON list of ``{"voteset": id, "data": value}``
+        objects, using :meth:`vote_batch`. ``votesets`` is a query that limits
+        the votesets that may be voted in (default: all). Responds with the
+        number of votes changed.
+
+        The CSRF token is read from the ``X-CSRFToken`` header, or from the
+        ``csrf_token`` key when the body is ``{"csrf_token": ..., "votes": [...]}``.
+        """
+        if request.method == 'POST':
+            payload = request.get_json(silent=True)
+            token = request.headers.get('X-CSRFToken')
+            items = payload
+            if isinstance(payload, dict):
+                token = token or payload.get('csrf_token')
+                items = payload.get('votes')
+            # The form only reads request.form, which a JSON body leaves empty
+            form = self.CsrfForm(formdata=MultiDict([('csrf_token', token or u'')]))
+            if form.validate():
+                if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+                    abort(400)
+                if votesets is None:
+                    votesets = self.VoteSet.query
+                try:
+                    ids = set(int(item['voteset']) for item in items)
+                except (KeyError, TypeError, ValueError):
+                    abort(400)
+                found = dict((voteset.id, voteset) for voteset in
+                    votesets.filter(self.VoteSet.id.in_(ids))) if ids else {}
+                if len(found) != len(ids):
+                    abort(404)
+                try:
+                    changed = self.vote_batch((user, found[int(item['voteset'])], item.get('data'))
+                        for item in items)
+                except ValueError:
+                    abort(400)
+                self.db.session.commit()
+                self.mark_write()
+                return jsonify(status='ok', votes=changed)
+            else:
+                response = jsonify(status='error', error='csrf')
+                response.status_code = 400
+                return response
+
+    # Comment page view handler
+    def page_action(self, commentset, user, document=None, permissions=None):
+        """
+        Render a page of comments for "more comments" and "more replies" links. The
+        query string may have ``comment`` (the comment whose replies are wanted; top-level
+        comments if missing) and ``after`` (the cursor from the link).
+        """
+        permissions = commentset.permissions(user, permissions)
+        reply_to = None
+        if request.args.get('comment'):
+            comment_id = request.args.get('comment', type=int)
+            if comment_id is None:
+                abort(404)
+            reply_to = self.Comment.query.get(comment_id)
+            if reply_to is None or reply_to.commentset != commentset:
+                abort(404)
+        reader = self.reader()
+        try:
+            comments, cursor = commentset.page(after=request.args.get('after'),
+                limit=(self.reply_limit or self.page_size) if reply_to else self.page_size,
+                reply_to=reply_to, depth=self.reply_depth, session=reader)
+        except ValueError:
+            abort(400)
+        return Markup(u''.join(self.iter_thread(comments, document, user, request.base_url,
+            commentset.getvotes(user, reader)))) + self._more_link(reply_to.id if reply_to else None,
+            cursor, request.base_url)
+
     # Comment view handler
     def comment_action(self, commentset, user, permissions=None):
         permissions = commentset.permissions(user, permissions)
@@ -488,30 +2626,232 @@ class Commentease(object):
             # Look for form submission
             commentform = self.CommentForm()
             if request.form['form.id'] == 'newcomment' and commentform.validate():
-                if commentform.comment_edit_id.data:
-                    comment = self.Comment.query.get(int(commentform.comment_edit_id.data))
-                    if comment:
-                        if comment.user == g.user:
-                            comment.message = commentform.message.data
-                            comment.edited_at = datetime.utcnow()
-                            flash("Your comment has been edited", "info")
+                signal = None
+                screened = None
+                name = 'comment.edit' if commentform.comment_edit_id.data else 'comment.post'
+                with self.measure(name) as operation:
+                    if commentform.comment_edit_id.data:
+                        comment = self.Comment.query.get(int(commentform.comment_edit_id.data))
+                        if comment:
+                            if comment.user == g.user:
+                                comment.message = commentform.message.data
+                                comment.edited_at = datetime.utcnow()
+                                comment.commentset.touch()
+                                signal = comment_edited
+                                flash("Your comment has been edited", "info")
+                            else:
+                                flash("You can only edit your own comments", "info")
                         else:
-                            flash("You can only edit your own comments", "info")
+                            flash("No such comment", "error")
                     else:
-                        flash("No such comment", "error")
-                else:
-                    comment = self.Comment(user=g.user, commentset=commentset,
-                        message=commentform.message.data)
-                    if commentform.comment_reply_to_id.data:
-                        reply_to = self.Comment.query.get(int(commentform.comment_reply_to_id.data))
-                        if reply_to and reply_to.commentset == commentset:
-                            comment.reply_to = reply_to
-                    commentset.count += 1
-                    if comment.votes.pattern == VOTE_PATTERN.UP_DOWN:
-                        # Vote for your own comment
-                        comment.votes.vote(g.user, +1)
-                    self.db.session.add(comment)
-                    flash("Your comment has been posted", "info")
-                self.db.session.commit()
+                        # Find the parent first. The new comment joins the session with its
+                        # comment set, and a query after that would flush it without a parent
+                        reply_to = None
+                        if commentform.comment_reply_to_id.data:
+                            reply_to = self.Comment.query.get(int(commentform.comment_reply_to_id.data))
+                            if reply_to is not None and reply_to.commentset != commentset:
+                                reply_to = None
+                        # With the pipeline, the comment is screened until it has been processed
+                        comment = self.Comment(user=g.user, commentset=commentset, reply_to=reply_to,
+                            status=COMMENT_STATUS.SCREENED if self.pipeline is not None
+                                else COMMENT_STATUS.PUBLIC,
+                            message=commentform.message.data)
+                        if comment.status == COMMENT_STATUS.PUBLIC:
+                            commentset.count += 1
+                            if reply_to is None:
+                                commentset.count_toplevel += 1
+                            else:
+                                commentset.count_replies += 1
+                            commentset.touch()
+                        if comment.votes.pattern == VOTE_PATTERN.UP_DOWN:
+                            # Vote for your own comment
+                            comment.votes.vote(g.user, +1)
+                        self.db.session.add(comment)
+                        signal = comment_posted
+                        flash("Your comment has been posted", "info")
+                    if signal is not None:
+                        self.db.session.flush()
+                        if self.pipeline is not None and comment.status == COMMENT_STATUS.SCREENED:
+                            screened = comment.id
+                        elif self.pubsub is not None:
+                            self.publish(comment.commentset_id, 'comment', self.comment_json(comment),
+                                self.db.session())
+                    self.db.session.commit()
+                if screened is not None and not self.pipeline.submit(screened):
+                    # The queue is full. Process it here, slowing posting down to the
+                    # rate the workers can keep up with
+                    self.process_comments([screened])
+                if signal is not None:
+                    self.mark_write()
+                    self._send(signal, comment=comment, operation=operation)
                 return redirect(request.base_url)  # FIXME: Return form and new comment
+            elif request.form['form.id'] == 'delcomment':
+                delcommentform = self.DeleteCommentForm()
+                if delcommentform.validate():
+                    deleted = False
+                    with self.measure('comment.delete') as operation:
+                        comment = self.Comment.query.get(int(delcommentform.comment_id.data))
+                        if comment and comment.commentset == commentset:
+                            if comment.user == g.user:
+                                self.publish(commentset.id, 'delete', {'id': comment.id}, self.db.session())
+                                if comment.status == COMMENT_STATUS.PUBLIC:
+                                    commentset.count -= 1
+                                    if comment.reply_to_id is None:
+                                        commentset.count_toplevel -= 1
+                                    else:
+                                        commentset.count_replies -= 1
+                                comment.delete()
+                                deleted = True
+                                flash("Your comment has been deleted", "info")
+                            else:
+                                flash("You can only delete your own comments", "info")
+                        else:
+                            flash("No such comment", "error")
+                        self.db.session.commit()
+                    if deleted:
+                        self.mark_write()
+                        self._send(comment_deleted, comment=comment, operation=operation)
+                    return redirect(request.base_url)
         return "Form: %s %s" % (request.method, request.form)
+
+
+# JSON views. These serve threads to clients that refresh them periodically, and
+# answer with 304 Not Modified when nothing has changed since the client's copy.
+
+def _thread_or_abort(commentset_id):
+    commentease = current_app.extensions['commentease']
+    commentset = commentease.CommentSet.query.get_or_404(commentset_id)
+    if commentease._thread_access is None or not commentease._thread_access(
+            commentset, getattr(g, 'user', None)):
+        abort(403)
+    return commentease, commentset
+
+
+def _thread_response(commentset_id, payload):
+    commentease, commentset = _thread_or_abort(commentset_id)
+    # Each set of arguments is a different representation and needs its own validator
+    etag, last_modified = commentease.thread_state(commentset, u'&'.join(u'%s=%s' % item
+        for item in sorted(request.args.items(multi=True))))
+    last_modified = last_modified.replace(microsecond=0)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        modified_since = request.if_modified_since
+        if modified_since is not None and modified_since.tzinfo is not None:
+            modified_since = modified_since.replace(tzinfo=None)
+        not_modified = modified_since is not None and last_modified <= modified_since
+    if not_modified:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(payload(commentease, commentset))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def _limit_arg(commentease):
+    # The ``limit`` argument of the JSON views, which must be a positive number
+    limit = request.args.get('limit', commentease.page_size, type=int)
+    if limit < 1:
+        abort(400)
+    return min(limit, 100)
+
+
+@commentease_blueprint.route('/commentease/<int:commentset_id>/thread.json')
+def thread_json(commentset_id):
+    """
+    All visible comments in a comment set, in display order.
+    """
+    def payload(commentease, commentset):
+        return {'comments': [commentease.comment_json(comment)
+            for comment, depth in _flatten(commentset.nodes(commentease.reader()))]}
+    return _thread_response(commentset_id, payload)
+
+
+@commentease_blueprint.route('/commentease/<int:commentset_id>/page.json')
+def page_json(commentset_id):
+    """
+    A page of comments, with the same ``comment``, ``after`` and ``order`` arguments
+    as :meth:`CommentSet.page`, and the cursor for the next page.
+    """
+    def payload(commentease, commentset):
+        reply_to = None
+        if request.args.get('comment'):
+            comment_id = request.args.get('comment', type=int)
+            if comment_id is None:
+                abort(404)
+            reply_to = commentease.Comment.query.get(comment_id)
+            if reply_to is None or reply_to.commentset != commentset:
+                abort(404)
+        try:
+            comments, cursor = commentset.page(after=request.args.get('after'), limit=_limit_arg(commentease),
+                order=request.args.get('order', 'rank'), reply_to=reply_to,
+                depth=commentease.reply_depth, session=commentease.reader())
+        except ValueError:
+            abort(400)
+        return {'comments': [commentease.comment_json(comment)
+            for comment, depth in _flatten(comments)], 'cursor': cursor}
+    return _thread_response(commentset_id, payload)
+
+
+@commentease_blueprint.route('/commentease/<int:commentset_id>/since.json')
+def since_json(commentset_id):
+    """
+    Comments posted after the comment id in ``cursor``, oldest first, and the
+    cursor to use for the next request.
+    """
+    def payload(commentease, commentset):
+        Comment = commentease.Comment
+        cursor = request.args.get('cursor', 0, type=int)
+        comments = commentease.reader().query(Comment).filter(Comment.commentset_id == commentset.id,
+            Comment.id > cursor, ~Comment.status.in_(COMMENT_STATUS.UNLISTED)).options(
+            joinedload(Comment.votes), joinedload(Comment.user)).order_by(Comment.id).limit(
+            _limit_arg(commentease)).all()
+        Comment.count_listed_replies(comments, commentease.reader())
+        return {'comments': [commentease.comment_json(comment) for comment in comments],
+            'cursor': comments[-1].id if comments else cursor}
+    return _thread_response(commentset_id, payload)
+
+
+@commentease_blueprint.route('/commentease/<int:commentset_id>/events')
+def thread_events(commentset_id):
+    """
+    Changes to a comment set as they happen: ``comment`` (new or edited, as in
+    the JSON views), ``delete`` and ``votes`` (counts by comment id). Clients that
+    accept ``text/event-stream`` get server-sent events until ``push_timeout``,
+    then reconnect. Others get a long-poll response of ``{"events": [...]}`` after
+    the first events arrive or ``timeout`` seconds. Events are not replayed, so
+    clients should catch up with ``since.json`` after reconnecting.
+    """
+    commentease, commentset = _thread_or_abort(commentset_id)
+    if commentease.pubsub is None:
+        abort(404)
+    subscription = commentease.pubsub.subscribe(u'commentease/%d' % commentset.id)
+    timeout = commentease.push_timeout
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        def stream():
+            yield 'retry: 3000\n\n'
+            deadline = time() + timeout
+            while time() < deadline:
+                message = subscription.get(timeout=min(15, max(deadline - time(), 0)))
+                if message is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield 'data: %s\n\n' % message
+        response = current_app.response_class(stream(), mimetype='text/event-stream')
+        # Closed when the stream ends or the client goes away
+        response.call_on_close(subscription.close)
+        response.headers['X-Accel-Buffering'] = 'no'
+    else:
+        with subscription:
+            messages = []
+            message = subscription.get(timeout=min(request.args.get('timeout', 25, type=int), timeout))
+            while message is not None:
+                messages.append(message)
+                message = subscription.get(timeout=0)
+        response = current_app.response_class('{"events": [%s]}' % ', '.join(messages),
+            mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.cache
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Cache backends for rendered comment threads. A backend needs ``get``, ``set``,
+    ``delete`` and ``clear`` methods and stores unicode strings.
+"""
+
+import threading
+from collections import OrderedDict
+
+try:  # Python 2
+    import anydbm as dbm
+except ImportError:  # Python 3
+    import dbm
+
+__all__ = ['LRUCache', 'DBMCache']
+
+
+class LRUCache(object):
+    """
+    In-process cache that evicts the least recently used entries once the combined
+    length of cached values exceeds ``maxsize`` characters.
+    """
+    def __init__(self, maxsize=16 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                # Move to the most recently used end
+                self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(value) > self.maxsize:
+                return
+            self._data[key] = value
+            self.size += len(value)
+            while self.size > self.maxsize:
+                oldkey, old = self._data.popitem(last=False)
+                self.size -= len(old)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class DBMCache(object):
+    """
+    Cache stored in a local dbm file, which survives restarts and can be larger
+    than memory. Entries are replaced rather than accumulated, so the file stays
+    proportional to the number of cached threads. dbm files are not safe for
+    concurrent writers, so use one file per process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = dbm.open(path, 'c')
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                return self._db[key.encode('utf-8')].decode('utf-8')
+            except KeyError:
+                return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._db[key.encode('utf-8')] = value.encode('utf-8')
+
+    def delete(self, key):
+        with self._lock:
+            try:
+                del self._db[key.encode('utf-8')]
+            except KeyError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._db.keys()):
+                del self._db[key]
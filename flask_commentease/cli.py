@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.cli
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    ``flask commentease`` commands, available with Flask 0.11 and later
+"""
+
+try:
+    import click
+    from flask.cli import AppGroup
+except ImportError:  # Flask < 0.11
+    click = None
+
+__all__ = ['register_commands']
+
+
+def register_commands(app, commentease):
+    """
+    Add the ``commentease`` command group to the app's CLI, if it has one.
+    """
+    if click is None or not hasattr(app, 'cli'):
+        return
+
+    commands = AppGroup('commentease', help="Export and import comments.")
+
+    @commands.command('export')
+    @click.option('--commentset', 'commentset_ids', type=int, multiple=True,
+        help="Comment set to export (repeatable; default: all).")
+    @click.argument('output', type=click.File('w'), default='-')
+    def export_command(commentset_ids, output):
+        """Export comment sets as JSON Lines."""
+        for line in commentease.export_comments(commentset_ids or None):
+            output.write(line)
+
+    @commands.command('import')
+    @click.argument('input', type=click.File('r'), default='-')
+    def import_command(input):
+        """Import comment sets from JSON Lines."""
+        counts = commentease.import_comments(input)
+        click.echo(u', '.join(u'%d %ss' % (counts[kind], kind) for kind in sorted(counts)))
+
+    app.cli.add_command(commands)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.instrument
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Timing and SQL statement counts for Commentease operations
+"""
+
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+from flask import g, has_app_context
+from sqlalchemy import event
+
+__all__ = ['Operation', 'Instrumentation', 'timed']
+
+
+class Operation(object):
+    """
+    A measured Commentease operation, such as ``vote`` or ``render``. ``statements``
+    and ``sql_time`` include nested operations and are None when instrumentation
+    is disabled.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.duration = None
+        self.statements = None
+        self.sql_time = None
+
+    def __repr__(self):
+        return '<Operation %s %.2fms %s statements>' % (self.name, (self.duration or 0) * 1000,
+            self.statements if self.statements is not None else '?')
+
+
+@contextmanager
+def timed(name):
+    """
+    Time an operation without counting statements.
+    """
+    operation = Operation(name)
+    start = default_timer()
+    try:
+        yield operation
+    finally:
+        operation.duration = default_timer() - start
+
+
+class Instrumentation(object):
+    """
+    Counts SQL statements and their time for each Commentease operation in
+    progress on the current thread, and passes completed operations to sinks.
+    A sink is any callable that takes an :class:`Operation`. Operations completed
+    during a request are also collected in a per-request summary. Only statements
+    on engines passed to :meth:`listen` are counted.
+    """
+    def __init__(self):
+        self.sinks = []
+        self._local = threading.local()
+
+    def listen(self, engine):
+        """
+        Count statements run on this engine. Listening twice on the same engine
+        has no further effect.
+        """
+        if not event.contains(engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._stack():
+            conn.info.setdefault('commentease_query_start', []).append(default_timer())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stack = self._stack()
+        starts = conn.info.get('commentease_query_start')
+        if stack and starts:
+            elapsed = default_timer() - starts.pop()
+            for operation in stack:
+                operation.statements += 1
+                operation.sql_time += elapsed
+
+    @contextmanager
+    def operation(self, name):
+        """
+        Measure an operation. Statements run while it is in progress are counted.
+        """
+        operation = Operation(name)
+        operation.statements = 0
+        operation.sql_time = 0.0
+        stack = self._stack()
+        stack.append(operation)
+        start = default_timer()
+        try:
+            yield operation
+        finally:
+            operation.duration = default_timer() - start
+            stack.remove(operation)
+            self.record(operation)
+
+    def record(self, operation):
+        for sink in self.sinks:
+            sink(operation)
+        if has_app_context():
+            if not hasattr(g, 'commentease_operations'):
+                g.commentease_operations = []
+            g.commentease_operations.append(operation)
+
+    def summary(self):
+        """
+        Totals per operation name for the current request, as a dictionary of
+        name to ``{'count', 'duration', 'statements', 'sql_time'}``.
+        """
+        totals = {}
+        for operation in getattr(g, 'commentease_operations', []):
+            total = totals.setdefault(operation.name,
+                {'count': 0, 'duration': 0.0, 'statements': 0, 'sql_time': 0.0})
+            total['count'] += 1
+            total['duration'] += operation.duration
+            total['statements'] += operation.statements
+            total['sql_time'] += operation.sql_time
+        return totals
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.pipeline
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Background processing of new comments
+"""
+
+import os
+import logging
+import threading
+try:
+    from queue import Queue, Empty, Full
+except ImportError:  # Python 2
+    from Queue import Queue, Empty, Full
+
+__all__ = ['Pipeline']
+
+logger = logging.getLogger(__name__)
+
+_stop = object()
+
+
+class Pipeline(object):
+    """
+    Calls ``process`` with batches of up to ``batch_size`` items from a queue, in
+    ``workers`` background threads. The queue holds at most ``queue_size`` items.
+    When it is full, :meth:`submit` refuses the item and the caller is expected to
+    process it itself, which slows producers down to the rate the workers sustain.
+
+    Workers start with the first submission, and again in a forked child process,
+    since threads don't survive a fork. Items still queued when the process exits
+    are lost, so ``process`` should leave a record that allows them to be retried.
+
+    Workers are threads of the current process, and there is no process pool. They
+    help when ``process`` waits on the database or a remote service, but Python code
+    that keeps the CPU busy runs on one thread at a time, so adding workers won't
+    speed it up. Run such work in separate processes instead.
+    """
+    def __init__(self, process, workers=2, queue_size=1000, batch_size=50):
+        self.process = process
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='commentease-pipeline-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, item):
+        """
+        Queue an item for processing. Returns False if the queue is full.
+        """
+        self.start()
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            return False
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Process the items already queued, then stop the workers.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self.queue.put(_stop)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _stop:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+                if item is _stop:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self.process(batch)
+            except Exception:
+                logger.exception("Failed to process batch of %d items", len(batch))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.pubsub
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Publish/subscribe for pushing thread changes to clients
+"""
+
+import threading
+try:
+    from queue import Queue, Empty, Full
+except ImportError:  # Python 2
+    from Queue import Queue, Empty, Full
+
+__all__ = ['PubSub', 'Subscription']
+
+
+class Subscription(object):
+    """
+    Messages published to a channel after subscribing. Close the subscription
+    when done with it.
+    """
+    def __init__(self, pubsub, channel, maxsize):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.queue = Queue(maxsize)
+
+    def get(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds for the next message. Returns None if
+        nothing arrived in time.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.pubsub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PubSub(object):
+    """
+    In-process publish/subscribe. Messages are strings. Each subscription has its
+    own bounded queue, and a subscriber that falls ``maxsize`` messages behind
+    misses the overflow instead of holding up publishers.
+
+    This only reaches subscribers in the same process. Deployments with several
+    processes can use any object with the same ``publish(channel, message)`` and
+    ``subscribe(channel)`` methods, backed by a shared broker.
+    """
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def publish(self, channel, message):
+        """
+        Send a message to all current subscribers of the channel.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(message)
+            except Full:
+                pass
+
+    def subscribe(self, channel):
+        """
+        Return a :class:`Subscription` to the channel.
+        """
+        subscription = Subscription(self, channel, self.maxsize)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.ranking
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Ranking functions for ordering comments. Each takes a comment's vote count,
+    vote score and creation time, and returns a float; higher ranks sort first.
+"""
+
+from math import sqrt, log10
+from datetime import datetime
+
+__all__ = ['score', 'wilson', 'hot']
+
+_epoch = datetime(1970, 1, 1)
+
+
+def score(count, score, created_at):
+    """
+    Rank by net score (upvotes minus downvotes).
+    """
+    return float(score)
+
+
+def wilson(count, score, created_at, z=1.96):
+    """
+    Rank by the lower bound of the Wilson score interval for the fraction of
+    upvotes, which favours comments with many votes over a few lucky ones.
+    """
+    if not count:
+        return 0.0
+    phat = (count + score) / 2.0 / count
+    return (phat + z * z / (2 * count) - z * sqrt(
+        (phat * (1 - phat) + z * z / (4 * count)) / count)) / (1 + z * z / count)
+
+
+def hot(count, score, created_at):
+    """
+    Rank by score decaying with age, so that new comments get a chance to be seen.
+    Every 12.5 hours of age is worth a factor of ten in score.
+    """
+    order = log10(max(abs(score), 1))
+    sign = 1 if score > 0 else -1 if score < 0 else 0
+    seconds = (created_at - _epoch).total_seconds() - 1134028003
+    return round(sign * order + seconds / 45000, 7)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.signals
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Signals sent by Commentease. The sender is the app. Receivers get the object
+    concerned and an ``operation`` with the time taken (and, with instrumentation
+    enabled, SQL statement counts). Signals need blinker to be installed.
+"""
+
+from flask.signals import Namespace
+
+__all__ = ['comment_posted', 'comment_edited', 'comment_deleted', 'comment_processed', 'vote_cast',
+    'vote_cancelled', 'votes_cast', 'thread_rendered']
+
+_signals = Namespace()
+
+#: A comment was posted. Receives ``comment`` and ``operation``
+comment_posted = _signals.signal('comment-posted')
+#: A comment was edited. Receives ``comment`` and ``operation``
+comment_edited = _signals.signal('comment-edited')
+#: A comment was deleted. Receives ``comment`` and ``operation``
+comment_deleted = _signals.signal('comment-deleted')
+#: The pipeline processed a new comment, which is now public unless a check objected.
+#: Receives ``comment`` and ``operation``
+comment_processed = _signals.signal('comment-processed')
+#: A vote was cast or changed. Receives ``voteset``, ``vote`` and ``operation``
+vote_cast = _signals.signal('vote-cast')
+#: A vote was withdrawn. Receives ``voteset``, ``user`` and ``operation``
+vote_cancelled = _signals.signal('vote-cancelled')
+#: Votes were cast with :meth:`Commentease.vote_batch`. Receives ``votes``, a list
+#: of ``(user, voteset, data)`` for votes that changed, and ``operation``
+votes_cast = _signals.signal('votes-cast')
+#: A comment thread was rendered. Receives ``commentset`` and ``operation``
+thread_rendered = _signals.signal('thread-rendered')
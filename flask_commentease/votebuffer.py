@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_commentease.votebuffer
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Write-behind buffer for voteset counts and scores
+"""
+
+import os
+import atexit
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
+from sqlalchemy.sql import bindparam
+
+__all__ = ['VoteBuffer']
+
+logger = logging.getLogger(__name__)
+
+
+def _merge(target, deltas):
+    for voteset_id, (count, score) in deltas.items():
+        oldcount, oldscore = target.get(voteset_id, (0, 0))
+        target[voteset_id] = (oldcount + count, oldscore + score)
+
+
+class VoteBuffer(object):
+    """
+    Coalesces changes to voteset counts and scores so that a burst of votes on a
+    popular voteset becomes a single UPDATE instead of one per vote.
+
+    Vote rows are written as usual. Count and score changes are staged against the
+    session that made them and enter the buffer only when that session commits, so
+    rolled back votes are never counted. The buffer is due for a flush when it holds
+    ``size`` votesets or ``interval`` seconds have passed since the last flush.
+
+    Given a ``flush`` function, :meth:`start` also calls it every ``interval``
+    seconds from a background thread, so that a quiet site flushes too, and once more
+    when the process exits. Changes still in the buffer are lost if the process dies
+    without exiting cleanly. Recount the affected votesets to recover (see
+    :meth:`Commentease.reconcile_votes`).
+    """
+    def __init__(self, size=100, interval=5, flush=None):
+        self.size = size
+        self.interval = interval
+        self.flush_function = flush
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._staged = WeakKeyDictionary()
+        self._committing = WeakKeyDictionary()
+        self._flushed_at = time()
+        self._pid = None
+        self._stopped = None
+
+    def start(self):
+        """
+        Start the flush timer, unless it is running or there is no ``flush`` function.
+        It starts again in a forked child process, since threads don't survive a fork.
+        """
+        with self._lock:
+            if self.flush_function is None or self._pid == os.getpid():
+                return
+            if self._pid is None:
+                atexit.register(self._flush_at_exit)
+            self._pid = os.getpid()
+            self._stopped = threading.Event()
+            thread = threading.Thread(target=self._run, args=(self._stopped,),
+                name='commentease-votebuffer')
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """
+        Stop the flush timer.
+        """
+        with self._lock:
+            if self._stopped is not None:
+                self._stopped.set()
+            self._pid = None
+
+    def _run(self, stopped):
+        while not stopped.wait(self.interval):
+            if self._pending:
+                try:
+                    self.flush_function()
+                except Exception:
+                    logger.exception("Failed to flush buffered votes")
+
+    def _flush_at_exit(self):
+        if self._pending and self.flush_function is not None:
+            try:
+                self.flush_function()
+            except Exception:
+                logger.exception("Failed to flush buffered votes at exit")
+
+    def add(self, session, voteset_id, count=0, score=0):
+        """
+        Stage a change to a voteset's count and score.
+        """
+        with self._lock:
+            _merge(self._staged.setdefault(session, {}), {voteset_id: (count, score)})
+
+    def prepare(self, session):
+        """
+        Hold the buffer while the given session commits, if it has staged changes,
+        until :meth:`commit`, :meth:`rollback` or :meth:`release`. Votes counted in
+        :meth:`held` then either miss the session's vote rows and its changes, or
+        see both.
+        """
+        if session in self._staged and session not in self._committing:
+            self._lock.acquire()
+            self._committing[session] = True
+
+    def commit(self, session):
+        """
+        Move changes staged in the given session into the buffer.
+        """
+        with self._lock:
+            staged = self._staged.pop(session, None)
+            if staged:
+                _merge(self._pending, staged)
+            self.release(session)
+
+    def rollback(self, session):
+        """
+        Discard changes staged in the given session.
+        """
+        with self._lock:
+            self._staged.pop(session, None)
+            self.release(session)
+
+    def release(self, session):
+        """
+        Stop holding the buffer for the given session, if :meth:`prepare` did.
+        """
+        if self._committing.pop(session, None):
+            self._lock.release()
+
+    @contextmanager
+    def held(self):
+        """
+        Keep committed changes out of the buffer while the block runs. Count votes
+        and :meth:`discard` the counted votesets in the block, so that changes
+        committed between the count and the discard aren't discarded uncounted.
+        The block waits for sessions between :meth:`prepare` and :meth:`commit`,
+        whose votes are in the database but not yet in the buffer.
+        """
+        with self._lock:
+            yield
+
+    def discard(self, session, voteset_id):
+        """
+        Discard buffered changes for a voteset that is being recounted in the given
+        session, since the recount already reflects them. See :meth:`held`.
+        """
+        with self._lock:
+            self._pending.pop(voteset_id, None)
+            if session in self._staged:
+                self._staged[session].pop(voteset_id, None)
+
+    def due(self):
+        """
+        Is the buffer due for a flush?
+        """
+        return bool(self._pending) and (len(self._pending) >= self.size
+            or time() - self._flushed_at >= self.interval)
+
+    def flush(self, bind, table, callback=None):
+        """
+        Apply buffered changes to the voteset table with one executemany UPDATE in its
+        own transaction. ``callback``, if given, is called with the connection and the
+        updated voteset ids within the same transaction. Returns the number of
+        votesets updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time()
+        if not pending:
+            return 0
+        statement = table.update().where(table.c.id == bindparam('_id')).values(
+            count=table.c.count + bindparam('_count'),
+            score=table.c.score + bindparam('_score'))
+        try:
+            with bind.begin() as connection:
+                connection.execute(statement, [{'_id': voteset_id, '_count': count, '_score': score}
+                    for voteset_id, (count, score) in pending.items()])
+                if callback is not None:
+                    callback(connection, list(pending))
+        except:
+            # Put the changes back so the next flush can retry them
+            with self._lock:
+                _merge(self._pending, pending)
+            raise
+        return len(pending)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Application, models and helpers shared by the tests. Each test gets fresh tables
+in an in-memory SQLite database.
+"""
+
+import unittest
+from flask import Flask, g, session
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select
+from baseframe import baseframe
+from flask_commentease import Commentease, CommentingMixin, COMMENT_STATUS
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+app.config['SECRET_KEY'] = 'test'
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['CSRF_ENABLED'] = False
+db = SQLAlchemy(app)
+
+
+class User(db.Model):
+    __tablename__ = 'user'
+    id = db.Column(db.Integer, primary_key=True)
+    fullname = db.Column(db.Unicode(80), nullable=False)
+
+
+class Document(CommentingMixin, db.Model):
+    __tablename__ = 'document'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(None, db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship(User)
+
+
+commentease = Commentease(app, db)
+baseframe.init_app(app, requires=[])
+
+
+@app.before_request
+def load_user():
+    g.user = User.query.get(session['user_id']) if 'user_id' in session else None
+
+
+@app.route('/documents/<int:document_id>/comments', methods=['GET', 'POST'])
+def document_comments(document_id):
+    document = Document.query.get_or_404(document_id)
+    return commentease.comment_action(document.comments, g.user)
+
+
+@app.route('/documents/<int:document_id>/comments/page')
+def document_comments_page(document_id):
+    document = Document.query.get_or_404(document_id)
+    return commentease.page_action(document.comments, g.user, document)
+
+
+class CommenteaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ctx = app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.users = [User(fullname=u'User %d' % i) for i in range(4)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.session.remove()
+        self.ctx.pop()
+
+    def document(self):
+        document = Document(user=self.users[0])
+        commentease.enable_commenting(document)
+        db.session.add(document)
+        db.session.commit()
+        return document
+
+    def post(self, document, user, message, reply_to=None, status=COMMENT_STATUS.PUBLIC):
+        """
+        Post a comment through the ORM, as ``comment_action`` does.
+        """
+        comment = commentease.Comment(user=user, commentset=document.comments, message=message,
+            status=status)
+        comment.reply_to = reply_to
+        comment.votes.vote(user, +1)
+        db.session.add(comment)
+        db.session.commit()
+        return comment
+
+    def thread(self, document):
+        """
+        Post a small thread and return its comments, in posting order::
+
+            0 ─ 1 ─ 2
+              └ 3
+            4 ─ 5
+            6
+        """
+        users = self.users
+        comments = []
+        for author, parent, message in [(0, None, u'first post'), (1, 0, u'a reply'),
+                (2, 1, u'a nested reply'), (3, 0, u'another reply'), (1, None, u'second post'),
+                (2, 4, u'reply to the second'), (3, None, u'third post')]:
+            comments.append(self.post(document, users[author], message,
+                comments[parent] if parent is not None else None))
+        document.comments.recount()
+        db.session.commit()
+        return comments
+
+    def client(self, user=None):
+        """
+        A test client, logged in as ``user`` if given.
+        """
+        client = app.test_client()
+        if user is not None:
+            with client.session_transaction() as client_session:
+                client_session['user_id'] = user.id
+        return client
+
+    def comment_state(self, commentset):
+        """
+        The stored state of the comments in a comment set, as a dictionary of
+        message to status, reply count and depth.
+        """
+        comment_table = commentease.Comment.__table__
+        return dict((row[0], tuple(row[1:])) for row in db.session.execute(select([
+            comment_table.c.message, comment_table.c.status, comment_table.c.reply_count,
+            comment_table.c.depth]).where(comment_table.c.commentset_id == commentset.id)))
+
+    def assertNoDrift(self):
+        self.assertEqual(commentease.CommentSet.repair(fix=False), [])
+        self.assertEqual(commentease.VoteSet.repair(fix=False), [])
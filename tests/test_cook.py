@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from flask_commentease import COMMENT_STATUS
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+class TestCook(CommenteaseTestCase):
+    def html_comment(self, document, message):
+        comment = commentease.Comment(user=self.users[1], commentset=document.comments,
+            status=COMMENT_STATUS.PUBLIC)
+        comment.parser = u'html'
+        comment.message = message
+        db.session.add(comment)
+        db.session.commit()
+        return comment
+
+    def test_memoized(self):
+        calls = []
+        parsers = commentease.parsers
+
+        def parser(text):
+            calls.append(text)
+            return u'<p>%s</p>' % text
+        commentease.parsers = dict(parsers, counting=parser)
+        try:
+            self.assertEqual(commentease.cook(u'counting', u'hello'), u'<p>hello</p>')
+            self.assertEqual(commentease.cook(u'counting', u'hello'), u'<p>hello</p>')
+            commentease.cook(u'counting', u'goodbye')
+            # Cooking the same text with another parser isn't served from the cache
+            self.assertEqual(commentease.cook(u'html', u'hello'), u'hello')
+        finally:
+            commentease.parsers = parsers
+        self.assertEqual(calls, [u'hello', u'goodbye'])
+
+    def test_parser_column(self):
+        document = self.document()
+        comment = self.html_comment(document, u'<em>fine</em><script>alert(1)</script>')
+        self.assertEqual(comment.message_html, u'<em>fine</em>&lt;script&gt;alert(1)&lt;/script&gt;')
+        markdown = self.post(document, self.users[1], u'*fine*')
+        self.assertEqual(markdown.message_html, u'<p><em>fine</em></p>')
+
+    def test_recook(self):
+        document, other = self.document(), self.document()
+        comment = self.html_comment(document, u'<em>styled</em> <code>x</code>')
+        untouched = self.html_comment(other, u'<em>elsewhere</em>')
+        version = document.comments.version
+        tags = commentease.sanitize_tags
+        commentease.sanitize_tags = [tag for tag in tags if tag != 'em']
+        commentease._configure_sanitizer()
+        try:
+            self.assertEqual(commentease.recook(document.comments, batch_size=1), 1)
+            db.session.expire_all()
+            self.assertEqual(comment.message_html, u'&lt;em&gt;styled&lt;/em&gt; <code>x</code>')
+            self.assertEqual(untouched.message_html, u'<em>elsewhere</em>')
+            self.assertEqual(document.comments.version, version + 1)
+            # Nothing left to change
+            self.assertEqual(commentease.recook(document.comments), 0)
+        finally:
+            commentease.sanitize_tags = tags
+            commentease._configure_sanitizer()
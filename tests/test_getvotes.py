@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import event
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+class TestGetVotes(CommenteaseTestCase):
+    def count_queries(self, f):
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            result = f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return result, len(statements)
+
+    def test_voteset_getvotes(self):
+        document = self.document()
+        comments = self.thread(document)
+        comments[0].votes.vote(self.users[2], -1)
+        db.session.commit()
+        votesets = [comment.votes for comment in comments]
+        # The fixture's posters vote for their own comments
+        expected = dict((comment.votes.id, +1) for comment in comments if comment.user == self.users[2])
+        expected[comments[0].votes.id] = -1
+        for given in [votesets, [voteset.id for voteset in votesets]]:
+            votes, queries = self.count_queries(lambda: commentease.VoteSet.getvotes(self.users[2], given))
+            self.assertEqual(dict((voteset_id, vote.data) for voteset_id, vote in votes.items()), expected)
+            self.assertEqual(queries, 1)
+        self.assertEqual(commentease.VoteSet.getvotes(None, votesets), {})
+        self.assertEqual(self.count_queries(lambda: commentease.VoteSet.getvotes(self.users[2], []))[1], 0)
+
+    def test_commentset_getvotes(self):
+        document, other = self.document(), self.document()
+        comments = self.thread(document)
+        elsewhere = self.post(other, self.users[1], u'elsewhere')
+        expected = sorted(comment.votes_id for comment in comments if comment.user == self.users[1])
+        commentset, user = document.comments, self.users[1]
+        votes, queries = self.count_queries(lambda: commentset.getvotes(user))
+        self.assertEqual(sorted(votes), expected)
+        self.assertNotIn(elsewhere.votes_id, votes)
+        self.assertEqual(queries, 1)
+
+    def test_render_queries_independent_of_size(self):
+        # Rendering looks up the viewer's votes once, however many comments there are
+        small, large = self.document(), self.document()
+        self.thread(small)
+        self.thread(large)
+        self.thread(large)
+        db.session.expire_all()
+        queries = [self.count_queries(lambda: commentease.thread_html(document, self.users[1],
+            u'/comments'))[1] for document in [small, large]]
+        self.assertEqual(queries[0], queries[1])
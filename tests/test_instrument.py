@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from flask import g
+from flask_commentease.signals import comment_posted, vote_cast, thread_rendered
+from .fixtures import CommenteaseTestCase, commentease, app, db
+
+
+class TestInstrumentation(CommenteaseTestCase):
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        self.operations = []
+        commentease.metrics_sink(self.operations.append)
+
+    def tearDown(self):
+        commentease.instrumentation = None
+        super(TestInstrumentation, self).tearDown()
+
+    def test_sink(self):
+        document = self.document()
+        comment = self.post(document, self.users[0], u'hello')
+        del self.operations[:]
+        comment.votes.vote(self.users[1], +1)
+        db.session.commit()
+        commentease.thread_html(document, self.users[1], u'/comments')
+        self.assertEqual([operation.name for operation in self.operations], ['vote', 'render'])
+        vote, render = self.operations
+        self.assertTrue(vote.statements >= 1)
+        self.assertTrue(render.statements >= 2)
+        self.assertTrue(0 <= render.sql_time <= render.duration)
+
+    def test_summary(self):
+        document = self.document()
+        g.commentease_operations = []
+        self.thread(document)
+        totals = commentease.metrics()
+        self.assertEqual(totals['vote']['count'], 7)
+        self.assertEqual(totals['vote']['statements'], sum(operation.statements
+            for operation in self.operations if operation.name == 'vote'))
+
+    def test_disabled(self):
+        commentease.instrumentation = None
+        self.assertEqual(commentease.metrics(), {})
+        with commentease.measure('vote') as operation:
+            pass
+        self.assertIsNone(operation.statements)
+        self.assertIsNotNone(operation.duration)
+
+
+class TestSignals(CommenteaseTestCase):
+    def receive(self, signal):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append((sender, kwargs))
+        signal.connect(receiver, app)
+        self.addCleanup(signal.disconnect, receiver, app)
+        return received
+
+    def test_vote_cast(self):
+        document = self.document()
+        comment = self.post(document, self.users[0], u'hello')
+        received = self.receive(vote_cast)
+        comment.votes.vote(self.users[1], -1)
+        [(sender, kwargs)] = received
+        self.assertIs(sender, app)
+        self.assertIs(kwargs['voteset'], comment.votes)
+        self.assertEqual(kwargs['vote'].data, -1)
+        self.assertEqual(kwargs['operation'].name, 'vote')
+
+    def test_comment_posted(self):
+        document = self.document()
+        received = self.receive(comment_posted)
+        response = self.client(self.users[1]).post('/documents/%d/comments' % document.id,
+            data={'form.id': 'newcomment', 'message': u'posted'})
+        self.assertEqual(response.status_code, 302)
+        [(sender, kwargs)] = received
+        self.assertEqual(kwargs['comment'].message, u'posted')
+        self.assertIsNotNone(kwargs['operation'].duration)
+
+    def test_thread_rendered(self):
+        document = self.document()
+        received = self.receive(thread_rendered)
+        commentease.thread_html(document, None, u'/comments')
+        self.assertEqual([kwargs['commentset'] for sender, kwargs in received], [document.comments])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import re
+from .fixtures import CommenteaseTestCase, commentease
+
+
+class TestIterThread(CommenteaseTestCase):
+    def setUp(self):
+        super(TestIterThread, self).setUp()
+        self.chained = self.document()
+        # A chain of replies five levels deep
+        comment = None
+        for depth in range(5):
+            comment = self.post(self.chained, self.users[depth % 4], u'level %d' % depth,
+                reply_to=comment)
+
+    def tearDown(self):
+        commentease.max_depth = None
+        commentease.flatten_depth = None
+        super(TestIterThread, self).tearDown()
+
+    def render(self, **kwargs):
+        return u''.join(commentease.iter_thread(self.chained.comments.thread(), self.chained, None,
+            u'/comments', **kwargs))
+
+    def messages(self, html):
+        return re.findall(r'level \d', html)
+
+    def test_nested(self):
+        html = self.render()
+        self.assertEqual(self.messages(html), [u'level 0', u'level 1', u'level 2', u'level 3', u'level 4'])
+        self.assertEqual(html.count(u'<ul class="com-children">'), 4)
+        self.assertEqual(html.count(u'<li'), html.count(u'</li>'))
+
+    def test_max_depth(self):
+        commentease.max_depth = 2
+        html = self.render()
+        self.assertEqual(self.messages(html), [u'level 0', u'level 1', u'level 2'])
+        self.assertIn(u'1 more reply', html)
+        self.assertEqual(html.count(u'<li'), html.count(u'</li>'))
+
+    def test_flatten_depth(self):
+        commentease.flatten_depth = 1
+        html = self.render()
+        self.assertEqual(self.messages(html), [u'level 0', u'level 1', u'level 2', u'level 3', u'level 4'])
+        # Everything below the first level of replies is listed at that level
+        self.assertEqual(html.count(u'<ul class="com-children">'), 1)
+        self.assertEqual(html.count(u'<li'), html.count(u'</li>'))
+
+    def test_chunks(self):
+        chunks = list(commentease.iter_thread(self.chained.comments.thread(), self.chained, None,
+            u'/comments', chunk_size=1))
+        # One chunk per comment, then the closing tags
+        self.assertEqual(len(chunks), 6)
+        self.assertEqual(u''.join(chunks), self.render())
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import event
+from werkzeug.exceptions import NotFound
+from flask_commentease import page_json
+from .fixtures import CommenteaseTestCase, commentease, app, db
+
+
+class TestJSONViews(CommenteaseTestCase):
+    def setUp(self):
+        super(TestJSONViews, self).setUp()
+        commentease.thread_access(lambda commentset, user: True)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        commentease._thread_access = None
+        super(TestJSONViews, self).tearDown()
+
+    def test_conditional_get(self):
+        document = self.document()
+        comments = self.thread(document)
+        url = '/commentease/%d/thread.json' % document.comments.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+        comments[3].votes.vote(self.users[1], +1)
+        db.session.commit()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_etag_varies_with_arguments(self):
+        document = self.document()
+        self.thread(document)
+        url = '/commentease/%d/page.json' % document.comments.id
+        first = self.client.get(url + '?limit=1')
+        second = self.client.get(url + '?limit=2')
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(self.client.get(url + '?limit=2', headers={
+            'If-None-Match': first.headers['ETag']}).status_code, 200)
+        self.assertEqual(self.client.get(url + '?limit=1', headers={
+            'If-None-Match': first.headers['ETag']}).status_code, 304)
+
+        since = '/commentease/%d/since.json' % document.comments.id
+        self.assertNotEqual(self.client.get(since + '?cursor=0').headers['ETag'],
+            self.client.get(since + '?cursor=3').headers['ETag'])
+
+
+    def test_bad_arguments(self):
+        document = self.document()
+        self.thread(document)
+        for view in ['page.json', 'since.json']:
+            url = '/commentease/%d/%s' % (document.comments.id, view)
+            for limit in ['0', '-1']:
+                self.assertEqual(self.client.get(url + '?limit=' + limit).status_code, 400)
+            self.assertEqual(self.client.get(url + '?limit=1000').status_code, 200)
+        # The app's error pages need assets that aren't built here, so the view is called directly
+        with app.test_request_context('/?comment=abc'):
+            self.assertRaises(NotFound, page_json, document.comments.id)
+
+    def test_poll_reads_one_row(self):
+        document = self.document()
+        comments = self.thread(document)
+        state = commentease.thread_state(document.comments)
+        comments[3].votes.vote(self.users[1], +1)
+        db.session.commit()
+        commentset = document.comments
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            self.assertNotEqual(commentease.thread_state(commentset), state)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('voteset', statements[0])
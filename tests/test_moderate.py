@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import select
+from flask_commentease import COMMENT_STATUS
+from flask_commentease.pipeline import Pipeline
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+class TestModerate(CommenteaseTestCase):
+    def test_hide_by_author(self):
+        document = self.document()
+        comments = self.thread(document)
+        changed = commentease.moderate(COMMENT_STATUS.HIDDEN, user=self.users[1])
+        db.session.commit()
+        self.assertEqual(changed, 2)
+        self.assertEqual(set(comment.id for comment in comments if comment.status == COMMENT_STATUS.HIDDEN),
+            set([comments[1].id, comments[4].id]))
+        self.assertEqual(document.comments.count, 5)
+        self.assertEqual([comment.id for comment in document.comments.thread()],
+            [comments[6].id, comments[0].id])
+        self.assertNoDrift()
+
+    def test_publish_leaves_unscreened_comments(self):
+        document = self.document()
+        comments = self.thread(document)
+        screened = self.post(document, self.users[2], u'not checked yet', status=COMMENT_STATUS.SCREENED)
+        draft = self.post(document, self.users[2], u'half written', status=COMMENT_STATUS.DRAFT)
+        commentease.moderate(COMMENT_STATUS.SPAM, ids=[comments[6].id])
+        db.session.commit()
+
+        changed = commentease.moderate(COMMENT_STATUS.PUBLIC, commentset=document.comments)
+        db.session.commit()
+        self.assertEqual(changed, 1)
+        self.assertEqual(comments[6].status, COMMENT_STATUS.PUBLIC)
+        self.assertEqual(screened.status, COMMENT_STATUS.SCREENED)
+        self.assertEqual(draft.status, COMMENT_STATUS.DRAFT)
+
+        changed = commentease.moderate(COMMENT_STATUS.PUBLIC, commentset=document.comments,
+            current=[COMMENT_STATUS.SCREENED])
+        db.session.commit()
+        self.assertEqual(changed, 1)
+        self.assertEqual(screened.status, COMMENT_STATUS.PUBLIC)
+        self.assertEqual(draft.status, COMMENT_STATUS.DRAFT)
+        self.assertNoDrift()
+
+    def test_publish_cooks_screened(self):
+        document = self.document()
+        commentease.pipeline = Pipeline(lambda ids: None)
+        try:
+            screened = self.post(document, self.users[2], u'*waiting*', status=COMMENT_STATUS.SCREENED)
+        finally:
+            commentease.pipeline = None
+        self.assertEqual(screened.message_html, u'')
+
+        commentease.moderate(COMMENT_STATUS.PUBLIC, ids=[screened.id], current=[COMMENT_STATUS.SCREENED])
+        db.session.commit()
+        self.assertEqual(screened.status, COMMENT_STATUS.PUBLIC)
+        self.assertEqual(screened.message_html, u'<p><em>waiting</em></p>')
+
+    def test_delete_matches_orm(self):
+        slow, fast = self.document(), self.document()
+        slow_comments, fast_comments = self.thread(slow), self.thread(fast)
+        order = [0, 2, 1, 3, 6]
+
+        for index in order:
+            slow_comments[index].delete()
+            db.session.commit()
+        slow.comments.recount()
+        db.session.commit()
+
+        removed = [fast_comments[index].id for index in order]
+        removed_votes = [fast_comments[index].votes_id for index in order]
+        changed = commentease.moderate(COMMENT_STATUS.DELETED, ids=removed)
+        db.session.commit()
+
+        self.assertEqual(changed, len(order))
+        self.assertEqual(self.comment_state(fast.comments), self.comment_state(slow.comments))
+        self.assertEqual(self.comment_state(fast.comments), {
+            u'second post': (COMMENT_STATUS.PUBLIC, 1, 0),
+            u'reply to the second': (COMMENT_STATUS.PUBLIC, 0, 1)})
+        self.assertEqual((fast.comments.count, fast.comments.count_toplevel, fast.comments.count_replies),
+            (2, 1, 1))
+        self.assertNoDrift()
+
+        # Votes, votesets and closure rows of removed comments are gone with them
+        for model, column in [(commentease.Vote, 'voteset_id'), (commentease.VoteSet, 'id')]:
+            table = model.__table__
+            self.assertEqual(db.session.execute(select([table]).where(
+                table.c[column].in_(removed_votes))).fetchall(), [])
+        tree_table = commentease.CommentTree.__table__
+        self.assertEqual(db.session.execute(select([tree_table]).where(
+            tree_table.c.child_id.in_(removed))).fetchall(), [])
+
+        # And so are their search rows
+        for document, comments in [(slow, slow_comments), (fast, fast_comments)]:
+            found, page = commentease.search(u'reply', commentset=document.comments)
+            self.assertEqual([comment.id for comment in found], [comments[5].id])
+            found, page = commentease.search(u'post', commentset=document.comments)
+            self.assertEqual([comment.id for comment in found], [comments[4].id])
+
+    def test_delete_keeps_placeholders(self):
+        document = self.document()
+        comments = self.thread(document)
+        commentease.moderate(COMMENT_STATUS.DELETED, ids=[comments[0].id, comments[2].id])
+        db.session.commit()
+        state = self.comment_state(document.comments)
+        self.assertEqual(state[u''], (COMMENT_STATUS.DELETED, 2, 0))
+        self.assertEqual(state[u'a reply'], (COMMENT_STATUS.PUBLIC, 0, 1))
+        self.assertNotIn(u'a nested reply', state)
+        self.assertEqual(commentease.search(u'first', commentset=document.comments), ([], None))
+        self.assertNoDrift()
+
+    def test_nothing_selected(self):
+        self.assertRaises(ValueError, commentease.moderate, COMMENT_STATUS.HIDDEN)
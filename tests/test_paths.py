@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import select
+from flask_commentease import COMMENT_STATUS
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+def tree_state(commentset):
+    """
+    The stored tree columns of a comment set's comments, by id.
+    """
+    comment_table = commentease.Comment.__table__
+    return dict((row[0], tuple(row[1:])) for row in db.session.execute(select([comment_table.c.id,
+        comment_table.c.reply_count, comment_table.c.depth, comment_table.c.root_id,
+        comment_table.c.path]).where(comment_table.c.commentset_id == commentset.id)))
+
+
+class TestPaths(CommenteaseTestCase):
+    def test_listeners_match_rebuild(self):
+        document = self.document()
+        comments = self.thread(document)
+        state = tree_state(document.comments)
+        self.assertEqual(state[comments[2].id], (0, 2, comments[0].id,
+            u'%016x%016x%016x' % (comments[0].id, comments[1].id, comments[2].id)))
+        self.assertEqual(state[comments[0].id][:3], (2, 0, comments[0].id))
+
+        commentease.Comment.rebuild([document.comments.id])
+        db.session.commit()
+        self.assertEqual(tree_state(document.comments), state)
+        self.assertNoDrift()
+
+    def test_large_ids(self):
+        document = self.document()
+        parent = self.post(document, self.users[0], u'parent')
+        big = commentease.Comment(id=2 ** 40, user=self.users[1], commentset=document.comments,
+            message=u'big id', status=COMMENT_STATUS.PUBLIC)
+        big.reply_to = parent
+        db.session.add(big)
+        db.session.commit()
+        self.post(document, self.users[2], u'below the big id', reply_to=big)
+        self.post(document, self.users[2], u'after the big id', reply_to=parent)
+        state = tree_state(document.comments)
+        self.assertEqual(state[big.id][3], u'%016x%016x' % (parent.id, 2 ** 40))
+
+        # The big id sorts after its smaller sibling, and its reply stays in its subtree
+        self.assertEqual([comment.message for comment in parent.subtree().sorted_replies()],
+            [u'after the big id', u'big id'])
+        self.assertEqual([comment.message for comment in big.subtree().replies], [u'below the big id'])
+
+        commentease.Comment.rebuild([document.comments.id])
+        db.session.commit()
+        self.assertEqual(tree_state(document.comments), state)
+
+    def test_subtree(self):
+        document = self.document()
+        comments = self.thread(document)
+        root = comments[0].subtree()
+        self.assertEqual(set(reply.id for reply in root.replies), set([comments[1].id, comments[3].id]))
+        self.assertEqual([reply.id for reply in comments[1].replies], [comments[2].id])
+
+    def test_more_replies_counts_listed(self):
+        document = self.document()
+        comments = self.thread(document)
+        self.post(document, self.users[3], u'held back', reply_to=comments[0],
+            status=COMMENT_STATUS.SCREENED)
+        commentease.moderate(COMMENT_STATUS.HIDDEN, ids=[comments[3].id])
+        db.session.commit()
+        db.session.expire_all()
+
+        page, cursor = document.comments.page(limit=10, depth=0)
+        self.assertEqual(dict((comment.message, comment.more_replies()) for comment in page),
+            {u'first post': 1, u'second post': 1, u'third post': 0})
+        first = [comment for comment in page if comment.message == u'first post'][0]
+        self.assertEqual(first.reply_count, 3)
+
+        # Counts are dropped when the comment expires, and counted again on their own
+        db.session.expire_all()
+        self.assertFalse(hasattr(first, '_listed_replies'))
+        self.assertEqual(first.shown_replies(), [])
+        self.assertEqual(first.more_replies(), 1)
+
+    def test_delete_with_replies(self):
+        document = self.document()
+        comments = self.thread(document)
+        comments[4].delete()
+        db.session.commit()
+        self.assertEqual(comments[4].status, COMMENT_STATUS.DELETED)
+        comments[6].delete()
+        db.session.commit()
+        self.assertNotIn(u'third post', self.comment_state(document.comments))
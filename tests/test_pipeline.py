@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+from flask_commentease import COMMENT_STATUS
+from flask_commentease.pipeline import Pipeline
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+class TestPipeline(unittest.TestCase):
+    def test_batches(self):
+        batches = []
+        pipeline = Pipeline(batches.append, workers=1, batch_size=2)
+        for item in range(5):
+            self.assertTrue(pipeline.submit(item))
+        pipeline.stop(1)
+        self.assertEqual(sorted(item for batch in batches for item in batch), list(range(5)))
+        self.assertTrue(all(1 <= len(batch) <= 2 for batch in batches))
+
+    def test_backpressure(self):
+        release = threading.Event()
+        pipeline = Pipeline(lambda batch: release.wait(1), workers=1, queue_size=1, batch_size=1)
+        submitted = [pipeline.submit(item) for item in range(4)]
+        # The worker holds at most one item and the queue one more
+        self.assertFalse(all(submitted))
+        self.assertFalse(pipeline.submit(4))
+        release.set()
+        pipeline.stop(1)
+
+    def test_failure_logged(self):
+        batches = []
+
+        def process(batch):
+            batches.append(batch)
+            raise RuntimeError("process failed")
+        pipeline = Pipeline(process, workers=1, batch_size=1)
+        pipeline.submit(1)
+        pipeline.submit(2)
+        pipeline.stop(1)
+        # The worker carried on after the first failure
+        self.assertEqual(batches, [[1], [2]])
+
+
+class TestProcessComments(CommenteaseTestCase):
+    def setUp(self):
+        super(TestProcessComments, self).setUp()
+        # Nothing is processed in the background, so tests run it when they choose
+        commentease.pipeline = Pipeline(lambda ids: None, workers=0)
+
+    def tearDown(self):
+        commentease.pipeline = None
+        del commentease.checks[:]
+        super(TestProcessComments, self).tearDown()
+
+    def submit(self, document, message):
+        response = self.client(self.users[1]).post('/documents/%d/comments' % document.id,
+            data={'form.id': 'newcomment', 'message': message})
+        self.assertEqual(response.status_code, 302)
+        db.session.expire_all()
+        return commentease.Comment.query.filter_by(_message=message).one()
+
+    def test_screened_then_public(self):
+        document = self.document()
+        comment = self.submit(document, u'*waiting*')
+        self.assertEqual(comment.status, COMMENT_STATUS.SCREENED)
+        self.assertEqual(comment.message_html, u'')
+        self.assertEqual(document.comments.count, 0)
+
+        self.assertEqual(commentease.process_comments(), 1)
+        db.session.expire_all()
+        self.assertEqual(comment.status, COMMENT_STATUS.PUBLIC)
+        self.assertEqual(comment.message_html, u'<p><em>waiting</em></p>')
+        self.assertEqual(document.comments.count, 1)
+        self.assertEqual(commentease.process_comments(), 0)
+        self.assertNoDrift()
+
+    def test_check(self):
+        @commentease.comment_check
+        def spam(comment):
+            if u'buy' in comment.message:
+                return COMMENT_STATUS.SPAM
+        document = self.document()
+        spammy, fine = self.submit(document, u'buy now'), self.submit(document, u'hello')
+        commentease.process_comments([spammy.id, fine.id])
+        db.session.expire_all()
+        self.assertEqual((spammy.status, fine.status), (COMMENT_STATUS.SPAM, COMMENT_STATUS.PUBLIC))
+        self.assertEqual(document.comments.count, 1)
+
+    def test_full_queue_processes_inline(self):
+        document = self.document()
+        # With no workers and no room in the queue, the view processes the comment itself
+        commentease.pipeline = Pipeline(lambda ids: None, workers=0, queue_size=1)
+        commentease.pipeline.submit(0)
+        comment = self.submit(document, u'straight through')
+        self.assertEqual(comment.status, COMMENT_STATUS.PUBLIC)
+        self.assertEqual(comment.message_html, u'<p>straight through</p>')
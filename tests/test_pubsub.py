@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+from flask_commentease.pubsub import PubSub
+from .fixtures import CommenteaseTestCase, commentease, app, db
+
+
+class TestPubSub(CommenteaseTestCase):
+    def setUp(self):
+        super(TestPubSub, self).setUp()
+        commentease.pubsub = PubSub(maxsize=2)
+        commentease.thread_access(lambda commentset, user: True)
+
+    def tearDown(self):
+        commentease.pubsub = None
+        commentease._thread_access = None
+        super(TestPubSub, self).tearDown()
+
+    def events(self, subscription):
+        events = []
+        message = subscription.get(timeout=0)
+        while message is not None:
+            events.append(json.loads(message))
+            message = subscription.get(timeout=0)
+        return events
+
+    def test_queue(self):
+        pubsub = commentease.pubsub
+        with pubsub.subscribe(u'a') as first:
+            second = pubsub.subscribe(u'a')
+            other = pubsub.subscribe(u'b')
+            for message in [u'1', u'2', u'3']:
+                pubsub.publish(u'a', message)
+            second.close()
+            pubsub.publish(u'a', u'4')
+            # A full queue drops the overflow
+            self.assertEqual([first.get(0), first.get(0), first.get(0)], [u'1', u'2', None])
+            self.assertEqual([second.get(0), second.get(0), second.get(0)], [u'1', u'2', None])
+            self.assertIsNone(other.get(0))
+        self.assertEqual(list(pubsub._subscriptions), [u'b'])
+
+    def test_published_on_commit(self):
+        document = self.document()
+        with commentease.pubsub.subscribe(u'commentease/%d' % document.comments.id) as subscription:
+            commentease.publish(document.comments.id, u'delete', {'id': 1}, db.session())
+            db.session.rollback()
+            commentease.publish(document.comments.id, u'delete', {'id': 2}, db.session())
+            self.assertEqual(self.events(subscription), [])
+            db.session.commit()
+            self.assertEqual(self.events(subscription), [{'type': u'delete', 'data': {'id': 2}}])
+
+    def test_comment_and_votes(self):
+        document = self.document()
+        comment = self.post(document, self.users[0], u'hello')
+        with commentease.pubsub.subscribe(u'commentease/%d' % document.comments.id) as subscription:
+            response = self.client(self.users[1]).post('/documents/%d/comments' % document.id,
+                data={'form.id': 'newcomment', 'message': u'pushed'})
+            self.assertEqual(response.status_code, 302)
+            [posted] = self.events(subscription)
+            self.assertEqual((posted['type'], posted['data']['html']), (u'comment', u'<p>pushed</p>'))
+
+            comment.votes.vote(self.users[1], +1)
+            db.session.commit()
+            self.assertEqual(self.events(subscription), [{'type': u'votes',
+                'data': {unicode(comment.id): {'count': 2, 'score': 2}}}])
+
+    def test_long_poll(self):
+        document = self.document()
+        response = self.client().get('/commentease/%d/events?timeout=0' % document.comments.id)
+        self.assertEqual(json.loads(response.data), {'events': []})
+        self.assertEqual(commentease.pubsub._subscriptions, {})
+
+    def test_event_stream(self):
+        document = self.document()
+        response = self.client().get('/commentease/%d/events' % document.comments.id,
+            headers={'Accept': 'text/event-stream'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        stream = iter(response.response)
+        self.assertEqual(next(stream), b'retry: 3000\n\n')
+        commentease.publish(document.comments.id, u'delete', {'id': 1})
+        self.assertEqual(json.loads(next(stream)[len(b'data: '):]), {'type': u'delete', 'data': {'id': 1}})
+        response.close()
+        self.assertEqual(commentease.pubsub._subscriptions, {})
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime, timedelta
+from flask_commentease import ranking
+from .fixtures import CommenteaseTestCase, commentease, db
+
+now = datetime(2014, 6, 1, 12, 0)
+
+
+def order(ranker, comments):
+    """
+    Names of ``(name, count, score, created_at)`` comments, highest rank first.
+    """
+    return [comment[0] for comment in sorted(comments, key=lambda comment: -ranker(*comment[1:]))]
+
+
+class TestRankers(unittest.TestCase):
+    def test_score(self):
+        self.assertEqual(order(ranking.score, [('down', 3, -1, now), ('none', 0, 0, now),
+            ('up', 5, 3, now), ('many', 100, 4, now)]), ['many', 'up', 'none', 'down'])
+
+    def test_wilson(self):
+        # One lucky vote ranks below many mostly good ones, and even below an even split of ten
+        self.assertEqual(order(ranking.wilson, [('lucky', 1, 1, now), ('popular', 100, 60, now),
+            ('mixed', 10, 0, now), ('none', 0, 0, now)]), ['popular', 'mixed', 'lucky', 'none'])
+        self.assertEqual(ranking.wilson(0, 0, now), 0.0)
+        self.assertTrue(0 < ranking.wilson(10, 10, now) < 1)
+
+    def test_hot(self):
+        # Each 12.5 hours of age must be made up by ten times the score
+        self.assertEqual(order(ranking.hot, [('old', 10, 10, now - timedelta(hours=20)),
+            ('new', 1, 1, now), ('older', 100, 100, now - timedelta(hours=24)),
+            ('buried', 5, -5, now)]), ['older', 'new', 'old', 'buried'])
+        self.assertAlmostEqual(ranking.hot(10, 10, now - timedelta(hours=12.5)), ranking.hot(1, 1, now))
+
+
+class TestRerank(CommenteaseTestCase):
+    def test_votes_reorder_page(self):
+        document = self.document()
+        document.comments.ranking = u'wilson'
+        first = self.post(document, self.users[0], u'first')
+        second = self.post(document, self.users[1], u'second')
+        for user in self.users[2:]:
+            second.votes.vote(user, +1)
+        first.votes.vote(self.users[2], -1)
+        db.session.commit()
+        comments, cursor = document.comments.page()
+        self.assertEqual([comment.message for comment in comments], [u'second', u'first'])
+
+    def test_failure_after_commit(self):
+        document = self.document()
+        comment = self.post(document, self.users[0], u'hello')
+        rank = comment.rank
+
+        def fail(session, voteset_ids):
+            raise RuntimeError("rerank failed")
+        commentease._rerank_committed = fail
+        try:
+            comment.votes.vote(self.users[1], +1)
+            db.session.commit()
+        finally:
+            del commentease._rerank_committed
+        db.session.expire_all()
+        self.assertEqual(comment.votes.count, 2)
+        self.assertEqual(comment.rank, rank)
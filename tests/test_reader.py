@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Read paths with ``COMMENT_READ_BIND``. The read bind is a second SQLite file
+that nothing replicates to, so a query can be told apart both by the engine it
+runs on and by the rows it sees.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from flask_commentease import Commentease, CommentingMixin
+
+tempdir = tempfile.mkdtemp()
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempdir, 'primary.db')
+app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + os.path.join(tempdir, 'replica.db')}
+app.config['COMMENT_READ_BIND'] = 'replica'
+app.config['SECRET_KEY'] = 'test'
+db = SQLAlchemy(app)
+
+
+class User(db.Model):
+    __tablename__ = 'user'
+    id = db.Column(db.Integer, primary_key=True)
+
+
+class Document(CommentingMixin, db.Model):
+    __tablename__ = 'document'
+    id = db.Column(db.Integer, primary_key=True)
+
+
+commentease = Commentease(app, db)
+
+
+@app.route('/read')
+def read():
+    return 'primary' if commentease.reader() is db.session else 'replica'
+
+
+@app.route('/write')
+def write():
+    commentease.mark_write()
+    return 'ok'
+
+
+def teardown_module():
+    shutil.rmtree(tempdir)
+
+
+class TestReader(unittest.TestCase):
+    def setUp(self):
+        self.ctx = app.test_request_context()
+        self.ctx.push()
+        self.primary = db.get_engine(app)
+        self.replica = db.get_engine(app, 'replica')
+        db.metadata.create_all(self.primary)
+        db.metadata.create_all(self.replica)
+        self.statements = {}
+        self.listeners = [(engine, self.counter(name))
+            for name, engine in [('primary', self.primary), ('replica', self.replica)]]
+        for engine, listener in self.listeners:
+            event.listen(engine, 'before_cursor_execute', listener)
+
+        self.document = Document()
+        commentease.enable_commenting(self.document)
+        self.user = User()
+        db.session.add_all([self.document, self.user])
+        db.session.commit()
+        self.commentset_id = self.document.comments.id
+        db.session.add(commentease.Comment(user=self.user, commentset=self.document.comments,
+            message=u'hello'))
+        db.session.commit()
+        self.statements.clear()
+
+    def tearDown(self):
+        for engine, listener in self.listeners:
+            event.remove(engine, 'before_cursor_execute', listener)
+        db.session.remove()
+        commentease._remove_read_session()
+        db.metadata.drop_all(self.primary)
+        db.metadata.drop_all(self.replica)
+        self.ctx.pop()
+
+    def counter(self, name):
+        def count(conn, cursor, statement, parameters, context, executemany):
+            self.statements[name] = self.statements.get(name, 0) + 1
+        return count
+
+    def test_reader(self):
+        reader = commentease.reader()
+        self.assertIsNot(reader, db.session)
+        self.assertIs(reader.get_bind(), self.replica)
+        # The replica has none of the primary's rows
+        self.assertEqual(reader.query(commentease.Comment).count(), 0)
+        self.assertEqual(db.session.query(commentease.Comment).count(), 1)
+        self.assertEqual(self.statements, {'replica': 1, 'primary': 1})
+
+    def test_thread_state(self):
+        commentset = commentease.CommentSet.query.get(self.commentset_id)
+        self.statements.clear()
+        # The comment set isn't on the replica, so the primary is asked next
+        state = commentease.thread_state(commentset)
+        self.assertEqual(self.statements, {'replica': 1, 'primary': 1})
+
+        commentease.mark_write()
+        self.statements.clear()
+        self.assertEqual(commentease.thread_state(commentset), state)
+        self.assertEqual(self.statements, {'primary': 1})
+
+    def test_mark_write(self):
+        commentease.mark_write()
+        self.assertIs(commentease.reader(), db.session)
+        commentset = db.session.query(commentease.CommentSet).get(self.commentset_id)
+        self.statements.clear()
+        comments, cursor = commentset.page(session=commentease.reader())
+        self.assertEqual([comment.message for comment in comments], [u'hello'])
+        self.assertNotIn('replica', self.statements)
+
+    def test_read_your_writes(self):
+        # Requests get their own app context, and so their own g, only if none is active
+        self.ctx.pop()
+        try:
+            client = app.test_client()
+            self.assertEqual(client.get('/read').data, b'replica')
+            client.get('/write')
+            # Later requests from the same client read from the primary until the time is up
+            self.assertEqual(client.get('/read').data, b'primary')
+            self.assertEqual(app.test_client().get('/read').data, b'replica')
+            with client.session_transaction() as session:
+                session['commentease_primary_until'] -= commentease.read_sticky + 1
+            self.assertEqual(client.get('/read').data, b'replica')
+        finally:
+            self.ctx.push()
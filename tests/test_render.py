@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import re
+from sqlalchemy import event
+from flask_commentease.cache import LRUCache
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+class TestCachedRender(CommenteaseTestCase):
+    def setUp(self):
+        super(TestCachedRender, self).setUp()
+        commentease.cache = LRUCache(1024 * 1024)
+
+    def tearDown(self):
+        commentease.cache = None
+        commentease.page_size = 20
+        super(TestCachedRender, self).tearDown()
+
+    def test_placeholders_filled(self):
+        document = self.document()
+        self.thread(document)
+        rendered = []
+        for attempt in range(2):
+            html = commentease.thread_html(document, self.users[1], u'/comments')
+            self.assertEqual(html.count(u'<li class="comment">'), 7)
+            self.assertNotIn(u'&lt;', html)
+            self.assertNotIn(u'<!--commentease:', html)
+            # Users see edit links on their own comments only, and their own votes
+            self.assertEqual(html.count(u'class="comment-edit"'), 2)
+            self.assertEqual(html.count(u'class="comment-vote-cancel"'), 2)
+            rendered.append(html)
+        self.assertEqual(rendered[0], rendered[1])
+
+        # The same markup as without a cache, apart from whitespace
+        commentease.cache = None
+        uncached = commentease.thread_html(document, self.users[1], u'/comments')
+        self.assertEqual(re.sub(r'\s+', u' ', uncached), re.sub(r'\s+', u' ', rendered[0]))
+
+        commentease.cache = LRUCache(1024 * 1024)
+        anonymous = commentease.thread_html(document, None, u'/comments')
+        self.assertNotIn(u'class="comment-edit"', anonymous)
+        self.assertNotIn(u'class="comment-vote-cancel"', anonymous)
+
+    def test_personalize_reads_shown_comments(self):
+        document = self.document()
+        comments = self.thread(document)
+        commentease.page_size = 1
+        html = commentease.thread_html(document, self.users[1], u'/comments')
+        self.assertEqual(html.count(u'<li class="comment">'), 1)
+
+        parameters = []
+
+        def capture(conn, cursor, statement, params, context, executemany):
+            parameters.append(params)
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            commentease.personalize(u'<!--commentease:vote:%d-->' % comments[6].id, document.comments,
+                self.users[1], u'/comments')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        # One query for the comment, one for the user's vote on it
+        self.assertEqual(len(parameters), 2)
+        self.assertIn(comments[6].id, parameters[0])
+        self.assertEqual(len(parameters[0]), 2)
+        self.assertEqual(len(parameters[1]), 2)
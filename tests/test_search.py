@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from flask_commentease import COMMENT_STATUS
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+class TestSearch(CommenteaseTestCase):
+    def messages(self, terms, **kwargs):
+        comments, page = commentease.search(terms, **kwargs)
+        return sorted(comment.message for comment in comments)
+
+    def test_filters(self):
+        document, other = self.document(), self.document()
+        self.post(document, self.users[1], u'cheap watches here')
+        self.post(document, self.users[2], u'where are the watches?')
+        self.post(document, self.users[2], u'nothing to see', status=COMMENT_STATUS.SPAM)
+        self.post(other, self.users[1], u'more cheap watches', status=COMMENT_STATUS.SPAM)
+        self.assertEqual(self.messages(u'cheap watches'), [u'cheap watches here', u'more cheap watches'])
+        self.assertEqual(self.messages(u'watches', commentset=document.comments),
+            [u'cheap watches here', u'where are the watches?'])
+        self.assertEqual(self.messages(u'watches', status=COMMENT_STATUS.SPAM), [u'more cheap watches'])
+        self.assertEqual(self.messages(u'watches', user=self.users[2]), [u'where are the watches?'])
+        self.assertEqual(self.messages(u'   '), [])
+        # Search syntax in the terms is taken literally
+        self.assertEqual(self.messages(u'"watches OR'), [])
+
+    def test_index_follows_changes(self):
+        document = self.document()
+        comment = self.post(document, self.users[1], u'original words')
+        comment.message = u'edited text'
+        db.session.commit()
+        self.assertEqual(self.messages(u'original'), [])
+        self.assertEqual(self.messages(u'edited'), [u'edited text'])
+        comment.delete()
+        db.session.commit()
+        self.assertEqual(self.messages(u'edited'), [])
+
+    def test_pages(self):
+        document = self.document()
+        for i in range(5):
+            self.post(document, self.users[1], u'page filler %d' % i)
+        seen = []
+        page = 1
+        while page is not None:
+            comments, page = commentease.search(u'filler', page=page, per_page=2)
+            self.assertTrue(len(comments) <= 2)
+            seen.extend(comment.message for comment in comments)
+        self.assertEqual(sorted(seen), [u'page filler %d' % i for i in range(5)])
+
+    def test_reindex(self):
+        document = self.document()
+        self.post(document, self.users[1], u'indexed later')
+        connection = db.session.connection()
+        if commentease._search_backend(connection) == 'fts5':
+            connection.execute('DELETE FROM comment_fts')
+            self.assertEqual(self.messages(u'indexed'), [])
+        commentease.reindex_search([document.comments.id])
+        db.session.commit()
+        self.assertEqual(self.messages(u'indexed'), [u'indexed later'])
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import event
+from .fixtures import CommenteaseTestCase, commentease, db, Document
+
+
+class Proposal(db.Model):
+    """
+    A model that gets the mixins from ``addmixin`` instead of subclassing them.
+    """
+    __tablename__ = 'proposal'
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.Unicode(80), nullable=False)
+
+
+commentease.addmixin(Proposal)
+
+
+class TestSummary(CommenteaseTestCase):
+    def count_queries(self, f):
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            result = f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return result, len(statements)
+
+    def test_addmixin(self):
+        proposal = Proposal(title=u'Talk')
+        commentease.enable_voting(proposal)
+        commentease.enable_commenting(proposal)
+        self.assertTrue(proposal.allow_voting and proposal.allow_commenting)
+        db.session.add(proposal)
+        db.session.commit()
+        proposal.votes.vote(self.users[1], +1)
+        proposal.votes.vote(self.users[2], -1)
+        proposal.votes.vote(self.users[3], -1)
+        db.session.add(commentease.Comment(user=self.users[0], commentset=proposal.comments,
+            message=u'Good talk'))
+        proposal.comments.count = 1
+        db.session.commit()
+        db.session.expunge_all()
+
+        proposals, queries = self.count_queries(lambda: [(p.title, p.vote_count, p.vote_score,
+            p.comment_count) for p in Proposal.query.options(*commentease.summary_options(Proposal))])
+        self.assertEqual(proposals, [(u'Talk', 3, -1, 1)])
+        self.assertEqual(queries, 1)
+
+    def test_subclass(self):
+        document = self.document()
+        self.post(document, self.users[1], u'hello')
+        document.comments.recount()
+        db.session.commit()
+        db.session.expunge_all()
+
+        counts, queries = self.count_queries(lambda: [document.comment_count for document in
+            Document.query.options(*commentease.summary_options(Document))])
+        self.assertEqual(counts, [1])
+        self.assertEqual(queries, 1)
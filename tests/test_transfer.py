@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import select
+from flask_commentease import VOTE_PATTERN
+from .fixtures import CommenteaseTestCase, commentease, db, User
+
+
+def snapshot():
+    """
+    Every row that an export and import should reproduce, including those the
+    import rebuilds rather than copies.
+    """
+    tables = [
+        (commentease.CommentSet, ['id', 'count', 'count_toplevel', 'count_replies', 'version']),
+        (commentease.Comment, ['id', 'commentset_id', 'reply_to_id', 'user_id', 'status', 'message',
+            'message_html', 'votes_id', 'rank', 'reply_count', 'depth', 'root_id', 'path']),
+        (commentease.CommentTree, ['parent_id', 'child_id', 'depth']),
+        (commentease.VoteSet, ['id', 'count', 'score', 'pattern', 'min', 'max']),
+        (commentease.Vote, ['user_id', 'voteset_id', 'data']),
+        (commentease.VoteBucket, ['voteset_id', 'value', 'count']),
+        ]
+    state = {}
+    for model, columns in tables:
+        table = model.__table__
+        state[table.name] = sorted(tuple(row) for row in db.session.execute(
+            select([table.c[name] for name in columns])))
+    return state
+
+
+class TestTransfer(CommenteaseTestCase):
+    def test_round_trip(self):
+        document = self.document()
+        comments = self.thread(document)
+        for user in self.users[1:]:
+            comments[1].votes.vote(user, -1)
+        comments[2].votes.cancelvote(self.users[2])
+        rated = commentease.Comment(user=self.users[0], commentset=document.comments,
+            message=u'rate this', votepattern=VOTE_PATTERN.RANGE)
+        rated.votes.min, rated.votes.max = 1, 5
+        db.session.add(rated)
+        db.session.commit()
+        for value, user in zip([4, 5, 4], self.users):
+            rated.votes.vote(user, value)
+        document.comments.recount()
+        db.session.commit()
+        before = snapshot()
+
+        users = [(user.id, user.fullname) for user in self.users]
+        nested_id = comments[2].id
+        lines = list(commentease.export_comments([document.comments.id]))
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([User(id=id, fullname=fullname) for id, fullname in users])
+        db.session.commit()
+
+        counts = commentease.import_comments(lines)
+        self.assertEqual(counts, {'commentset': 1, 'voteset': 8, 'comment': 8, 'vote': 11})
+        self.assertEqual(snapshot(), before)
+        self.assertNoDrift()
+        found, page = commentease.search(u'nested')
+        self.assertEqual([comment.id for comment in found], [nested_id])
+
+    def test_export_selected(self):
+        first, second = self.document(), self.document()
+        self.thread(first)
+        self.post(second, self.users[1], u'elsewhere')
+        lines = list(commentease.export_comments([second.comments.id]))
+        self.assertEqual(len(lines), 4)
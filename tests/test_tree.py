@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import event, select
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+def closure(commentset):
+    """
+    The closure rows of a comment set's comments, as ``(parent_id, child_id, depth)``.
+    """
+    tree_table = commentease.CommentTree.__table__
+    comment_table = commentease.Comment.__table__
+    return sorted(tuple(row) for row in db.session.execute(select([tree_table.c.parent_id,
+        tree_table.c.child_id, tree_table.c.depth]).where(tree_table.c.child_id.in_(
+        select([comment_table.c.id]).where(comment_table.c.commentset_id == commentset.id)))))
+
+
+class TestCommentTree(CommenteaseTestCase):
+    def count_queries(self, f):
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            result = f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return result, len(statements)
+
+    def test_rows_on_post(self):
+        document = self.document()
+        comments = self.thread(document)
+        ids = [comment.id for comment in comments]
+        rows = closure(document.comments)
+        # Every comment is its own ancestor, and the nested reply has two more
+        self.assertEqual(len(rows), 7 + 4 + 1)
+        self.assertEqual([row for row in rows if row[1] == ids[2]],
+            sorted([(ids[0], ids[2], 2), (ids[1], ids[2], 1), (ids[2], ids[2], 0)]))
+
+        commentease.CommentTree.rebuild([document.comments.id])
+        db.session.commit()
+        self.assertEqual(closure(document.comments), rows)
+
+    def test_rows_on_delete(self):
+        document = self.document()
+        comments = self.thread(document)
+        removed = comments[2].id
+        comments[2].delete()
+        db.session.commit()
+        self.assertFalse([row for row in closure(document.comments) if removed in row[:2]])
+        self.assertEqual(len(closure(document.comments)), 6 + 3)
+
+    def test_thread_in_one_query(self):
+        document = self.document()
+        self.thread(document)
+        commentset = document.comments
+        db.session.expunge_all()
+        db.session.add(commentset)
+
+        def walk():
+            def messages(comments):
+                return sorted((comment.message, messages(comment.replies)) for comment in comments)
+            return messages(commentset.thread())
+        tree, queries = self.count_queries(walk)
+        self.assertEqual(queries, 1)
+        self.assertEqual(tree, [
+            (u'first post', [(u'a reply', [(u'a nested reply', [])]), (u'another reply', [])]),
+            (u'second post', [(u'reply to the second', [])]),
+            (u'third post', [])])
+
+    def test_subtree_depth(self):
+        document = self.document()
+        comments = self.thread(document)
+        db.session.expire_all()
+        root = comments[0].subtree(max_depth=1)
+        self.assertEqual(sorted(reply.message for reply in root.replies), [u'a reply', u'another reply'])
+        reply = [reply for reply in root.replies if reply.message == u'a reply'][0]
+        # The level below the limit isn't loaded, only counted
+        self.assertEqual(reply.more_replies(), 1)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import select
+from werkzeug.exceptions import NotFound
+from flask_commentease import COMMENT_STATUS
+from .fixtures import CommenteaseTestCase, commentease, app, db
+
+
+class TestCommentAction(CommenteaseTestCase):
+    def submit(self, document, user, **data):
+        data.setdefault('form.id', 'newcomment')
+        response = self.client(user).post('/documents/%d/comments' % document.id, data=data)
+        self.assertEqual(response.status_code, 302)
+        db.session.expire_all()
+
+    def test_reply(self):
+        document = self.document()
+        parent = self.post(document, self.users[0], u'parent')
+        self.submit(document, self.users[1], message=u'a reply', comment_reply_to_id=str(parent.id))
+
+        reply = commentease.Comment.query.filter_by(reply_to=parent).one()
+        tree_table = commentease.CommentTree.__table__
+        self.assertEqual(sorted(db.session.execute(select([tree_table.c.parent_id, tree_table.c.depth]).where(
+            tree_table.c.child_id == reply.id)).fetchall()), [(parent.id, 1), (reply.id, 0)])
+        self.assertEqual([comment.id for comment in parent.subtree().replies], [reply.id])
+        self.assertIn(u'a reply', commentease.thread_html(document, None, u'/comments'))
+
+    def test_reply_tree_columns(self):
+        document = self.document()
+        parent = self.post(document, self.users[0], u'parent')
+        document.comments.recount()
+        db.session.commit()
+        self.submit(document, self.users[1], message=u'a reply', comment_reply_to_id=str(parent.id))
+
+        reply = commentease.Comment.query.filter_by(reply_to=parent).one()
+        self.assertEqual((reply.depth, reply.root_id, reply.path),
+            (1, parent.id, parent.path + u'%016x' % reply.id))
+        self.assertEqual(parent.reply_count, 1)
+        self.assertNoDrift()
+
+        # The parent has a reply, so deleting it leaves a placeholder
+        self.submit(document, self.users[0], **{'form.id': 'delcomment', 'comment_id': str(parent.id)})
+        self.assertEqual(parent.status, COMMENT_STATUS.DELETED)
+        self.assertEqual(reply.reply_to_id, parent.id)
+        self.assertNoDrift()
+
+    def test_reply_elsewhere_is_top_level(self):
+        document, other = self.document(), self.document()
+        parent = self.post(other, self.users[0], u'parent')
+        self.submit(document, self.users[1], message=u'stray', comment_reply_to_id=str(parent.id))
+        comment = commentease.Comment.query.filter_by(commentset=document.comments).one()
+        self.assertEqual((comment.reply_to_id, comment.depth, comment.root_id), (None, 0, comment.id))
+
+    def test_parent_is_fixed(self):
+        document = self.document()
+        first = self.post(document, self.users[0], u'first')
+        second = self.post(document, self.users[0], u'second')
+        second.reply_to = first
+        self.assertRaises(ValueError, db.session.flush)
+
+
+class TestPageAction(CommenteaseTestCase):
+    def test_page(self):
+        document = self.document()
+        self.thread(document)
+        commentease.page_size = 1
+        try:
+            response = self.client().get('/documents/%d/comments/page' % document.id)
+        finally:
+            commentease.page_size = 20
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count(b'<li'), 1)
+
+    def test_bad_comment(self):
+        document = self.document()
+        self.thread(document)
+        # The app's error pages need assets that aren't built here, so the view is called directly
+        for comment in ['abc', '999']:
+            with app.test_request_context('/?comment=' + comment):
+                self.assertRaises(NotFound, commentease.page_action, document.comments, None, document)
+
+    def test_page_size_at_least_one(self):
+        document = self.document()
+        self.thread(document)
+        for limit in [0, -1]:
+            comments, cursor = document.comments.page(limit=limit)
+            self.assertEqual(len(comments), 1)
+            self.assertIsNotNone(cursor)
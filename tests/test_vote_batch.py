@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import json
+from flask import session
+from werkzeug.exceptions import BadRequest
+from flask_commentease import VOTE_PATTERN
+from .fixtures import CommenteaseTestCase, commentease, app, db
+
+
+class TestVoteBatch(CommenteaseTestCase):
+    def votesets(self, document):
+        """
+        One voteset of each pattern, on comments of a document.
+        """
+        votesets = []
+        for pattern in [VOTE_PATTERN.UP_ONLY, VOTE_PATTERN.UP_DOWN, VOTE_PATTERN.RANGE,
+                VOTE_PATTERN.CUSTOM]:
+            comment = commentease.Comment(user=self.users[0], commentset=document.comments,
+                message=u'pattern %d' % pattern, votepattern=pattern)
+            comment.votes.min, comment.votes.max = 1, 5
+            db.session.add(comment)
+            votesets.append(comment.votes)
+        db.session.commit()
+        document.comments.recount()
+        db.session.commit()
+        return votesets
+
+    def state(self, votesets):
+        return [(voteset.count, voteset.score, voteset.histogram(),
+            sorted((vote.user_id, vote.data) for vote in voteset.votes)) for voteset in votesets]
+
+    def test_matches_orm(self):
+        slow, fast = self.votesets(self.document()), self.votesets(self.document())
+        rounds = [
+            [(0, 0, None), (1, 0, None), (0, 1, +1), (1, 1, -1), (0, 2, 3), (1, 2, 5), (0, 3, 7)],
+            [(1, 1, +1), (0, 2, 4), (2, 2, 4), (0, 3, 8), (2, 0, None), (0, 1, +1)],
+            ]
+        for votes in rounds:
+            for user, index, data in votes:
+                slow[index].vote(self.users[user], data)
+            db.session.commit()
+            # Load everything the batch changes, so that stale instances would show
+            self.state(fast)
+            vote = fast[2].getvote(self.users[0])
+            changed = commentease.vote_batch((self.users[user], fast[index], data)
+                for user, index, data in votes)
+            self.assertEqual(self.state(fast), self.state(slow))
+            db.session.commit()
+        self.assertEqual(changed, 5)
+        self.assertEqual(vote.data, 4)
+        self.assertEqual(fast[2].histogram(), [(1, 0), (2, 0), (3, 0), (4, 2), (5, 1)])
+        self.assertNoDrift()
+
+    def test_invalid_votes_write_nothing(self):
+        votesets = self.votesets(self.document())
+        for data in [{'value': 1}, [1], u'1', 1.5]:
+            self.assertRaises(ValueError, commentease.vote_batch,
+                [(self.users[1], votesets[0], None), (self.users[1], votesets[3], data)])
+        self.assertRaises(ValueError, commentease.vote_batch, [(self.users[1], votesets[2], 6)])
+        db.session.commit()
+        self.assertEqual([voteset.count for voteset in votesets], [0, 0, 0, 0])
+
+    def test_action_rejects_invalid_data(self):
+        votesets = self.votesets(self.document())
+        for data in [{'value': 1}, [1, 2], u'up']:
+            body = json.dumps([{'voteset': votesets[3].id, 'data': data}])
+            with app.test_request_context(method='POST', data=body, content_type='application/json'):
+                self.assertRaises(BadRequest, commentease.vote_batch_action, self.users[1])
+
+    def test_action_without_csrf(self):
+        votesets = self.votesets(self.document())
+        body = json.dumps([{'voteset': votesets[0].id}, {'voteset': votesets[1].id, 'data': -1}])
+        with app.test_request_context(method='POST', data=body, content_type='application/json'):
+            response = commentease.vote_batch_action(self.users[1])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {'status': 'ok', 'votes': 2})
+
+    def test_action_with_csrf(self):
+        votesets = self.votesets(self.document())
+        votes = [{'voteset': votesets[0].id}]
+        app.config['CSRF_ENABLED'] = True
+        try:
+            with app.test_request_context():
+                token = commentease.CsrfForm().csrf_token.current_token
+                csrf_session = dict(session)
+
+            def post(body, headers={}):
+                with app.test_request_context(method='POST', data=json.dumps(body),
+                        content_type='application/json', headers=headers):
+                    session.update(csrf_session)
+                    return commentease.vote_batch_action(self.users[1])
+
+            for response in [post(votes), post(votes, {'X-CSRFToken': 'wrong'}),
+                    post({'csrf_token': 'wrong', 'votes': votes})]:
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(json.loads(response.data), {'status': 'error', 'error': 'csrf'})
+            self.assertEqual(votesets[0].count, 0)
+
+            response = post(votes, {'X-CSRFToken': token})
+            self.assertEqual(json.loads(response.data), {'status': 'ok', 'votes': 1})
+            response = post({'csrf_token': token, 'votes': [{'voteset': votesets[1].id, 'data': 1}]})
+            self.assertEqual(json.loads(response.data), {'status': 'ok', 'votes': 1})
+        finally:
+            app.config['CSRF_ENABLED'] = False
+        db.session.expire_all()
+        self.assertEqual([voteset.count for voteset in votesets[:2]], [1, 1])
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+from flask_commentease.votebuffer import VoteBuffer
+from .fixtures import CommenteaseTestCase, commentease, db
+
+
+class Session(object):
+    """
+    Stands in for a database session, which the buffer only uses as a key.
+    """
+
+
+class TestVoteBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buffer = VoteBuffer(size=2, interval=3600)
+
+    def test_coalesce(self):
+        first, second = Session(), Session()
+        self.buffer.add(first, 1, 1, 1)
+        self.buffer.add(first, 1, 1, -1)
+        self.buffer.add(second, 1, 1, 1)
+        self.assertEqual(self.buffer._pending, {})
+        self.buffer.commit(first)
+        self.assertEqual(self.buffer._pending, {1: (2, 0)})
+        self.assertFalse(self.buffer.due())
+        self.buffer.commit(second)
+        self.buffer.commit(second)
+        self.assertEqual(self.buffer._pending, {1: (3, 1)})
+
+        self.buffer.add(first, 2, 1, 1)
+        self.buffer.commit(first)
+        self.assertTrue(self.buffer.due())
+
+    def test_rollback(self):
+        session = Session()
+        self.buffer.add(session, 1, 1, 1)
+        self.buffer.rollback(session)
+        self.buffer.commit(session)
+        self.assertEqual(self.buffer._pending, {})
+
+    def test_discard(self):
+        session = Session()
+        self.buffer.add(session, 1, 1, 1)
+        self.buffer.add(session, 2, 1, 1)
+        self.buffer.commit(session)
+        self.buffer.add(session, 1, 1, 1)
+        with self.buffer.held():
+            self.buffer.discard(session, 1)
+        self.buffer.commit(session)
+        self.assertEqual(self.buffer._pending, {2: (1, 1)})
+
+    def test_count_waits_for_commit(self):
+        voter, counter = Session(), Session()
+        self.buffer.add(voter, 1, 1, 1)
+        # The voter's rows are in the database now, but its change isn't in the buffer
+        self.buffer.prepare(voter)
+        counted = threading.Event()
+
+        def recount():
+            with self.buffer.held():
+                counted.set()
+                self.buffer.discard(counter, 1)
+        thread = threading.Thread(target=recount)
+        thread.start()
+        self.assertFalse(counted.wait(0.1))
+        self.buffer.commit(voter)
+        thread.join(1)
+        self.assertTrue(counted.is_set())
+        # The recount saw the voter's rows and dropped its change, instead of both counting it
+        self.assertEqual(self.buffer._pending, {})
+
+    def test_release(self):
+        session = Session()
+        self.buffer.add(session, 1, 1, 1)
+        self.buffer.prepare(session)
+        self.buffer.release(session)
+        self.buffer.release(session)
+        thread = threading.Thread(target=lambda: self.buffer.discard(Session(), 1))
+        thread.start()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+
+class TestBufferedVotes(CommenteaseTestCase):
+    def setUp(self):
+        super(TestBufferedVotes, self).setUp()
+        commentease.votebuffer = VoteBuffer(size=100, interval=3600)
+
+    def tearDown(self):
+        commentease.votebuffer = None
+        super(TestBufferedVotes, self).tearDown()
+
+    def counts(self, comments):
+        db.session.expire_all()
+        return [(comment.votes.count, comment.votes.score) for comment in comments]
+
+    def test_flush(self):
+        document = self.document()
+        comments = self.thread(document)[:2]
+        for user in self.users[1:]:
+            comments[0].votes.vote(user, +1)
+        # The poster of the second comment changes their vote
+        comments[1].votes.vote(self.users[1], -1)
+        db.session.commit()
+        # The commit no longer holds the buffer
+        thread = threading.Thread(target=lambda: commentease.votebuffer.discard(Session(), 0))
+        thread.start()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.counts(comments), [(1, 1), (1, 1)])
+        self.assertEqual(commentease.flush_votes(), 2)
+        self.assertEqual(self.counts(comments), [(4, 4), (1, -1)])
+        self.assertEqual(commentease.flush_votes(), 0)
+        self.assertNoDrift()
+
+    def test_rollback_discards(self):
+        document = self.document()
+        comment = self.thread(document)[0]
+        comment.votes.vote(self.users[1], +1)
+        db.session.rollback()
+        self.assertEqual(commentease.flush_votes(), 0)
+        self.assertEqual(self.counts([comment]), [(1, 1)])
+
+    def test_recount_discards(self):
+        document = self.document()
+        comment = self.thread(document)[0]
+        comment.votes.vote(self.users[1], +1)
+        db.session.commit()
+        comment.votes.recount()
+        db.session.commit()
+        self.assertEqual(commentease.flush_votes(), 0)
+        self.assertEqual(self.counts([comment]), [(2, 2)])